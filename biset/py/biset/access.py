@@ -24,7 +24,7 @@ class BiSetBitsTrafo(Item):
         self.itemAddReceiver("req", BiSetRequest)
         self.itemAddSender("send", Bits)
         self.itemAddReceiver("recv", Bits)
-        choc.submit(self.run(), name=f"{self.name}~run")
+        self.itemSubmit(self.run(), name=f"{self.name}~run")
         
     async def run(self):
         sendSock = self.itemGet("send")
@@ -133,7 +133,7 @@ class Regfile(Item):
         self.dirty = set()
 
     def release(self):
-        choc.call(self.ccRelease(), name=f"{self.name}~release")
+        self.itemCall(self.ccRelease(), f"{self.name}~release")
 
     def lockRead(self):
         self.lockedRead = True
@@ -225,13 +225,13 @@ class Register:
         return val
 
     def rd(self, invalid:bool=False):
-        return choc.call(self.ccRd(invalid), f"{self.names[0]}~rd")
+        return self.regfile.itemCall(self.ccRd(invalid), f"{self.names[0]}~rd")
 
     async def ccWr(self, value:int):
         await self.regfile.ccWrite(self.addr, value, self.volatile or self.opaque)
 
     def wr(self, value:int):
-        choc.call(self.ccWr(value), f"{self.names[0]}~wr")
+        self.regfile.itemCall(self.ccWr(value), f"{self.names[0]}~wr")
 
     def dump(self):
         print(f'  {self.name:10s}:{self.rd():#x}')
@@ -255,7 +255,7 @@ class Field:
         return bitsel(regval, self.interval)
 
     def rd(self):
-        return choc.call(self.ccRd(), f"{self.name}~rd")
+        return self.register.regfile.itemCall(self.ccRd(), f"{self.name}~rd")
 
     async def ccWr(self, val):
         if not self.canWrite:
@@ -267,4 +267,4 @@ class Field:
         await self.register.ccWr(stripped | newval)
 
     def wr(self, val):
-        choc.call(self.ccWr(val), f"{self.name}~rd")
+        self.register.regfile.itemCall(self.ccWr(val), f"{self.name}~rd")
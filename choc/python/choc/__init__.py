@@ -27,6 +27,7 @@ from __future__ import annotations
 from abc import ABC, abstractmethod
 import threading
 import asyncio
+import contextlib
 import logging
 from concurrent.futures import Future
 import time
@@ -34,6 +35,19 @@ from typing import Coroutine
 
 from bilib.fn import etype
 
+#one loop with its thread - the daemon runs one or more of these
+class Shard:
+    def __init__(self, daemon:Daemon, idx:int, loop:asyncio.AbstractEventLoop=None):
+        self.idx = idx
+        self.watchDogTick = time.time()
+        if loop is not None:
+            self.loop = loop
+            self.thread = None
+            return
+        self.loop = asyncio.new_event_loop()
+        name = "ChocDaemon" if idx == 0 else f"ChocDaemon{idx}"
+        self.thread = threading.Thread(target=daemon.run, args=(self,), name=name)
+
 class Daemon:
     instance:Daemon = None
     logName = "ChocDaemon"
@@ -44,100 +58,155 @@ class Daemon:
             cls.instance = Daemon()
         return cls.instance
 
-    def __init__(self):
-        self.loop = asyncio.new_event_loop()
+    #without a loop the daemon runs its own loops in separate threads - one per shard
+    # with a loop choc is embedded into the application running that loop (see attach)
+    def __init__(self, loop:asyncio.AbstractEventLoop=None, shards:int=1):
+        etype((shards, int))
+        if shards < 1:
+            raise Exception(f"choc needs at least one shard (got {shards})")
+        self.embedded = loop is not None
         self.running = True
-        self.thread = threading.Thread(target=self.run, name="ChocDaemon")
-        self.thread.start()
+        self.nextShard = 0
+        if self.embedded:
+            if shards != 1:
+                raise Exception("an embedded choc cannot be sharded")
+            self.shards = [Shard(self, 0, loop)]
+            self.loop = loop
+            self.thread = None
+            return
+        self.shards = [Shard(self, idx) for idx in range(shards)]
+        #shard 0 is the default loop
+        self.loop = self.shards[0].loop
+        self.thread = self.shards[0].thread
+        for shard in self.shards:
+            shard.thread.start()
         self.watchdog = threading.Thread(
             target=self.watch, name="ChocDog",
             args=(threading.current_thread(),), daemon=True
         )
-        self.watchDogTick = time.time()
         self.watchdog.start()
 
+    #round robin over the shards - shard 0 is left to unpinned items if there are others
+    def autoShard(self) -> int:
+        count = len(self.shards)
+        if count == 1:
+            return 0
+        shard = self.nextShard % (count - 1) + 1
+        self.nextShard += 1
+        return shard
+
+    def getShard(self, shard:int) -> Shard:
+        if not 0 <= shard < len(self.shards):
+            raise Exception(f"choc has no shard {shard} (shards:{len(self.shards)})")
+        return self.shards[shard]
+
     def watch(self, main:threading.Thread):
         log = logging.getLogger(self.logName)
         logging.getLogger(self.logName).debug("watch dog started")
         while main.is_alive():
             main.join(0.5)
-            if self.watchDogTick + 5 < time.time():
-                current = asyncio.current_task(self.loop)
-                log.warning(f"async watch dog did not tick for 5 seconds - coroutine runing amok? maybe this one:{current}")
-                self.watchDogTick = time.time()
+            for shard in self.shards:
+                if shard.watchDogTick + 5 < time.time():
+                    current = asyncio.current_task(shard.loop)
+                    log.warning(f"async watch dog of shard {shard.idx} did not tick for 5 seconds - coroutine runing amok? maybe this one:{current}")
+                    shard.watchDogTick = time.time()
         logging.getLogger(self.logName).debug("main thread stopped - stopping choc also")
         self.stop()
 
-    async def watchAsync(self):
+    async def watchAsync(self, shard:Shard):
         try:
             while self.running:
                 await asyncio.sleep(1)
-                self.watchDogTick = time.time()
+                shard.watchDogTick = time.time()
         except asyncio.CancelledError:
             pass
 
-    def run(self):
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_until_complete(self.watchAsync())
-        logging.getLogger(self.logName).debug("loop shutdown async")
-        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
-        logging.getLogger(self.logName).debug("loop stop")
-        self.loop.stop()
-        logging.getLogger(self.logName).debug("loop close")
-        self.loop.close()
-        logging.getLogger(self.logName).debug("stopping daemon thread")
+    def run(self, shard:Shard):
+        loop = shard.loop
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.watchAsync(shard))
+        logging.getLogger(self.logName).debug(f"loop {shard.idx} shutdown async")
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        logging.getLogger(self.logName).debug(f"loop {shard.idx} stop")
+        loop.stop()
+        logging.getLogger(self.logName).debug(f"loop {shard.idx} close")
+        loop.close()
+        logging.getLogger(self.logName).debug(f"stopping daemon thread {shard.idx}")
     
+    #stopping twice (e.g. choc.stop and the watch dog at exit) is a noop
     def stop(self):
+        if not self.running:
+            return
         self.running = False
-        fut = asyncio.run_coroutine_threadsafe(self.cancelall(), self.loop)
-        fut.result()
+        if self.embedded:
+            for task in self.ownTasks():
+                task.cancel()
+            return
+        futs = [asyncio.run_coroutine_threadsafe(self.cancelall(), shard.loop) for shard in self.shards]
+        for fut in futs:
+            fut.result()
         #logging.getLogger(self.logName).debug("loop stop")
         #self.loop.call_soon_threadsafe(self.loop.stop)
 
+    #cancels all tasks of the loop it is running on
     async def cancelall(self):
         log = logging.getLogger(self.logName)
         log.debug("canceling everything")
-        for task in asyncio.all_tasks(self.loop):
+        for task in asyncio.all_tasks():
             if task == asyncio.current_task() or task.cancelling():
                 continue
             log.debug(f"canceling task:{task}")
             task.cancel()
         log.debug(f"canceled tasks done!")
 
+    #the running tasks on the loop of an embedded daemon - Task.store holds the tasks of all loops
+    def ownTasks(self) -> list[asyncio.Task]:
+        return [task.task for task in list(Task.store) if task.task.get_loop() is self.loop]
+
+    #stop an embedded daemon and wait for its tasks to finish
+    async def ccShutdown(self):
+        tasks = self.ownTasks()
+        self.stop()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 class TimedOut(Exception):
     pass
 
 class Task():
     store = set()
 
-    def __init__(self, coro:Coroutine, name:str, weak:bool=False):
-        etype((coro, Coroutine), (name, str), (weak, bool))
+    def __init__(self, coro:Coroutine, name:str, weak:bool=False, start:bool=True, shard:int=0):
+        etype((coro, Coroutine), (name, str), (weak, bool), (start, bool), (shard, int))
         self.coro = coro
         self.name = name
         self.task = None
-        self.waiting = False
         self.weak = weak
-        self.created = threading.Event()
-        Daemon.inst().loop.call_soon_threadsafe(self._ccCreate)
+        self.shard = shard
+        self.future = Future() #result of the task for other threads
+        if start:
+            runOnLoop(self._ccCreate, shard)
 
-    async def _ccGuard(self):
+    #create the task - this has to be run in the loop thread of the shard
+    def _ccCreate(self):
+        self.task = asyncio.create_task(self.coro, name=self.name)
         if not self.weak:
             self.store.add(self)
-        await self.task
-        if not self.weak:
-            self.store.remove(self)
+        self.task.add_done_callback(self._ccDone)
 
-    #create the task - this has to be run in the Choc Deamon thread
-    def _ccCreate(self):
-        self.task = asyncio.create_task(self.coro, name=self.name)
-        self.task.add_done_callback(dumpTaskException)
-        self.guard = asyncio.run_coroutine_threadsafe(self._ccGuard(), Daemon.inst().loop)
-        self.created.set()
+    def _ccDone(self, tsk:asyncio.Task):
+        self.store.discard(self)
+        if tsk.cancelled():
+            self.future.cancel()
+            return
+        dumpTaskException(tsk)
+        exc = tsk.exception()
+        if exc is None:
+            self.future.set_result(tsk.result())
+        else:
+            self.future.set_exception(exc)
 
     def __call__(self, timeout:float=None) -> any:
-        self.created.wait(timeout)
-        self.guard.result()
-        return self.task.result()
+        return self.future.result(timeout)
     
     async def ccCancel(self):    
         self.task.cancel()
@@ -145,33 +214,185 @@ class Task():
 
 
 def dumpTaskException(tsk:asyncio.Task):
-    if not Daemon.inst().running:
+    if Daemon.instance is None or not Daemon.instance.running:
         return
     exc = tsk.exception()
     if exc is not None and not isinstance(exc, asyncio.CancelledError):
         log = logging.getLogger("choc")
         log.error(f"Exception in Task:{tsk.get_name()}", exc_info=exc)
 
-#submits a coroutine to the daemon thread
+#shard pinned by pinShard for the current thread
+shardPin = threading.local()
+
+#the shard new work goes to - the pinned one, the one we are running on or the default shard 0
+def currentShard() -> int:
+    pinned = getattr(shardPin, "shard", None)
+    if pinned is not None:
+        return pinned
+    inst = Daemon.instance
+    if inst is None:
+        return 0
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return 0
+    for shard in inst.shards:
+        if shard.loop is loop:
+            return shard.idx
+    return 0
+
+#with choc.pinShard(): - items created in the block go to one shard (default: the next one round robin)
+@contextlib.contextmanager
+def pinShard(shard:int=None):
+    etype((shard, (int,None)))
+    if shard is None:
+        shard = Daemon.inst().autoShard()
+    Daemon.inst().getShard(shard)
+    prev = getattr(shardPin, "shard", None)
+    shardPin.shard = shard
+    try:
+        yield shard
+    finally:
+        shardPin.shard = prev
+
+#true if called from within a daemon loop (a given shard or any)
+def onLoop(shard:int=None) -> bool:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    if shard is not None:
+        return loop is Daemon.inst().getShard(shard).loop
+    return any(sh.loop is loop for sh in Daemon.inst().shards)
+
+#runs fn in the loop of a shard - directly if we are already there, otherwise with one thread hop
+def runOnLoop(fn:callable, shard:int=0):
+    if onLoop(shard):
+        fn()
+    else:
+        Daemon.inst().getShard(shard).loop.call_soon_threadsafe(fn)
+
+#starts the daemon with a number of shards (loops running in parallel threads)
+# has to be called before the first choc item is created
+def setup(shards:int=1) -> Daemon:
+    etype((shards, int))
+    inst = Daemon.instance
+    if inst is not None:
+        if len(inst.shards) == shards:
+            return inst
+        raise Exception(f"choc is already running with {len(inst.shards)} shards")
+    Daemon.instance = Daemon(shards=shards)
+    return Daemon.instance
+
+#submits a coroutine to a daemon thread (default: the current shard)
 # returns a handle to wait for the return value
-def submit(coro:asyncio.coroutine, name:str=None) -> Task:
-    etype((name, str))
-    th = Task(coro, name)
+def submit(coro:asyncio.coroutine, name:str=None, shard:int=None) -> Task:
+    etype((name, str), (shard, (int,None)))
+    if shard is None:
+        shard = currentShard()
+    th = Task(coro, name, shard=shard)
     return th
 
-#submits a coroutine to the daemon thread
+#submits a list of coroutines to a daemon thread at once
+# names can be a single name for all, a list of names or None (the name of each coroutine)
+# if the arguments are wrong, the coroutines are closed
+def submitMany(coros:list, names:str|list=None, shard:int=None) -> list[Task]:
+    try:
+        etype((coros, list, Coroutine), (names, (str,list,None), str), (shard, (int,None)))
+        if isinstance(names, list) and len(names) != len(coros):
+            raise ValueError(f"got {len(names)} names for {len(coros)} coroutines")
+        if shard is None:
+            shard = currentShard()
+        Daemon.inst().getShard(shard)
+    except Exception:
+        for coro in coros:
+            if isinstance(coro, Coroutine):
+                coro.close()
+        raise
+    if names is None:
+        names = [coro.__qualname__ for coro in coros]
+    elif not isinstance(names, list):
+        names = [names] * len(coros)
+    tasks = [Task(coro, name, start=False, shard=shard) for coro, name in zip(coros, names)]
+    startTasks(tasks, shard)
+    return tasks
+
+#starts tasks created with start=False - all of them with one hop to the loop of the shard
+def startTasks(tasks:list[Task], shard:int=0):
+    etype((tasks, list, Task), (shard, int))
+    def create():
+        for task in tasks:
+            task._ccCreate()
+    runOnLoop(create, shard)
+
+#submits a coroutine to a daemon thread
 # and waits for it to finish
 # returns the return value of the coroutine
-def call(coro:asyncio.coroutine, name:str=None, timeout:float=None) -> any:
-    hndl = submit(coro, name)
+# from a loop only other shards can be called (that loop is blocked meanwhile)
+def call(coro:asyncio.coroutine, name:str=None, timeout:float=None, shard:int=None) -> any:
+    if shard is None:
+        shard = currentShard()
+    if onLoop(shard):
+        coro.close()
+        raise Exception("choc.call would block the choc loop - await the coroutine directly")
+    hndl = submit(coro, name, shard)
     return hndl(timeout)
 
-#submits a coroutine that calls a function with given arguments
+#calls a function with given arguments in a daemon thread
 # waits for the function to finish and returns its return value
-def do(fn:callable, *args, name:str, **kwargs):
-    async def coroWrapper():
+def do(fn:callable, *args, name:str, shard:int=None, **kwargs):
+    if shard is None:
+        shard = currentShard()
+    if onLoop(shard):
         return fn(*args, **kwargs)
-    return call(coroWrapper(), name)
+    fut = Future()
+    def run():
+        try:
+            fut.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            fut.set_exception(e)
+    Daemon.inst().getShard(shard).loop.call_soon_threadsafe(run)
+    return fut.result()
+
+#embed choc into an application loop (default: the running loop)
+# items then run on that loop and the cc* coroutines can be awaited directly
+# has to be called before the first choc item is created
+def attach(loop:asyncio.AbstractEventLoop=None) -> Daemon:
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    inst = Daemon.instance
+    if inst is not None:
+        if inst.loop is loop:
+            return inst
+        raise Exception("choc is already running on another loop")
+    Daemon.instance = Daemon(loop)
+    return Daemon.instance
+
+#stop the embedded choc and release the loop
+def detach():
+    inst = Daemon.instance
+    if inst is None or not inst.embedded:
+        raise Exception("choc is not attached to a loop")
+    inst.stop()
+    Daemon.instance = None
+
+#async with choc.session(): - runs choc embedded on the running loop for the duration of the block
+@contextlib.asynccontextmanager
+async def session():
+    inst = attach()
+    try:
+        yield inst
+    finally:
+        await inst.ccShutdown()
+        Daemon.instance = None
+
+#connects a >> b >> c ..., fusing chains of plain converters into one stage
+def fuse(*items):
+    from choc.pipe import connect, deferStart
+    with deferStart():
+        for a, b in zip(items, items[1:]):
+            connect(a, b, fuse=True)
+    return items[-1]
 
 def stop():
     Daemon.inst().stop()
@@ -9,17 +9,23 @@
 ############            Authors:
 ############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
 
+from __future__ import annotations
 from abc import ABC, abstractmethod
 from asyncio import Queue
 import asyncio
+from collections import deque
+from concurrent.futures import Executor
+import heapq
 import logging
 from pathlib import Path
 import queue
-from typing import Iterable
+import struct
+import threading
+from typing import Callable, Iterable, Iterator
 import choc
 from bilib.fn import etype
-from choc.pipe import Item, PipeOffband, PipeType, Request, Socket
-from choc.types import L9, Bits, Change, Edge, NotPureSignal, Tme
+from choc.pipe import BATCH_SIZE, Fuse, Item, Pipe, PipeOffband, PipeType, Request, Socket
+from choc.types import CYCLE, Bits, Change, ChangeBuffer, Edge, NotPureSignal, Tme
 
 
 class RequestInput(Item):
@@ -28,7 +34,7 @@ class RequestInput(Item):
         super().__init__(name)
         self.queue = asyncio.Queue()
         self.itemAddSender("req", typ)
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
 
     async def run(self):
         reqSocket = self.itemGet("req")
@@ -42,25 +48,36 @@ class RequestInput(Item):
         return req.result
     
     def post(self, req:Request) -> choc.Task:
-        return choc.submit(self.process(req), f"{self.name}~process")
+        return self.itemSubmit(self.process(req), f"{self.name}~process")
 
 # sockets:
 # IO name   type      
 # -> in     <fromType>      (forged if multiplexer)
 # <- out    <toType>     
 
+#converts a batch of values - runs in an executor for offloaded converters
+def convertMany(fn:Callable, vals:list) -> list:
+    return [fn(val) for val in vals]
+
 class Converter(Item, ABC):
-    def __init__(self, name:str, fromType:PipeType, toType:PipeType, multiplexer:bool=False):
-        super().__init__(name)
+    executor:Executor = None #set by offload
+    def __init__(self, name:str, fromType:PipeType, toType:PipeType, multiplexer:bool=False, shard:int=None):
+        super().__init__(name, shard)
         self.itemAddSender("out", toType)
         self.fromType = fromType if multiplexer else None
         self.nPorts = 0
         if not multiplexer:
             sock = self.itemAddReceiver("in", fromType)
-            choc.submit(self.run(sock), name=f"{self.name}~run")
+            self.itemSubmit(self.run(sock), name=f"{self.name}~run")
 
     async def run(self, inSocket:Socket):
         outSocket = self.itemGet("out")
+        await inSocket.connected.wait()
+        if isinstance(inSocket.pipe, Fuse):
+            return #the sending converter runs our conversion
+        if self.executor is not None:
+            await self.runOffload(inSocket, outSocket)
+            return
         while True:
             inVal = await inSocket.recv()
             if isinstance(inVal, PipeOffband):
@@ -69,14 +86,62 @@ class Converter(Item, ABC):
             outVal = self.convert(inVal)
             await outSocket.send(outVal)
 
+    #run convert in an executor (thread or process pool) instead of the choc loop
+    # values are converted in batches of up to batch values, with at most inflight batches at once
+    # the output keeps the input order
+    # for process pools fn has to be a picklable replacement for convert (e.g. a module level function)
+    # has to be called before the converter is connected
+    def offload(self, executor:Executor, batch:int=64, inflight:int=4, fn:Callable=None) -> Converter:
+        etype((executor, Executor), (batch, int), (inflight, int), (fn, (Callable, None)))
+        assert batch > 0 and inflight > 0, "batch and inflight must be positive"
+        self.executor = executor
+        self.batch = batch
+        self.inflight = inflight
+        self.offloadFn = fn
+        return self
+
+    async def runOffload(self, inSocket:Socket, outSocket:Socket):
+        loop = asyncio.get_running_loop()
+        fn = self.convert if self.offloadFn is None else self.offloadFn
+        pending = deque() #batches in conversion, in input order
+        end = None #offband that ends the conversion
+        while True:
+            if end is None and len(pending) < self.inflight:
+                #only block for input if there is no result to wait for
+                vals = await inSocket.recvMany(self.batch, timeout=0 if pending else None)
+                for pos, val in enumerate(vals):
+                    if isinstance(val, PipeOffband):
+                        end = val
+                        vals = vals[:pos]
+                        break
+                if vals:
+                    pending.append(loop.run_in_executor(self.executor, convertMany, fn, vals))
+                    continue
+            if not pending:
+                if end is not None:
+                    break
+                continue
+            await outSocket.sendMany(await pending.popleft())
+        await outSocket.send(end)
+
     def forgeRecvSocket(self, typ:PipeType):
         if self.fromType is None or not typ.match(self.fromType):
             return None
         sock = self.itemAddReceiver(f"in{self.nPorts}", self.fromType)
-        choc.submit(self.run(sock), name=f"{self.name}~run{self.nPorts}")
+        self.itemSubmit(self.run(sock), name=f"{self.name}~run{self.nPorts}")
         self.nPorts += 1
         return sock
 
+    #a plain converter following another converter is run inline by the sending converter
+    def fusePipe(self, sock:Socket, peer:Socket) -> Pipe:
+        if type(self).run is not Converter.run or not isinstance(peer.parent, Converter):
+            return None
+        if self.executor is not None:
+            return None
+        if self.sockets.get("in") is not sock:
+            return None
+        return Fuse(f"{peer.name}+{sock.name}", sock, self.convert, self.itemGet("out"))
+
     @abstractmethod
     def convert(self, val:any) -> any:
         pass
@@ -93,7 +158,7 @@ class Multiplexer(Item):
         myTyp = self.itemGet('out').typ
         socket = self.itemAddReceiver(f"in{self.nPorts}", myTyp)
         self.nPorts += 1
-        choc.submit(self.receiver(socket), f"{self.name}~receiver")
+        self.itemSubmit(self.receiver(socket), f"{self.name}~receiver")
         return socket
 
     async def receiver(self, socket:Socket):
@@ -110,19 +175,77 @@ class Multiplexer(Item):
             return None
         return self.newPort()
 
+#merges the Change streams of several sockets by time (k-way merge on a heap)
+# changes at the same time are ordered by key(port, change), by default in port order
+# yields batches of (port, change) - a batch is yielded before waiting for input, so nothing is held back
+# pending are values that were already received from the sockets (one list per socket)
+async def ccMergeChanges(socks:list[Socket], key:Callable[[int, Change], any]=None, pending:list[list]=None):
+    log = logging.getLogger("ccMergeChanges")
+    queues = [deque() for _ in socks]
+    ended = [False] * len(socks)
+    heap = []
+    def take(port:int, vals:list):
+        for val in vals:
+            if not isinstance(val, PipeOffband):
+                queues[port].append(val)
+            elif val == PipeOffband.PipeEnd:
+                log.debug(f"input {socks[port]} ended")
+                ended[port] = True
+    for port, vals in enumerate(pending or []):
+        take(port, vals)
+    #puts the next change of a port on the heap - waits for it if none is queued
+    async def pull(port:int):
+        while not queues[port] and not ended[port]:
+            take(port, await socks[port].recvMany(BATCH_SIZE))
+        if queues[port]:
+            chg = queues[port].popleft()
+            tie = port if key is None else key(port, chg)
+            heapq.heappush(heap, (chg.time, tie, port, chg))
+    for port in range(len(socks)):
+        await pull(port)
+    batch = []
+    while heap:
+        _, _, port, chg = heapq.heappop(heap)
+        batch.append((port, chg))
+        if len(batch) >= BATCH_SIZE or (not queues[port] and not ended[port]):
+            yield batch
+            batch = []
+        await pull(port)
+    if batch:
+        yield batch
+
+#merges several Change streams into one stream ordered by time
+# changes at the same time are ordered by tieBreak(port, change), by default in port order
+# the merged stream ends when all inputs have ended
+class TimeMerge(Item):
+    def __init__(self, nPorts:int, name:str="TimeMerge", tieBreak:Callable[[int, Change], any]=None):
+        etype((nPorts, int), (name, str), (tieBreak, (Callable, None)))
+        super().__init__(name)
+        self.tieBreak = tieBreak
+        self.ports = [self.itemAddReceiver(f"in{idx}", Change) for idx in range(nPorts)]
+        self.itemAddSender("out", Change)
+        self.itemSubmit(self.run(), f"{self.name}~run")
+
+    async def run(self):
+        outSock = self.itemGet("out")
+        async for batch in ccMergeChanges(self.ports, self.tieBreak):
+            await outSock.sendMany([chg for _, chg in batch])
+        await outSock.send(PipeOffband.PipeEnd)
+
 class Input(Item):
     class InputRequest(Request):
         LOGNAME = "InputReq"
-        def __init__(self, value:any):
+        def __init__(self, value:any, many:bool=False):
             super().__init__()
             self.value = value
+            self.many = many #value is a list of values to be sent at once
 
     def __init__(self, typ:PipeType|type, name:str):
         etype((name,str), (typ,(PipeType,type)))
         super().__init__(name)
         self.itemAddSender("synth", typ)
         self.queue = Queue()
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
 
     async def process(self, req:InputRequest):
         etype((req, self.InputRequest))
@@ -141,18 +264,21 @@ class Input(Item):
             req = await self.queue.get()
             log.debug(f"Synth processing request {req}")
             value = req.value
-            await socket.send(value)
+            if req.many:
+                await socket.sendMany(value)
+            else:
+                await socket.send(value)
             log.debug(f"Synth processing finished - value:{value}")
             req.commit(0)
 
     def feed(self, value:any) -> choc.Task:
         req = self.InputRequest(value)
-        return choc.submit(self.process(req), f"{self.name}~process")
+        return self.itemSubmit(self.process(req), f"{self.name}~process")
 
     def feeds(self, values:Iterable) -> choc.Task:
         etype((values, Iterable))
-        for val in values:
-            self.feed(val)
+        req = self.InputRequest(list(values), many=True)
+        return self.itemSubmit(self.process(req), f"{self.name}~process")
 
     def close(self):
         self.feed(PipeOffband.PipeEnd)
@@ -163,15 +289,16 @@ class Output(Item):
         super().__init__(name)
         self.itemAddReceiver("blend", typ)
         self.tdcQueue = queue.Queue() #thread domain crossing queue
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
 
     async def run(self):
         log = logging.getLogger(self.name)
         socket = self.itemGet("blend")
         while True:
-            val = await socket.recv()
-            log.debug(f"Blend received {val}")
-            self.tdcQueue.put(val)
+            vals = await socket.recvMany(BATCH_SIZE)
+            log.debug(f"Blend received {len(vals)} values")
+            for val in vals:
+                self.tdcQueue.put(val)
 
     def consume(self, timeout:float=None) -> any:
         try:
@@ -209,15 +336,18 @@ class Clock(Item):
         self.stop = stop
         self.itemAddSender("out", Tme)
         self.log().debug(f"create clock start:{self.start} stop:{self.stop} period:{self.period}")
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
 
     async def run(self):
         outSock = self.itemGet("out")
         now = self.start
         while self.stop is None or now < self.stop:
-            self.log().debug(f"emit:{now}")
-            await outSock.send(now)
-            now += self.period
+            batch = []
+            while len(batch) < BATCH_SIZE and (self.stop is None or now < self.stop):
+                batch.append(now)
+                now += self.period
+            self.log().debug(f"emit:{batch[0]}..{batch[-1]}")
+            await outSock.sendMany(batch)
         await outSock.send(PipeOffband.PipeEnd)
 
 class Range(Item):
@@ -228,12 +358,13 @@ class Range(Item):
         self.stop = stop
         self.step = step
         self.itemAddSender("out", int)
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
 
     async def run(self):
         outSock = self.itemGet("out")
-        for i in range(self.start, self.stop, self.step):
-            await outSock.send(i)
+        values = range(self.start, self.stop, self.step)
+        for pos in range(0, len(values), BATCH_SIZE):
+            await outSock.sendMany(values[pos:pos+BATCH_SIZE])
         await outSock.send(PipeOffband.PipeEnd)
 
 class TimedSignal(Item):
@@ -243,7 +374,7 @@ class TimedSignal(Item):
         self.itemAddReceiver("clk", Tme)
         self.itemAddReceiver("in", typ)
         self.itemAddSender("out", Change)
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
 
     async def run(self):
         log = self.log()
@@ -287,7 +418,7 @@ class ClockedSignal(Converter):
 
     def convert(self, val:any) -> Change:
         chg = Change(val, self.cycle, sync=False)
-        self.cycle += Tme("1c")
+        self.cycle += CYCLE
         return chg
 
 # unpack Change to its value
@@ -302,48 +433,176 @@ class SignalInterface(Converter):
             log.warning(f"interface provided values out of order")
         return val.value
 
+FLUSH_SIZE = 1 << 16 #bytes a FileWriter collects before they are written
+FLUSH_DELAY = 0.5    #seconds collected data waits at most before it is written
+WRITE_QUEUE = 64     #flushed chunks that may wait for the writer thread before write() blocks
+RECORD_LENGTH = struct.Struct(">I")
+
+#file written by a separate thread, so that the choc loop does not wait for the disk
+# write() only collects the data - it is passed to the writer thread when flushSize bytes are collected,
+# flushDelay seconds after the first collected write, on flush() and on close()
+# in binary mode each value is written as a record: 4 byte length + val.toBytes()
+# otherwise as str(val) and a newline
+class FileWriter:
+    def __init__(self, fname:Path, binary:bool=False, flushSize:int=FLUSH_SIZE, flushDelay:float=FLUSH_DELAY):
+        etype((fname, (Path,str)), (binary, bool), (flushSize, int), (flushDelay, (int,float)))
+        self.fname = fname
+        self.binary = binary
+        self.flushSize = flushSize
+        self.flushDelay = flushDelay
+        self.chunks = []
+        self.size = 0
+        self.timer = None
+        self.closed = False
+        self.error = None #exception of the writer thread, raised by the next call
+        self.fh = open(fname, "wb")
+        self.queue = queue.Queue(WRITE_QUEUE)
+        self.thread = threading.Thread(target=self.run, name=f"FileWriter:{fname}", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while (data := self.queue.get()) is not None:
+                self.fh.write(data)
+        except Exception as exc:
+            self.error = exc
+            #keep taking the chunks, so that flush does not block on a full queue
+            while self.queue.get() is not None:
+                pass
+        try:
+            self.fh.close()
+        except Exception as exc:
+            self.error = self.error or exc
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, val:any):
+        if self.binary:
+            data = val.toBytes()
+            self.chunks.append(RECORD_LENGTH.pack(len(data)))
+        else:
+            data = f"{val}\n".encode()
+        self._collect(data)
+
+    def writeMany(self, vals:Iterable):
+        for val in vals:
+            self.write(val)
+
+    #writes raw data, regardless of the mode
+    def writeRaw(self, data:bytes|str):
+        self._collect(data.encode() if isinstance(data, str) else data)
+
+    def _collect(self, data:bytes):
+        self._raise()
+        if self.closed:
+            raise Exception(f"FileWriter {self.fname} is already closed")
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.flushSize:
+            self.flush()
+        elif self.timer is None:
+            try:
+                self.timer = asyncio.get_running_loop().call_later(self.flushDelay, self.flush)
+            except RuntimeError:
+                pass
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.chunks:
+            self.queue.put(b"".join(self.chunks))
+            self.chunks = []
+            self.size = 0
+
+    def _finish(self):
+        if not self.closed:
+            self.flush()
+            self.closed = True
+            self.queue.put(None)
+
+    #flushes and closes the file - waits for the writer thread
+    def close(self):
+        self._finish()
+        self.thread.join()
+        self._raise()
+
+    async def ccClose(self):
+        self._finish()
+        await asyncio.to_thread(self.thread.join)
+        self._raise()
+
+#reads the records of a file written by a binary FileWriter
+def readRecords(fname:Path) -> Iterator[bytes]:
+    with open(fname, "rb") as fh:
+        while len(head := fh.read(RECORD_LENGTH.size)) == RECORD_LENGTH.size:
+            (length,) = RECORD_LENGTH.unpack(head)
+            yield fh.read(length)
+
+#writes all values to a file (see FileWriter) - the file is closed on PipeEnd
 class ToFile(Item):
-    def __init__(self, fname:Path, typ:PipeType|type=None, name:str="Tee"):
+    def __init__(self, fname:Path, typ:PipeType|type=None, name:str="Tee", binary:bool=False):
         super().__init__(name)
-        etype((fname,Path), (typ,(PipeType,type,None)), (name,str))
+        etype((fname,Path), (typ,(PipeType,type,None)), (name,str), (binary,bool))
         self.itemAddReceiver("in", typ)
-        choc.submit(self.process(), f"{self.name}.process")
         self.fname = fname
+        self.binary = binary
+        self.task = self.itemSubmit(self.process(), f"{self.name}.process")
 
     async def process(self):
         inSock = self.itemGet("in")
-        with open(self.fname, "w"):
-            pass
+        writer = FileWriter(self.fname, self.binary)
         while True:
-            item = await inSock.recv()
-            with open(self.fname, "a") as fh:
-                print(item, file=fh)
-
+            vals = await inSock.recvMany(BATCH_SIZE)
+            for val in vals:
+                if val is PipeOffband.PipeEnd:
+                    await writer.ccClose()
+                    return
+                if not (self.binary and isinstance(val, PipeOffband)):
+                    writer.write(val)
+
+    #waits until the input ended and the file is written
+    def wait(self, timeout:float=None):
+        self.task(timeout)
+
+#forwards all values and writes them to a file (see FileWriter) - the file is closed on PipeEnd
 class Tee(Item):
-    def __init__(self, fname:Path, typ:PipeType|type=None, name:str="Tee"):
+    def __init__(self, fname:Path, typ:PipeType|type=None, name:str="Tee", binary:bool=False):
         super().__init__(name)
-        etype((fname,Path), (typ,(PipeType,type,None)), (name,str))
+        etype((fname,Path), (typ,(PipeType,type,None)), (name,str), (binary,bool))
         self.itemAddReceiver("in", typ)
         self.itemAddSender("out", typ)
         self.fname = fname
-        choc.submit(self.process(), f"{self.name}.process")
+        self.binary = binary
+        self.task = self.itemSubmit(self.process(), f"{self.name}.process")
 
     async def process(self):
         inSock = self.itemGet("in")
         outSock = self.itemGet("out")
-        with open(self.fname, "w"):
-            pass
+        writer = FileWriter(self.fname, self.binary)
         while True:
-            item = await inSock.recv()
-            with open(self.fname, "a") as fh:
-                print(item, file=fh)
-            await outSock.send(item)
+            vals = await inSock.recvMany(BATCH_SIZE)
+            for pos, val in enumerate(vals):
+                if val is PipeOffband.PipeEnd:
+                    #values behind the end are dropped
+                    await writer.ccClose()
+                    await outSock.sendMany(vals[:pos+1])
+                    return
+                if not (self.binary and isinstance(val, PipeOffband)):
+                    writer.write(val)
+            await outSock.sendMany(vals)
+
+    #waits until the input ended and the file is written
+    def wait(self, timeout:float=None):
+        self.task(timeout)
 
 class Printer(Item):
     def __init__(self, typ:PipeType|type=None, newlines:bool=True, name:str="Printer"):
         super().__init__(name)
         self.itemAddReceiver("in", typ)
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
         self.endline = "\n" if newlines else ''
 
     async def run(self):
@@ -358,7 +617,7 @@ class TeePrinter(Item):
         etype((typ,(PipeType,type,None)), (name,str))
         self.itemAddReceiver("in", typ)
         self.itemAddSender("out", typ)
-        choc.submit(self.process(), f"{self.name}.process")
+        self.itemSubmit(self.process(), f"{self.name}.process")
 
     async def process(self):
         inSock = self.itemGet("in")
@@ -382,21 +641,21 @@ class BitsReqToInterface(Item):
         self.itemAddSender("out", Change)
         self.itemAddReceiver("in", Change)
         self.queue = asyncio.Queue()
-        choc.submit(self.send(), f"{self.name}~send")
-        choc.submit(self.receive(), f"{self.name}~receive")
+        self.itemSubmit(self.send(), f"{self.name}~send")
+        self.itemSubmit(self.receive(), f"{self.name}~receive")
 
     async def send(self):
         reqSock = self.itemGet("req")
         outSock = self.itemGet("out")
         log = logging.getLogger(self.name)
-        cycle = Tme("1c")
+        cycle = CYCLE
         while True:
             req = await reqSock.recv()
             log.debug(f"found a BitsRequest {req}")
             await self.queue.put(req)
             chg = Change(req.data, cycle, sync=False)
             await outSock.send(chg)
-            cycle += Tme("1c")
+            cycle += CYCLE
 
     async def receive(self):
         inSock = self.itemGet("in")
@@ -408,74 +667,184 @@ class BitsReqToInterface(Item):
             log.debug(f"found a value {val} for BitsRequest {req}")
             req.commit(val)
 
+#follows a Change stream like a signal - read() returns the value at the current position (pos),
+# which is moved by seek and the edge functions
+# received changes are kept in a ChangeBuffer so that pos can also go back in time
+# retention limits how far behind pos the history is kept (None keeps everything)
 class Probe(Item):
-    value:tuple[Change, Change]
-    def __init__(self, name:str="Prober"):
-        super().__init__(name)
+    history:ChangeBuffer
+    def __init__(self, name:str="Prober", retention:Tme=None, shard:int=None):
+        etype((name, str), (retention, (Tme,None)))
+        super().__init__(name, shard)
         self.itemAddReceiver("in", Change)
         self.pos = Tme.zero()
-        self.value = (None, None)
+        self.retention = retention
+        self.horizon = None #earliest time that is still in the history
+        self.history = ChangeBuffer()
+        self.ended = False
 
     def seek(self, pos:Tme, relative:bool=False):
-        etype((pos,Tme))
+        etype((pos,Tme), (relative,bool))
         if relative:
             pos += self.pos
-        assert pos >= self.pos, f"Prober cannot seek backwards to:{pos} from {self.pos}"
+        assert self.horizon is None or pos >= self.horizon, f"Prober cannot seek back to:{pos} - history starts at {self.horizon}"
         self.pos = pos
 
-    #makes sure that self.pos lies between the two current values
-    # edge makes sure that there are really two values
-    async def _align(self, edge:bool=False):
-        inSock = self.itemGet("in")
-        if self.value[0] is None:
-            self.value = (await inSock.recv(), None)
-        if self.pos == self.value[0].time and edge is False:
+    #drops the history that is older than the retention window
+    def _trim(self):
+        if self.retention is None or len(self.history) == 0:
             return
-        elif self.value[1] is None:
-            self.value = (self.value[0], await inSock.recv())
-        while self.pos >= self.value[1].time:
-            chg = await inSock.recv()
-            self.value = (self.value[1], chg)
-
-    async def ccRead(self) -> Bits:
-        await self._align()
-        if self.pos == self.value[1].time:
-            return self.value[1].value
-        else:
-            return self.value[0].value
-    
+        horizon = self.pos - self.retention
+        if self.horizon is not None and horizon <= self.horizon:
+            return
+        self.horizon = horizon
+        self.history.trim(horizon)
+
+    #receives the next batch of changes into the history - False if the stream has ended
+    async def _receive(self) -> bool:
+        if self.ended:
+            return False
+        for val in await self.itemGet("in").recvMany(BATCH_SIZE):
+            if isinstance(val, PipeOffband):
+                if val == PipeOffband.PipeEnd:
+                    self.ended = True
+                continue
+            self.history.append(val)
+        return True
+
+    #receives changes until the value at time is known
+    async def _cover(self, time:Tme):
+        while len(self.history) == 0 or self.history.time(-1) < time:
+            if not await self._receive():
+                break
+        if len(self.history) == 0:
+            raise Exception(f"{self.name} input ended without any change")
+
+    #value at pos, or at any other time that is still in the history
+    async def ccRead(self, at:Tme=None) -> Bits:
+        etype((at, (Tme,None)))
+        self._trim()
+        if at is None:
+            at = self.pos
+        assert self.horizon is None or at >= self.horizon, f"Prober cannot read at:{at} - history starts at {self.horizon}"
+        await self._cover(at)
+        return self.history.value(max(self.history.indexAt(at), 0))
+
+    #moves pos to the next edge after pos and returns its change
+    # returns None if there is no edge before maxTime (pos is then moved to maxTime) or the stream ended
     async def ccNextEdge(self, typ:Edge=Edge.any, maxTime:Tme=None) -> Change:
-        log = logging.getLogger(self.name)
         etype((typ, Edge), (maxTime, (Tme,None)))
-        #log.debug(f"initial align to:{self.pos}")
-        await self._align(edge=True)
+        self._trim()
+        start = self.history.indexAt(self.pos) + 1
         while True:
-            if maxTime is not None and self.value[1].time >= maxTime:
-                self.pos = maxTime
+            idx = self.history.nextEdge(typ, start)
+            if idx >= 0:
+                chg = self.history[idx]
+                if maxTime is not None and chg.time >= maxTime:
+                    break
+                self.pos = chg.time
+                return chg
+            if maxTime is not None and len(self.history) and self.history.time(-1) >= maxTime:
+                break
+            #only the new changes have to be scanned
+            start = max(len(self.history), start)
+            if not await self._receive():
                 return None
-            self.pos = self.value[1].time
-            #log.debug(f"values:{self.value[0]}:{self.value[1]}")
-            if self.value[1] is not None and self.value[0].value != self.value[1].value:
-                #log.debug(f"this is some edge v0:{self.value[0].value[0]} v1:{self.value[1].value[0]}")
-                #this is a change
-                if typ == Edge.pos:
-                    if self.value[0].value[0] == L9._0 and self.value[1].value[0] == L9._1:
-                       #log.debug("found posedge")
-                        return self.value[1]
-                elif typ == Edge.neg:
-                    if self.value[0].value[0] == L9._1 and self.value[1].value[0] == L9._0:
-                        #log.debug("found negedge")
-                        return self.value[1]
-                else: #any
-                    #log.debug("found any edge")
-                    return self.value[1]
-            await self._align(edge=True)
-
-    def read(self) -> Bits:
-        return choc.call(self.ccRead(), f"{self.name}~read")
+        self.pos = maxTime
+        return None
+
+    #moves pos back to the last edge before pos and returns its change
+    # returns None if there is no edge after minTime (pos is then moved to minTime) in the history
+    async def ccPrevEdge(self, typ:Edge=Edge.any, minTime:Tme=None) -> Change:
+        etype((typ, Edge), (minTime, (Tme,None)))
+        self._trim()
+        idx = self.history.prevEdge(typ, self.history.countBefore(self.pos))
+        if idx >= 0:
+            chg = self.history[idx]
+            if minTime is None or chg.time > minTime:
+                self.pos = chg.time
+                return chg
+        if minTime is not None:
+            self.seek(minTime)
+        return None
+
+    def read(self, at:Tme=None) -> Bits:
+        return self.itemCall(self.ccRead(at), f"{self.name}~read")
     
     def nextEdge(self, typ:Edge=Edge.any, maxTime:Tme=None) -> Change:
-        return choc.call(self.ccNextEdge(typ, maxTime), f"{self.name}~nextEdge")
+        return self.itemCall(self.ccNextEdge(typ, maxTime), f"{self.name}~nextEdge")
+
+    def prevEdge(self, typ:Edge=Edge.any, minTime:Tme=None) -> Change:
+        return self.itemCall(self.ccPrevEdge(typ, minTime), f"{self.name}~prevEdge")
+
+#several Probes that are moved together, so all signals are looked at the same point in time
+# inputs are connected in the order of names (x >> group takes the next free one) or by name (x >> group["valid"])
+class ProbeGroup(Item):
+    probes:dict[str,Probe]
+    def __init__(self, names:list[str], name:str="ProbeGroup", retention:Tme=None):
+        etype((names, list, str), (name, str), (retention, (Tme,None)))
+        super().__init__(name)
+        self.probes = {sig: Probe(f"{self.name}.{sig}", retention, self.shard) for sig in names}
+        self.pos = Tme.zero()
+
+    def __getitem__(self, sig:str) -> Probe:
+        return self.probes[sig]
+
+    def iterSockets(self) -> Iterator[Socket]:
+        for prb in self.probes.values():
+            yield from prb.iterSockets()
+
+    def seek(self, pos:Tme, relative:bool=False):
+        etype((pos,Tme), (relative,bool))
+        if relative:
+            pos += self.pos
+        for prb in self.probes.values():
+            prb.seek(pos)
+        self.pos = pos
+
+    #values of all signals at pos (or at another time still in the history)
+    async def ccRead(self, at:Tme=None) -> dict[str,any]:
+        return {sig: await prb.ccRead(at) for sig, prb in self.probes.items()}
+
+    #moves all probes to the next (or previous) edge of one signal, or the closest edge of any if signal is None
+    # on edges at the same time the signal listed first wins
+    # returns the name of the signal with the edge and the values of all signals there
+    async def _ccEdge(self, typ:Edge, signal:str, limit:Tme, backwards:bool) -> tuple[str, dict[str,any]]:
+        etype((typ, Edge), (signal, (str,None)), (limit, (Tme,None)))
+        edge = None
+        for sig in (self.probes if signal is None else [signal]):
+            prb = self.probes[sig]
+            prb.seek(self.pos)
+            if backwards:
+                chg = await prb.ccPrevEdge(typ, limit)
+            else:
+                chg = await prb.ccNextEdge(typ, limit)
+            if chg is not None:
+                edge = sig
+                limit = chg.time
+        if limit is None:
+            return None
+        self.seek(limit)
+        if edge is None:
+            return None
+        return (edge, await self.ccRead())
+
+    #returns None if there is no edge before maxTime (all probes are then moved to maxTime) or the inputs ended
+    async def ccNextEdge(self, typ:Edge=Edge.any, signal:str=None, maxTime:Tme=None) -> tuple[str, dict[str,any]]:
+        return await self._ccEdge(typ, signal, maxTime, False)
+
+    #returns None if there is no edge after minTime (all probes are then moved to minTime) in the history
+    async def ccPrevEdge(self, typ:Edge=Edge.any, signal:str=None, minTime:Tme=None) -> tuple[str, dict[str,any]]:
+        return await self._ccEdge(typ, signal, minTime, True)
+
+    def read(self, at:Tme=None) -> dict[str,any]:
+        return self.itemCall(self.ccRead(at), f"{self.name}~read")
+
+    def nextEdge(self, typ:Edge=Edge.any, signal:str=None, maxTime:Tme=None) -> tuple[str, dict[str,any]]:
+        return self.itemCall(self.ccNextEdge(typ, signal, maxTime), f"{self.name}~nextEdge")
+
+    def prevEdge(self, typ:Edge=Edge.any, signal:str=None, minTime:Tme=None) -> tuple[str, dict[str,any]]:
+        return self.itemCall(self.ccPrevEdge(typ, signal, minTime), f"{self.name}~prevEdge")
 
 
 
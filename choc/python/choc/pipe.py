@@ -13,12 +13,19 @@ from __future__ import annotations
 from abc import ABC, abstractmethod
 from asyncio import Condition, Event, Lock
 import asyncio
+from collections import deque
+import contextlib
 from enum import Enum
 import logging
-from typing import Callable, Iterator
+import threading
+from typing import Callable, Coroutine, Iterable, Iterator
 import choc
 from bilib.fn import etype, uniqueName
 
+BATCH_SIZE = 1024 #default number of values moved with one sendMany/recvMany
+TRUST_SAMPLE = 1024 #trusted sockets check every n-th value (only in debug mode)
+CROSS_SHARD_DEPTH = 64 #default depth of pipes between items on different shards
+
 class PipeType:
     typ:type        #type of the values transferred
     name:str        #name of the type
@@ -96,6 +103,13 @@ class Plugable(ABC):
         connect(self, peer)
         return peer
 
+    # like >> but allows to select the pipe, e.g. a buffer with depth
+    # to trust the connection (skip per value type checks) and to prevent fusing
+    def connect(self, peer:Plugable, depth:int=None, trusted:bool=False, fuse:bool=True) -> Plugable:
+        etype((peer, Plugable), (depth, (int,None)), (trusted, bool), (fuse, bool))
+        connect(self, peer, depth, trusted, fuse)
+        return peer
+
     # self << peer
     def __lshift__(self, peer:Plugable) -> Plugable:
         etype((peer, (Plugable)))
@@ -138,18 +152,41 @@ class Socket(Plugable):
         self.parent = None #prevent parent from being garbacge collected
         self.peer = None #prevent peer from being garbage collected
         self.connected = Event()
+        self.checked = set() #value classes that already passed the type check
+        self.trusted = False #skip type checks, only sample them in debug mode
+        self.nSample = 0
 
     def __repr__(self) -> str:
         dir = "Send" if self.direction == Direction.Sender else "Recv"
         return f"{dir}Socket({self.name},{self.typ})"
 
+    #the shard of the owning Item - sockets are used from its loop only
+    @property
+    def shard(self) -> int:
+        return getattr(self.parent, "shard", 0)
+
+    #checks a value against the socket type
+    # a class is only checked once, unless its objects carry a type name or extra
+    def checkType(self, val:any):
+        cls = type(val)
+        if cls in self.checked or cls is PipeOffband:
+            return
+        if self.trusted:
+            if not __debug__:
+                return
+            self.nSample += 1
+            if self.nSample % TRUST_SAMPLE:
+                return
+        valTyp = PipeType.fromObject(val)
+        assert self.typ.match(valTyp), f"socket detected type change in:{self} val:{val} valTyp:{valTyp}"
+        self.typ.update(valTyp)
+        if not self.trusted and not hasattr(cls, "getTypeName") and not hasattr(cls, "getTypeExtra"):
+            self.checked.add(cls)
+
     async def send(self, val:any):
         assert self.direction == Direction.Sender, "cannot send on receiver"
         log = logging.getLogger(self.name)
-        valTyp = PipeType.fromObject(val)
-        if valTyp.typ != PipeOffband:
-            assert self.typ.match(valTyp), f"socket detected type change in:{self} val:{val} valTyp:{valTyp}"
-            self.typ.update(valTyp)
+        self.checkType(val)
         #log.debug(f"Socket sending val:{val}")
         #if not self.connected.is_set():
         #    log.debug("Socket waiting for connection (send)")
@@ -163,23 +200,86 @@ class Socket(Plugable):
         #    log.debug("Socket waiting for connection (send)")
         await self.connected.wait()
         val = await self.pipe.pull()
-        valTyp = PipeType.fromObject(val)
-        if valTyp.typ != PipeOffband:
-            assert valTyp.typ == PipeOffband or self.typ.match(valTyp), f"socket detected type change in:{self} val:{val} valTyp:{valTyp}"
-            self.typ.update(valTyp)
+        self.checkType(val)
         #log.debug(f"Socket recving val:{val}")
         return val
 
-    def connectForward(self, peer:Socket):
-        etype((peer, Socket))
+    #send several values as one transfer through the pipe
+    async def sendMany(self, vals:Iterable):
+        assert self.direction == Direction.Sender, "cannot send on receiver"
+        vals = list(vals)
+        for val in vals:
+            self.checkType(val)
+        await self.connected.wait()
+        await self.pipe.pushMany(vals)
+
+    #receive up to max values as one transfer
+    # waits until at least one value is available, or timeout seconds passed (returns an empty list)
+    # the timeout covers waiting for the connection and for the values together
+    # timeout=0 only returns what is available right now
+    async def recvMany(self, max:int=BATCH_SIZE, timeout:float=None) -> list:
+        assert self.direction == Direction.Receiver, "cannot recv on sender"
+        etype((max,int), (timeout,(int,float,None)))
+        if timeout is None:
+            await self.connected.wait()
+            vals = await self.pipe.pullMany(max)
+        elif timeout <= 0:
+            if not self.connected.is_set():
+                return []
+            vals = await self.pipe.pullMany(max, wait=False)
+        else:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            try:
+                await asyncio.wait_for(self.connected.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+            #the pull is cancelled at the deadline - values it took before that are still returned
+            pull = asyncio.ensure_future(self.pipe.pullMany(max))
+            try:
+                await asyncio.wait((pull,), timeout=deadline - loop.time())
+            finally:
+                if not pull.done():
+                    pull.cancel()
+                    await asyncio.wait((pull,))
+            if pull.cancelled():
+                return []
+            vals = pull.result()
+        for val in vals:
+            self.checkType(val)
+        return vals
+
+    #depth selects the pipe: None or 0 -> Gate, otherwise a Buffer of that depth
+    # if not given the depth is taken from the parent Items (pipeDepth)
+    # sockets on different shards are always connected by a thread safe ThreadPipe
+    # if fuse is set and neither a depth is given nor one of the Items has a pipeDepth,
+    # the receiving Item may process the values inline (see Item.fusePipe)
+    # the socket types are negotiated here, trusted connections skip the per value checks
+    def connectForward(self, peer:Socket, depth:int=None, trusted:bool=False, fuse:bool=False):
+        etype((peer, Socket), (depth, (int,None)), (trusted, bool), (fuse, bool))
         assert self.pipe is None, "socket already connected"
-        pipe = Gate(f"{self.name}+{peer.name}")
+        assert self.typ.match(peer.typ), f"cannot connect {self} to {peer} - types do not match"
+        self.typ.update(peer.typ)
+        peer.typ.update(self.typ)
+        self.trusted = trusted
+        peer.trusted = trusted
+        crossShard = self.shard != peer.shard
+        pipe = None
+        if depth is None:
+            depth = getattr(self.parent, "pipeDepth", None) or getattr(peer.parent, "pipeDepth", None)
+        if fuse and depth is None and peer.parent is not None and not crossShard:
+            pipe = peer.parent.fusePipe(peer, self)
+        if pipe is None:
+            pipe = mkPipe(f"{self.name}+{peer.name}", depth, crossShard)
         self.pipe = pipe
         peer.pipe = pipe
         self.peer = peer #prevent garbage collection
         peer.peer = self #prevent garbage collection
-        choc.do(self.connected.set, name="Socket.connectForward")
-        choc.do(peer.connected.set, name="Socket.connectForward")
+        choc.do(self.connected.set, name="Socket.connectForward", shard=self.shard)
+        choc.do(peer.connected.set, name="Socket.connectForward", shard=peer.shard)
+        for sock in (self, peer):
+            if sock.parent is not None:
+                startItem(sock.parent)
 
     def iterSockets(self) -> Iterator[Socket]:
         yield self
@@ -187,19 +287,51 @@ class Socket(Plugable):
 class Item(Plugable):
     name:str
     sockets:dict[str,Socket]
-    def __init__(self, name:str=None):
-        etype((name, (str,None)))
+    shard:int
+    pipeDepth:int = None #default depth of pipes connected to this Item (None -> Gate)
+    #shard selects the daemon loop the Item runs on (default: the current one, see choc.pinShard)
+    def __init__(self, name:str=None, shard:int=None):
+        etype((name, (str,None)), (shard, (int,None)))
         self.name = uniqueName("Item" if name is None else name)
         logging.getLogger("Item").debug(f"creating Item:{self.name}")
         self.sockets = {}
+        self.shard = choc.currentShard() if shard is None else shard
+        self.pending = [] #tasks waiting for the first connection, None once started
 
     def __del__(self):
         log = logging.getLogger(self.name)
         log.debug("deleting")
+        for task in getattr(self, "pending", None) or []:
+            task.coro.close()
 
     def log(self) -> logging.Logger:
         return logging.getLogger(self.name)
 
+    #submits a coroutine to the shard of this Item
+    # until one of its sockets is connected the task is only created, it starts with the first connection
+    def itemSubmit(self, coro:Coroutine, name:str) -> choc.Task:
+        if self.pending is not None and self.sockets:
+            task = choc.Task(coro, name, start=False, shard=self.shard)
+            self.pending.append(task)
+            return task
+        return choc.submit(coro, name, shard=self.shard)
+
+    #the tasks that wait for the start of this Item - from now on tasks start right away
+    def itemTakePending(self) -> list[choc.Task]:
+        tasks = self.pending or []
+        self.pending = None
+        return tasks
+
+    #starts the waiting tasks of this Item
+    def itemStart(self):
+        tasks = self.itemTakePending()
+        if tasks:
+            choc.startTasks(tasks, self.shard)
+
+    #runs a coroutine on the shard of this Item and waits for the result
+    def itemCall(self, coro:Coroutine, name:str, timeout:float=None) -> any:
+        return choc.call(coro, name, timeout, shard=self.shard)
+
     def itemAdd(self, name:str, dir:Direction, typ:PipeType|type=None) -> Socket:
         etype((name,str), (dir,Direction), (typ,(PipeType,type,None)))
         sock = Socket(f"{self.name}{'+' if dir == Direction.Sender else '-'}{name}", dir, typ)
@@ -224,6 +356,11 @@ class Item(Plugable):
     def iterSockets(self) -> Iterator[Socket]:
         yield from self.sockets.values()
 
+    #returns a pipe that processes the values for the receiving socket inline in the pushing coroutine
+    # or None if the Item cannot be fused to the sending peer
+    def fusePipe(self, sock:Socket, peer:Socket) -> Pipe:
+        return None
+
 class Parallel(Plugable):
     items:Plugable
     def __init__(self):
@@ -245,9 +382,40 @@ class Parallel(Plugable):
         else:
             return None
 
+#items connected inside a deferStart block
+startHold = threading.local()
+
+#starts the tasks of an Item after a connection - or later if a deferStart block is open
+def startItem(item:Item):
+    held = getattr(startHold, "items", None)
+    if held is None:
+        item.itemStart()
+    elif item.pending:
+        held.append(item)
+
+#with deferStart(): - Items connected in the block start their tasks together at its end, one loop hop per shard
+@contextlib.contextmanager
+def deferStart():
+    outer = getattr(startHold, "items", None)
+    if outer is None:
+        startHold.items = []
+    try:
+        yield
+    finally:
+        if outer is None:
+            items = startHold.items
+            startHold.items = None
+            byShard = {}
+            for item in items:
+                byShard.setdefault(item.shard, []).extend(item.itemTakePending())
+            for shard, tasks in byShard.items():
+                if tasks:
+                    choc.startTasks(tasks, shard)
+
 #connect a -> b
-def connect(a:Plugable, b:Plugable):
-    etype((a,Plugable), (b,Plugable))
+# depth, trusted and fuse select the pipe type and type checking used for the connections (see Socket.connectForward)
+def connect(a:Plugable, b:Plugable, depth:int=None, trusted:bool=False, fuse:bool=True):
+    etype((a,Plugable), (b,Plugable), (depth,(int,None)), (trusted,bool), (fuse,bool))
     log = logging.getLogger("PipeConnect")
     nConnected = 0
     for aSock in a.iterSockets():
@@ -257,14 +425,14 @@ def connect(a:Plugable, b:Plugable):
             if bSock.direction == Direction.Sender or bSock.connected.is_set():
                 continue
             if aSock.typ.match(bSock.typ):
-                aSock.connectForward(bSock)
+                aSock.connectForward(bSock, depth, trusted, fuse)
                 nConnected += 1
                 log.debug(f"Connected {aSock} -> {bSock}")
                 break
         else:
             socket = b.forgeRecvSocket(aSock.typ)
             if socket:
-                aSock.connectForward(socket)
+                aSock.connectForward(socket, depth, trusted, fuse)
                 nConnected += 1
                 log.debug(f"Connected {aSock} -> new {socket}")
     if nConnected == 0:
@@ -286,6 +454,7 @@ class Request:
         self.data = data
         self.result = None
         self.done = Event()
+        self.loop = None #loop of the waiter, commit may come from another shard
         self.callBack = None
 
     def setCallBack(self, cb:Callable, *args):
@@ -294,7 +463,15 @@ class Request:
 
     def commit(self, result):
         self.result = result
-        self.done.set()
+        loop = self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is None or loop is running:
+            self.done.set()
+        else:
+            loop.call_soon_threadsafe(self.done.set)
         if self.callBack is not None:
             cb, args = self.callBack
             choc.submit(cb(self, *args), f"{self.uid}~callback")
@@ -303,6 +480,7 @@ class Request:
         return f"Request({self.uid})"#, {self.data}, {self.result})"
 
     async def wait(self, timeout:float=None):
+        self.loop = asyncio.get_running_loop()
         await asyncio.wait_for(self.done.wait(), timeout) 
 
 # pushing and pulling is coroutine safe
@@ -314,6 +492,18 @@ class Pipe(ABC):
     async def pull(self) -> any:
         pass
 
+    #push a list of values, pipes should override this to transfer them at once
+    async def pushMany(self, vals:list):
+        for val in vals:
+            await self.push(val)
+
+    #pull up to max values, at least one (if wait is set)
+    # pipes should override this to transfer them at once
+    async def pullMany(self, max:int, wait:bool=True) -> list:
+        if not wait:
+            return []
+        return [await self.pull()]
+
 
 #transfer data from one thread to another only when both are ready
 class Gate(Pipe):
@@ -327,10 +517,17 @@ class Gate(Pipe):
         self.pushLock = Lock() #make sure only one coroutine pushes
         self.pullLock = Lock() #make sure only one coroutine pulls
         self.condition = Condition()
-        self.store = None
+        self.store = None #list of values currently in the gate
+        self.pos = 0      #next value of store to be pulled
         self.name = uniqueName(name)
 
     async def push(self, value:any):
+        await self.pushMany([value])
+
+    #the pushed values are transferred as one - push returns when all of them are pulled
+    async def pushMany(self, values:list):
+        if not values:
+            return
         #log = logging.getLogger(self.name)
         #log.debug(f"push: pushing gate")
         async with self.pushLock, self.condition:
@@ -339,7 +536,8 @@ class Gate(Pipe):
                 await self.condition.wait()
                 #log.debug(f"push: woke up. gate={self.state} (idle?)")
             #log.debug("push: gate=idle->pushing")
-            self.store = value
+            self.store = values
+            self.pos = 0
             #notify that gate is loaded
             #we cannot leave before the gate has been pulled
             self.state = Gate.State.pushing
@@ -354,29 +552,198 @@ class Gate(Pipe):
         #log.debug(f"push: push finished")
 
     async def pull(self) -> any:
+        return (await self.pullMany(1))[0]
+
+    async def pullMany(self, max:int, wait:bool=True) -> list:
         tmp = None
         #log.debug(f"pull: pulled gate")
         async with self.pullLock, self.condition:
             #wait until gate is loaded
             while self.state != Gate.State.pushing:
+                if not wait:
+                    return []
                 await self.condition.wait()
                 #log.debug(f"pull: woke up. gate={self.state} (pushing?)")
-            tmp = self.store
-            #notify that value has been retrieved
-            #log.debug(f"pull: gate=pushing->pulled")
-            self.state = Gate.State.pulled
-            self.condition.notify()
+            tmp = self.store[self.pos:self.pos+max]
+            self.pos += len(tmp)
+            #notify that all values have been retrieved
+            if self.pos >= len(self.store):
+                #log.debug(f"pull: gate=pushing->pulled")
+                self.store = None
+                self.state = Gate.State.pulled
+                self.condition.notify()
         #log.debug("pull: pull finished")
         return tmp
 
+#transfer data through a bounded fifo
+# the pusher only blocks if the buffer is full, the puller if it is empty
+class Buffer(Pipe):
+    def __init__(self, name:str, depth:int):
+        etype((name,str), (depth,int))
+        assert depth > 0, "buffer depth must be positive"
+        self.depth = depth
+        self.store = deque()
+        self.lock = Lock()
+        self.notFull = Condition(self.lock)
+        self.notEmpty = Condition(self.lock)
+        self.name = uniqueName(name)
+
+    async def push(self, value:any):
+        async with self.notFull:
+            while len(self.store) >= self.depth:
+                await self.notFull.wait()
+            self.store.append(value)
+            self.notEmpty.notify()
+
+    async def pull(self) -> any:
+        async with self.notEmpty:
+            while not self.store:
+                await self.notEmpty.wait()
+            value = self.store.popleft()
+            self.notFull.notify()
+        return value
+
+    async def pushMany(self, values:list):
+        pos = 0
+        async with self.notFull:
+            while pos < len(values):
+                while len(self.store) >= self.depth:
+                    await self.notFull.wait()
+                n = min(self.depth - len(self.store), len(values) - pos)
+                self.store.extend(values[pos:pos+n])
+                pos += n
+                self.notEmpty.notify()
+
+    async def pullMany(self, max:int, wait:bool=True) -> list:
+        async with self.notEmpty:
+            while not self.store:
+                if not wait:
+                    return []
+                await self.notEmpty.wait()
+            n = min(max, len(self.store))
+            values = [self.store.popleft() for _ in range(n)]
+            self.notFull.notify()
+        return values
+
+#processes the values inline in the pushing coroutine and sends them on the out socket
+# used to fuse chains of converters - nobody pulls from a fuse
+# like Converter.run the first offband is forwarded and ends the conversion, later values are dropped
+class Fuse(Pipe):
+    def __init__(self, name:str, sock:Socket, fn:Callable, out:Socket):
+        etype((name,str), (sock,Socket), (fn,Callable), (out,Socket))
+        self.sock = sock #the fused receiving socket
+        self.fn = fn
+        self.out = out
+        self.ended = False
+        self.name = uniqueName(name)
+
+    async def push(self, value:any):
+        if self.ended:
+            return
+        if isinstance(value, PipeOffband):
+            self.ended = True
+            await self.out.send(value)
+            return
+        self.sock.checkType(value)
+        await self.out.send(self.fn(value))
+
+    async def pushMany(self, values:list):
+        if self.ended:
+            return
+        outs = []
+        for value in values:
+            if isinstance(value, PipeOffband):
+                self.ended = True
+                outs.append(value)
+                break
+            self.sock.checkType(value)
+            outs.append(self.fn(value))
+        await self.out.sendMany(outs)
+
+    async def pull(self) -> any:
+        raise Exception(f"cannot pull from fused pipe:{self.name}")
+
+#transfer data through a bounded fifo between coroutines on different shards
+# the asyncio primitives are bound to one loop, so waiters park on futures of their own loop
+# and are woken thread safe by the other side
+class ThreadPipe(Pipe):
+    def __init__(self, name:str, depth:int):
+        etype((name,str), (depth,int))
+        assert depth > 0, "pipe depth must be positive"
+        self.depth = depth
+        self.store = deque()
+        self.lock = threading.Lock()
+        self.pushWaiters = [] #(loop, future) of blocked pushers
+        self.pullWaiters = [] #(loop, future) of blocked pullers
+        self.name = uniqueName(name)
+
+    #has to be called with the lock held
+    def _park(self, waiters:list) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        waiters.append((loop, fut))
+        return fut
+
+    #has to be called with the lock held
+    def _wake(self, waiters:list):
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(_resolve, fut)
+        waiters.clear()
+
+    async def push(self, value:any):
+        await self.pushMany([value])
+
+    async def pull(self) -> any:
+        return (await self.pullMany(1))[0]
+
+    async def pushMany(self, values:list):
+        pos = 0
+        while pos < len(values):
+            with self.lock:
+                n = min(self.depth - len(self.store), len(values) - pos)
+                if n > 0:
+                    self.store.extend(values[pos:pos+n])
+                    pos += n
+                    self._wake(self.pullWaiters)
+                    continue
+                fut = self._park(self.pushWaiters)
+            await fut
+
+    async def pullMany(self, max:int, wait:bool=True) -> list:
+        while True:
+            with self.lock:
+                if self.store:
+                    n = min(max, len(self.store))
+                    values = [self.store.popleft() for _ in range(n)]
+                    self._wake(self.pushWaiters)
+                    return values
+                if not wait:
+                    return []
+                fut = self._park(self.pullWaiters)
+            await fut
+
+def _resolve(fut:asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+#create the pipe for a connection
+# crossShard pipes connect items on different loops and are always buffered
+def mkPipe(name:str, depth:int=None, crossShard:bool=False) -> Pipe:
+    etype((name,str), (depth,(int,None)), (crossShard,bool))
+    if crossShard:
+        return ThreadPipe(name, depth or CROSS_SHARD_DEPTH)
+    if not depth:
+        return Gate(name)
+    return Buffer(name, depth)
+
 class OutPort(Item):
     def __init__(self, port:Socket, name:str="OutPort"):
         etype((name,str), (port,Socket))
         assert port.direction == Direction.Sender
-        super().__init__(name)
+        super().__init__(name, port.shard)
         self.port = port
         self.itemAddReceiver("in", port.typ)
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
 
     async def run(self):
         inSocket = self.itemGet("in")
@@ -388,10 +755,10 @@ class InPort(Item):
     def __init__(self, port:Socket, name:str="InPort"):
         etype((name,str), (port,Socket))
         assert port.direction == Direction.Receiver
-        super().__init__(name)
+        super().__init__(name, port.shard)
         self.port = port
         self.itemAddSender("out", port.typ)
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
 
     async def run(self):
         outSocket = self.itemGet("out")
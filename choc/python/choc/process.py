@@ -0,0 +1,251 @@
+####    ############    Copyright (C) 2025 Mattis Hasler, Barkhausen Institut
+####    ############
+####                    This source describes Open Hardware and is licensed under the
+####                    CERN-OHL-W v2 (https://cern.ch/cern-ohl)
+############    ####
+############    ####
+####    ####    ####
+####    ####    ####
+############            Authors:
+############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
+
+# run parts of a choc graph in worker processes
+
+from __future__ import annotations
+import asyncio
+import logging
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+import pickle
+import struct
+from typing import Callable
+import weakref
+import choc
+from bilib.fn import etype
+from choc.pipe import BATCH_SIZE, Item, PipeType, Socket, connect
+
+RING_SIZE = 4 << 20 #default bytes of one shared memory ring
+POLL_MIN = 0.0001   #first back off when polling an empty/full ring
+POLL_MAX = 0.01     #longest back off when polling
+
+#single producer single consumer ring of length prefixed records in shared memory
+# the header holds the write (head) and read (tail) byte counters, each side only writes its own
+# the counters are accessed as native words so that the other process never sees a half written one
+class ShmRing:
+    HEADER_SIZE = 16
+    LENGTH = struct.Struct("<I")
+
+    #without a name a new ring is created, otherwise an existing one is attached
+    def __init__(self, size:int=RING_SIZE, name:str=None):
+        etype((size, int), (name, (str,None)))
+        self.size = size
+        self.owner = name is None
+        if self.owner:
+            self.shm = SharedMemory(create=True, size=self.HEADER_SIZE + size)
+        else:
+            self.shm = SharedMemory(name=name)
+        self.counters = self.shm.buf[:self.HEADER_SIZE].cast("Q") #head, tail
+        if self.owner:
+            self.counters[0] = 0
+            self.counters[1] = 0
+        self.data = self.shm.buf[self.HEADER_SIZE:self.HEADER_SIZE + size]
+
+    #pickling attaches the ring in the other process
+    def __reduce__(self):
+        return (ShmRing, (self.size, self.shm.name))
+
+    def _write(self, pos:int, data:bytes):
+        off = pos % self.size
+        first = min(len(data), self.size - off)
+        self.data[off:off+first] = data[:first]
+        if first < len(data):
+            self.data[:len(data)-first] = data[first:]
+
+    def _read(self, pos:int, length:int) -> bytes:
+        off = pos % self.size
+        first = min(length, self.size - off)
+        if first == length:
+            return bytes(self.data[off:off+length])
+        return bytes(self.data[off:]) + bytes(self.data[:length-first])
+
+    #the largest record that fits into the ring
+    def maxRecord(self) -> int:
+        return self.size - self.LENGTH.size
+
+    #returns False if the ring is too full right now
+    def put(self, data:bytes) -> bool:
+        length = self.LENGTH.size + len(data)
+        if length > self.size:
+            raise Exception(f"record of {len(data)} bytes does not fit into ring of {self.size} bytes")
+        head = self.counters[0]
+        if self.size - (head - self.counters[1]) < length:
+            return False
+        self._write(head, self.LENGTH.pack(len(data)))
+        self._write(head + self.LENGTH.size, data)
+        #publish the record only after it is written
+        self.counters[0] = head + length
+        return True
+
+    #returns None if the ring is empty
+    def get(self) -> bytes:
+        tail = self.counters[1]
+        if self.counters[0] == tail:
+            return None
+        (length,) = self.LENGTH.unpack(self._read(tail, self.LENGTH.size))
+        data = self._read(tail + self.LENGTH.size, length)
+        self.counters[1] = tail + self.LENGTH.size + length
+        return data
+
+    #check is called while waiting and can raise to give up
+    async def ccPut(self, data:bytes, check:Callable=None):
+        delay = POLL_MIN
+        while not self.put(data):
+            if check is not None:
+                check()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, POLL_MAX)
+
+    async def ccGet(self, check:Callable=None) -> bytes:
+        delay = POLL_MIN
+        while (data := self.get()) is None:
+            if check is not None:
+                check()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, POLL_MAX)
+        return data
+
+    def close(self):
+        self.counters.release()
+        self.data.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+#pickles a batch of values into the ring, batches too big for the ring are split
+async def ccPutBatch(ring:ShmRing, vals:list, check:Callable=None):
+    data = pickle.dumps(vals, pickle.HIGHEST_PROTOCOL)
+    if len(data) > ring.maxRecord() and len(vals) > 1:
+        half = len(vals) // 2
+        await ccPutBatch(ring, vals[:half], check)
+        await ccPutBatch(ring, vals[half:], check)
+        return
+    await ring.ccPut(data, check)
+
+#forwards all values received on a socket into a ring
+async def ccToRing(sock:Socket, ring:ShmRing, check:Callable=None):
+    while True:
+        vals = await sock.recvMany(BATCH_SIZE)
+        await ccPutBatch(ring, vals, check)
+
+#sends all batches from a ring on a socket
+async def ccFromRing(ring:ShmRing, sock:Socket, check:Callable=None):
+    while True:
+        vals = pickle.loads(await ring.ccGet(check))
+        await sock.sendMany(vals)
+
+#worker side end of a segment - values of the parent come out of "out", values for the parent go into "in"
+class RingBridge(Item):
+    def __init__(self, inRing:ShmRing, outRing:ShmRing, inType:PipeType|type=None, outType:PipeType|type=None, name:str="RingBridge"):
+        etype((inRing, (ShmRing,None)), (outRing, (ShmRing,None)), (name, str))
+        super().__init__(name)
+        if inRing is not None:
+            sock = self.itemAddSender("out", inType)
+            self.itemSubmit(ccFromRing(inRing, sock), f"{self.name}~fromRing")
+        if outRing is not None:
+            sock = self.itemAddReceiver("in", outType)
+            self.itemSubmit(ccToRing(sock, outRing), f"{self.name}~toRing")
+
+#sends an exception of the worker to the parent, unpicklable ones are replaced by their text
+def sendError(errors, exc:BaseException):
+    try:
+        errors.send(exc)
+    except Exception:
+        errors.send(Exception(f"{type(exc).__name__}: {exc}"))
+
+#entry point of the worker process
+# errors is the sending end of a pipe that takes the exception if building the graph fails
+def segmentMain(factory:Callable, inRing:ShmRing, outRing:ShmRing, inType:PipeType|type, outType:PipeType|type, stop, errors):
+    log = logging.getLogger("ProcessSegment")
+    try:
+        graph = factory()
+        head, tail = graph if isinstance(graph, tuple) else (graph, graph)
+        bridge = RingBridge(inRing, outRing, inType, outType)
+        if inRing is not None:
+            connect(bridge, head)
+        if outRing is not None:
+            connect(tail, bridge)
+    except BaseException as exc:
+        log.error(f"segment failed to start: {exc}")
+        sendError(errors, exc)
+        raise
+    log.debug("segment running")
+    stop.wait()
+    log.debug("segment stopping")
+    choc.stop()
+    for ring in (inRing, outRing):
+        if ring is not None:
+            ring.close()
+
+def stopSegment(proc:multiprocessing.Process, stop, errors, rings:list[ShmRing]):
+    stop.set()
+    proc.join(5)
+    if proc.is_alive():
+        proc.terminate()
+    errors.close()
+    for ring in rings:
+        ring.close()
+
+#runs a sub graph of choc items in a worker process
+# factory is a picklable callable that builds the graph in the worker and returns it
+# either as one Plugable or as a (head, tail) tuple - values from "in" are sent to head, tail feeds "out"
+# the segment is connected with >> like any other Item, the values cross the process boundary
+# as pickled batches in shared memory rings
+class ProcessSegment(Item):
+    def __init__(self, factory:Callable, inType:PipeType|type=None, outType:PipeType|type=None, name:str="ProcessSegment", ringSize:int=RING_SIZE):
+        etype((factory, Callable), (inType, (PipeType,type,None)), (outType, (PipeType,type,None)), (name, str), (ringSize, int))
+        super().__init__(name)
+        ctx = multiprocessing.get_context("spawn")
+        self.inRing = None if inType is None else ShmRing(ringSize)
+        self.outRing = None if outType is None else ShmRing(ringSize)
+        self.stopEvent = ctx.Event()
+        self.errors, errors = ctx.Pipe(duplex=False)
+        self.failure = None
+        self.process = ctx.Process(
+            target=segmentMain, name=self.name, daemon=True,
+            args=(factory, self.inRing, self.outRing, inType, outType, self.stopEvent, errors)
+        )
+        self.process.start()
+        errors.close()
+        rings = [ring for ring in (self.inRing, self.outRing) if ring is not None]
+        self.finalizer = weakref.finalize(self, stopSegment, self.process, self.stopEvent, self.errors, rings)
+        self.pumps = []
+        if self.inRing is not None:
+            sock = self.itemAddReceiver("in", inType)
+            self.pumps.append(self.itemSubmit(ccToRing(sock, self.inRing, self.checkWorker), f"{self.name}~toRing"))
+        if self.outRing is not None:
+            sock = self.itemAddSender("out", outType)
+            self.pumps.append(self.itemSubmit(ccFromRing(self.outRing, sock, self.checkWorker), f"{self.name}~fromRing"))
+
+    #raises the exception of the worker if it failed, or an error if it is gone
+    # called by the pumps while they wait on a ring, so they do not poll a dead worker forever
+    def checkWorker(self):
+        if self.failure is None and self.errors.poll():
+            try:
+                self.failure = self.errors.recv()
+            except EOFError:
+                pass
+        if self.failure is None and not self.process.is_alive():
+            self.failure = Exception(f"{self.name} worker exited with code {self.process.exitcode}")
+        if self.failure is not None:
+            raise self.failure
+
+    async def ccClose(self):
+        tasks = [pump.task for pump in self.pumps if pump.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    #stop the worker process and release the shared memory
+    def close(self):
+        self.itemCall(self.ccClose(), f"{self.name}~close")
+        self.finalizer()
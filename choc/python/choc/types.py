@@ -10,10 +10,14 @@
 ############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
 
 from __future__ import annotations
+from array import array
+from bisect import bisect_left, bisect_right
 from enum import Enum
+import functools
 import random
 import re
-from typing import Iterator
+import sys
+from typing import Iterable, Iterator
 from bilib.fn import etype, ctype
 from choc.pipe import PipeType
 
@@ -26,59 +30,94 @@ class TmeType(Enum):
     def fromBytes(byt:bytes):
         return TmeType(int.from_bytes(byt[0:1], 'big'))
 
+#parses a time string to (TmeType, value) - literals repeat a lot, so the results are cached
+@functools.lru_cache(maxsize=1024)
+def parseTimeStr(msg:str) -> tuple[TmeType,int]:
+    m = re.match(Tme.REX_TIMESTR, msg)
+    if m is None:
+        raise Exception("cannot parse time string")
+    #cycle
+    v = m.group(6)
+    if v is not None:
+        return (TmeType.cycle, int(v[:-1]))
+    #period
+    mask = 1000000000000
+    value = None
+    for v in m.groups()[:-1]:
+        if v is not None:
+            if value is None:
+                value = 0
+            value += int(v[:-1]) * mask
+        mask //= 1000
+    return (TmeType.period, value)
+
+setSlot = object.__setattr__
+
+#a point or span in time, either in picoseconds (period) or in clock cycles (cycle)
+# Tmes are immutable and can be used as dict keys
+# string literals are parsed once, the arithmetic uses the unchecked _make constructor
 class Tme:
     REX_TIMESTR = r"^(\d+s)?(\d+m)?(\d+u)?(\d+n)?(\d+p)?(^\d+c)?$"
     E12 = 1_000_000_000_000
-    period: int
-    cycle: int
+    __slots__ = ("_val", "_typ")
+    _val: int
+    _typ: TmeType
     def __init__(self, value:str|Tme|int=None, period:int=None, cycle:int=None, typ:TmeType=None):
+        #fast path for literals like Tme("1c")
+        if type(value) is str and period is None and cycle is None and typ is None:
+            typ, val = parseTimeStr(value)
+            setSlot(self, "_val", val)
+            setSlot(self, "_typ", typ)
+            return
         etype((value, (str,Tme,int,None)), (period, (int,None)), (cycle, (int,None)), (typ, (TmeType,None)))
         if value is not None:
             assert period is None and cycle is None, "cannot create Tme from value and period/cycle"
             if isinstance(value, str):
                 assert typ is None, "cannot create Tme from string and TmeType"
-                typ, val = Tme.parseStr(value)
-                self.cycle = val if typ == TmeType.cycle else None
-                self.period = val if typ == TmeType.period else None
+                typ, val = parseTimeStr(value)
             elif isinstance(value, Tme):
                 assert typ is None, "cannot create Tme from Tme and TmeType"
-                self.period = value.period
-                self.cycle = value.cycle
+                typ, val = value._typ, value._val
             elif isinstance(value, int):
                 assert typ is not None, "cannot create Tme from int without TmeType"
-                self.period = value if typ == TmeType.period else None
-                self.cycle = value if typ == TmeType.cycle else None
+                val = value
             else:
                 raise Exception(f"parsing value to Tme failt {value} ({type(value)})")
         elif period is not None:
-            self.period = period
-            self.cycle = None
+            typ, val = TmeType.period, period
         elif cycle is not None:
-            self.period = None
-            self.cycle = cycle
+            typ, val = TmeType.cycle, cycle
         else:
             raise Exception("unable to create Tme from constructor params")
-        assert self.period is None or self.cycle is None, "Tme cannot have both period and cycle"
+        setSlot(self, "_val", val)
+        setSlot(self, "_typ", typ)
+
+    #unchecked constructor for internal use
+    @classmethod
+    def _make(cls, val:int, typ:TmeType) -> Tme:
+        tme = object.__new__(cls)
+        setSlot(tme, "_val", val)
+        setSlot(tme, "_typ", typ)
+        return tme
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Tme is immutable")
+
+    #pickle/copy without going through __setattr__
+    def __reduce__(self):
+        return (Tme._make, (self._val, self._typ))
+
+    @property
+    def period(self) -> int:
+        return self._val if self._typ is TmeType.period else None
+
+    @property
+    def cycle(self) -> int:
+        return self._val if self._typ is TmeType.cycle else None
 
     @classmethod
     def parseStr(cls, msg:str) -> tuple[TmeType,int]:
-        m = re.match(cls.REX_TIMESTR, msg)
-        if m is None:
-            raise Exception("cannot parse time string")
-        #cycle
-        v = m.group(6)
-        if v is not None:
-            return (TmeType.cycle, int(v[:-1]))
-        #period
-        mask = 1000000000000
-        value = None
-        for v in m.groups()[:-1]:
-            if v is not None:
-                if value is None:
-                    value = 0
-                value += int(v[:-1]) * mask
-            mask //= 1000
-        return (TmeType.period, value)
+        return parseTimeStr(msg)
 
     def __str__(self) -> str:
         active = False
@@ -106,66 +145,77 @@ class Tme:
     def __repr__(self):
         return self.__str__()
 
+    def __hash__(self):
+        return hash((self._val, self._typ))
+
+    def __int__(self):
+        return self._val
+
     def toFreq(self) -> int:
         return self.E12 // self.period
 
     def toInt(self) -> int:
-        if self.period is not None:
-            return self.period
-        if self.cycle is not None:
-            return self.cycle
+        return self._val
 
     @classmethod
     def fromFreq(cls, freq:int):
-        return Tme(period=cls.E12 // freq)
+        return Tme._make(cls.E12 // freq, TmeType.period)
 
-    def comp(self, other:Tme) -> int:
-        etype((other, Tme))
-        if (self.period is None) != (other.period is None):
+    #raises if other is no Tme or of the other type
+    def _check(self, other:Tme):
+        if not isinstance(other, Tme):
+            etype((other, Tme))
+        if self._typ is not other._typ:
             raise Exception("cannot compare period to cycles")
-        selfInt = self.toInt()
-        otherInt = other.toInt()
-        return -1 if selfInt < otherInt else 1 if selfInt > otherInt else 0
+
+    def comp(self, other:Tme) -> int:
+        self._check(other)
+        return -1 if self._val < other._val else 1 if self._val > other._val else 0
 
     def __lt__(self, other:Tme) -> bool:
-        return self.comp(other) < 0 
+        self._check(other)
+        return self._val < other._val
 
     def __gt__(self, other:Tme) -> bool:
-        return self.comp(other) > 0
+        self._check(other)
+        return self._val > other._val
 
+    #unlike the ordering, equality does not raise - Tme are dict keys next to other types and other Tme types
     def __eq__(self, other:Tme) -> bool:
-        return self.comp(other) == 0
+        if not isinstance(other, Tme):
+            return NotImplemented
+        return self._typ is other._typ and self._val == other._val
 
     def __ge__(self, other:Tme) -> bool:
-        return self.comp(other) >= 0
+        self._check(other)
+        return self._val >= other._val
 
     def __le__(self, other:Tme) -> bool:
-        return self.comp(other) <= 0 
+        self._check(other)
+        return self._val <= other._val
 
     def __mul__(self, other:int|Tme|float) -> Tme:
-        etype((other, (int,Tme,float)))
         if isinstance(other, (int, float)):
-            return Tme(int(self.toInt() * other), typ=self.typ())
+            return Tme._make(int(self._val * other), self._typ)
         elif isinstance(other, Tme):
-            assert self.typ() != other.typ(), "can only multiply time with different types"
-            return Tme(int(self) * int(other), typ=TmeType.period)
+            assert self._typ is not other._typ, "can only multiply time with different types"
+            return Tme._make(self._val * other._val, TmeType.period)
         else:
+            etype((other, (int,Tme,float)))
             raise Exception("Tme multiply parameter is wrong")
 
     def __rmul__(self, other:int) -> Tme:
         return self.__mul__(other)
 
     def _addsub(self, other:Tme|int, sub:bool) -> Tme:
-        a = self.toInt()
         if isinstance(other, Tme):
-            assert self.typ() == other.typ(), "Tme difference is only possible with the same typ"
-            b = other.toInt()
+            assert self._typ is other._typ, "Tme difference is only possible with the same typ"
+            b = other._val
         elif isinstance(other, int):
             b = other
         else:
             raise Exception("can only add int or Tme to Tme")
-        v = a - b if sub else a + b
-        return Tme(v, typ=self.typ())
+        return Tme._make(self._val - b if sub else self._val + b, self._typ)
 
     def __add__(self, other:Tme|int) -> Tme:
         return self._addsub(other, False)
@@ -175,33 +225,27 @@ class Tme:
 
     def __truediv__(self, other:int|Tme) -> Tme:
         if isinstance(other, int):
-            return Tme(self.toInt() // other, typ=self.typ())
+            return Tme._make(self._val // other, self._typ)
         elif isinstance(other, Tme):
-            assert self.typ() == TmeType.period and other.typ() == TmeType.period, "can only divide Tmes of type period"
-            return Tme(self.toInt() // other.toInt(), typ=TmeType.cycle)
+            assert self._typ is TmeType.period and other._typ is TmeType.period, "can only divide Tmes of type period"
+            return Tme._make(self._val // other._val, TmeType.cycle)
         else:
             raise Exception("Tme division went wrong")
 
     def toBytes(self) -> bytes:
-        val = self.toInt()
-        return val.to_bytes(8, 'big') + self.typ().toBytes()
+        return self._val.to_bytes(8, 'big') + self._typ.toBytes()
     
     def nBytes(self) -> int:
         return 9
         
     def typ(self) -> TmeType:
-        if self.cycle is None:
-            return TmeType.period
-        elif self.period is None:
-            return TmeType.cycle
-        else:
-            raise Exception("cannot determine type of Tme")
+        return self._typ
 
     @classmethod
     def fromBytes(cls, byt:bytes):
         val = int.from_bytes(byt[0:8], 'big')
         typ = TmeType.fromBytes(byt[8:])
-        return Tme(val, typ=typ)
+        return Tme._make(val, typ)
 
     @classmethod
     def zero(cls, ref:TmeType|Tme=None) -> Tme:
@@ -214,7 +258,7 @@ class Tme:
             typ = ref.typ()
         else:
             raise Exception("cannot determine type of Tme")
-        return Tme(0, typ=typ)
+        return Tme._make(0, typ)
 
     @classmethod
     def metronom(cls, cycle:Tme, start:Tme=None, end:Tme=None) -> Iterator[Tme]:
@@ -234,6 +278,7 @@ NSEC = Tme(period=1_000)
 USEC = Tme(period=1_000_000)
 MSEC = Tme(period=1_000_000_000)
 SEC  = Tme(period=1_000_000_000_000)
+CYCLE = Tme(cycle=1)
 
 KILO = 1000
 MEGA = 1000 * KILO
@@ -300,21 +345,65 @@ class L9(Enum):
                 return v
         raise Exception("cannot find L9 value")
 
+#the L9 member, character and VCD character of each 4 bit L9 code
+L9_BY_CODE = [next((l9 for l9 in L9 if l9.value == code), None) for code in range(16)]
+CHAR_BY_CODE = [None if l9 is None else l9.toChar() for l9 in L9_BY_CODE]
+VCD_BY_CODE = [None if l9 is None else l9.toVCD() for l9 in L9_BY_CODE]
+#L9 code of each 4 state (and the common 9 state) VCD character
+CODE_BY_VCD = {ch: l9.value for ch, l9 in (
+    ("0", L9._0), ("1", L9._1), ("x", L9.X), ("X", L9.X), ("z", L9.Z), ("Z", L9.Z),
+    ("u", L9.U), ("U", L9.U), ("w", L9.Y), ("W", L9.Y), ("l", L9.L), ("L", L9.L), ("h", L9.H), ("H", L9.H), ("-", L9.D)
+)}
+#bytes.translate tables selecting one bit of a code as ascii '0'/'1'
+PLANE_TABLES = [bytes(ord('1') if (code >> plane) & 1 else ord('0') for code in range(256)) for plane in range(4)]
+#wire format codec tables (two L9 codes per byte, even bit in the low nibble)
+# spread: byte k (little endian) of a byte's bits moved to every 4th bit
+SPREAD_TABLES = [bytes((sum(((b >> i) & 1) << (4 * i) for i in range(8)) >> (8 * k)) & 0xff for b in range(256)) for k in range(4)]
+# gather: bit p of both nibbles of a byte placed at bits 2k and 2k+1
+GATHER_TABLES = [[bytes((((b >> p) & 1) | (((b >> (4 + p)) & 1) << 1)) << (2 * k) for b in range(256)) for k in range(4)] for p in range(4)]
+VALID_NIBBLES = bytes(b for b in range(256) if L9_BY_CODE[b & 0xf] is not None and L9_BY_CODE[b >> 4] is not None)
+PURE_NIBBLES = bytes(b for b in range(256) if b & 0xee == 0)
+
+#spreads the bits of an int to every 4th bit (nBytes: bytes of the int)
+def spreadNibbles(num:int, nBytes:int) -> int:
+    src = num.to_bytes(nBytes, 'little')
+    out = bytearray(4 * nBytes)
+    for k in range(4):
+        out[k::4] = src.translate(SPREAD_TABLES[k])
+    return int.from_bytes(out, 'little')
+
+#gathers bit p of every nibble of little endian data (length a multiple of 4) into an int
+def gatherNibbles(src:bytes, p:int) -> int:
+    ret = 0
+    for k in range(4):
+        ret |= int.from_bytes(src[k::4].translate(GATHER_TABLES[p][k]), 'little')
+    return ret
+
+#a vector of L9 bits stored as bit-planes
+# plane k holds bit k of the L9 code of every bit (val, unk, weak and virt), bit i of a plane is bit i of the vector
+# pure vectors (only 0 and 1) have all planes but val zero
 class Bits:
     REX_STRPARSE = r"(\d+)'([hdob])([a-fA-F0-9xzhlyudXZHLYUD]+)"
-    value: list[L9]
+    __slots__ = ("width", "val", "unk", "weak", "virt")
+    width: int
+    val: int
+    unk: int
+    weak: int
+    virt: int
     def __init__(self, value:any, width:int=None):
         etype((width, (int,None)))
         if isinstance(value, Bits):
             assert width is None
-            self.value = value.value
+            self._setPlanes(value.width, value.val, value.unk, value.weak, value.virt)
         elif isinstance(value, L9):
             assert isinstance(width, int)
-            self.value = (value,) * width
+            mask = (1 << width) - 1
+            code = value.value
+            self._setPlanes(width, *(mask if (code >> plane) & 1 else 0 for plane in range(4)))
         elif isinstance(value, (list, tuple)):
             assert width is None
             etype((value, (list, tuple), L9))
-            self.value = tuple(value)
+            self._codesRead([v.value for v in value])
         elif isinstance(value, str):
             assert width is None
             self._strRead(value)
@@ -326,38 +415,91 @@ class Bits:
         else:
             raise Exception(f"cannot create Bits from given value of type:{type(value)}")
 
+    def _setPlanes(self, width:int, val:int, unk:int, weak:int, virt:int):
+        self.width = width
+        self.val = val
+        self.unk = unk
+        self.weak = weak
+        self.virt = virt
+
+    #unchecked constructor from planes
+    @classmethod
+    def _fromPlanes(cls, width:int, val:int, unk:int=0, weak:int=0, virt:int=0) -> Bits:
+        bits = cls.__new__(cls)
+        bits._setPlanes(width, val, unk, weak, virt)
+        return bits
+
+    #bits that are not 0 or 1
+    def _impure(self) -> int:
+        return self.unk | self.weak | self.virt
+
+    #bits that are dontcare (code 0b1110)
+    def _dontcare(self) -> int:
+        return self.unk & self.weak & self.virt & ~self.val
+
+    #L9 codes of all bits, lsb first
+    def _codes(self) -> list[int]:
+        if self.width == 0:
+            return []
+        if not self._impure():
+            return [int(c) for c in reversed(format(self.val, f"0{self.width}b"))]
+        strs = [reversed(format(plane, f"0{self.width}b")) for plane in (self.val, self.unk, self.weak, self.virt)]
+        return [int(a) | (int(b) << 1) | (int(c) << 2) | (int(d) << 3) for a, b, c, d in zip(*strs)]
+
+    #set the planes from L9 codes, lsb first
+    def _codesRead(self, codes:list[int]):
+        width = len(codes)
+        if width == 0:
+            self._setPlanes(0, 0, 0, 0, 0)
+            return
+        raw = bytes(reversed(codes))
+        self._setPlanes(width, *(int(raw.translate(PLANE_TABLES[plane]), 2) for plane in range(4)))
+
+    #the bits as tuple of L9, lsb first
+    @property
+    def value(self) -> tuple[L9]:
+        return tuple(L9_BY_CODE[code] for code in self._codes())
+
     def __hash__(self):
-        return hash(self.value)
+        return hash((self.width, self.val, self.unk, self.weak, self.virt))
 
     def __len__(self) -> int:
-        return len(self.value)
+        return self.width
 
     def __getitem__(self, itm):
         if isinstance(itm, slice):
-            return Bits(self.value[itm])
+            start, stop, step = itm.indices(self.width)
+            if step != 1:
+                return Bits(self.value[itm])
+            width = max(stop - start, 0)
+            mask = (1 << width) - 1
+            return Bits._fromPlanes(width, *((plane >> start) & mask for plane in (self.val, self.unk, self.weak, self.virt)))
         else:
-            return self.value[itm]
+            if itm < 0:
+                itm += self.width
+            if not 0 <= itm < self.width:
+                raise IndexError("Bits index out of range")
+            code = ((self.val >> itm) & 1) | (((self.unk >> itm) & 1) << 1) \
+                | (((self.weak >> itm) & 1) << 2) | (((self.virt >> itm) & 1) << 3)
+            return L9_BY_CODE[code]
         
     #creates a Bits vector from binary data, creating one bit for each binary bit
     # using only the symbols 0 and 1
     # if width is given create a vector of that width, otherwise use the length of the binary data (byte precise)
     def _binaryRead(self, byt:bytes, width:int=None):
-        etype((byt, bytes), width, (int,None))
+        etype((byt, bytes), (width, (int,None)))
         if width is None:
             width = len(byt) * 8
-        lst = []
+        val = 0
         for s in range(width):
             b = byt[(width // 8) - 1 - (s // 8)]
-            lst.append(L9((b >> (s % 8)) & 1))
-        self.value = tuple(lst)
+            val |= ((b >> (s % 8)) & 1) << s
+        self._setPlanes(width, val, 0, 0, 0)
 
     def _intRead(self, num:int, width:int):
-        lst = []
         if width is None:
             raise Exception("creating bits from interger needs a width")
-        for i in range(width):
-            lst.append(L9((num >> i) & 1))
-        self.value = tuple(lst)
+        self._setPlanes(width, num & ((1 << width) - 1), 0, 0, 0)
 
     def _strRead(self, msg:str):
         m = re.match(self.REX_STRPARSE, msg)
@@ -371,8 +513,7 @@ class Bits:
         except ValueError:
             num = None
         if num is not None:
-            lst = [L9((num >> i) & 1) for i in range(width)]
-            self.value = tuple(lst)
+            self._intRead(num, width)
         elif base == 2:
             last = 'X'
             lst = []
@@ -381,93 +522,122 @@ class Bits:
                     last = raw[i]
                 except IndexError:
                     pass
-                lst.append(L9.fromChar(last))
-            self.value = tuple(lst)
+                lst.append(L9.fromChar(last).value)
+            self._codesRead(lst)
         else:
             raise Exception("cannot parse Bits")
 
-    #create a Bits vector from serialization bytes (2bits per byte)
+    #create a Bits vector from serialization bytes (2 bits per byte)
+    # 2 byte width followed by the L9 codes, big endian, bit 0 in the low nibble of the last byte
     @classmethod
-    def fromBytes(self, raw:bytes) -> Bits:
+    def fromBytes(cls, raw:bytes) -> Bits:
         s = int.from_bytes(raw[0:2], 'big')
-        lst = []
-        for idx in range(s):
-            byt = ((s - 1) // 2) - (idx // 2)
-            b = raw[2+byt]
-            lst.append(L9((b >> 4) if idx % 2 else (b & 0xf)))
-        return Bits(lst)
-
-    #serialize the Bits vector into bytes (2bits per byte)
+        nBytes = (s + 1) // 2
+        num = int.from_bytes(raw[2:2+nBytes], 'big') & ((1 << (4 * s)) - 1)
+        src = num.to_bytes(nBytes + (-nBytes % 4), 'little')
+        if src.translate(None, VALID_NIBBLES):
+            raise ValueError(f"invalid L9 code in Bits serialization:{bytes(raw[:2+nBytes])}")
+        if not src.translate(None, PURE_NIBBLES):
+            return cls._fromPlanes(s, gatherNibbles(src, 0))
+        return cls._fromPlanes(s, *(gatherNibbles(src, plane) for plane in range(4)))
+
+    #serialize the Bits vector into bytes (2 bits per byte)
     def toBytes(self) -> bytes:
-        s = len(self.value)
-        data = bytes()
-        data += s.to_bytes(2, 'big')
-        pack = [0] * (((s-1)//2)+1)
-        for bit,val in enumerate(self.value):
-            byt = ((s - 1) // 2) - (bit // 2) 
-            pack[byt] |= (int(val) << 4) if bit % 2 else int(val)
-        data += bytes(pack)
-        #print(f"pack:{self.value} -> {data}")
-        return data
+        s = self.width
+        planeBytes = (s + 7) // 8
+        num = spreadNibbles(self.val, planeBytes)
+        if self._impure():
+            for plane, bits in enumerate((self.unk, self.weak, self.virt), 1):
+                num |= spreadNibbles(bits, planeBytes) << plane
+        return s.to_bytes(2, 'big') + num.to_bytes((s + 1) // 2, 'big')
+
+    #size of the serialization
+    def nBytes(self) -> int:
+        return 2 + (self.width + 1) // 2
 
-    def toInt(self, force:bool=False) -> int:
-        ret = 0
-        for b in reversed(self.value):
-            ret = (ret << 1) | b.toInt(force)
+    #serialize a list of Bits vectors back to back
+    @classmethod
+    def toBytesMany(cls, bitsList:Iterable[Bits]) -> bytes:
+        return b"".join(bits.toBytes() for bits in bitsList)
+
+    #parse back to back serialized Bits vectors (at most count)
+    @classmethod
+    def fromBytesMany(cls, raw:bytes, count:int=None) -> list[Bits]:
+        #slices of the view do not copy the rest of raw
+        raw = memoryview(raw)
+        ret = []
+        pos = 0
+        while pos < len(raw) and (count is None or len(ret) < count):
+            bits = cls.fromBytes(raw[pos:])
+            ret.append(bits)
+            pos += bits.nBytes()
         return ret
 
+    def toInt(self, force:bool=False) -> int:
+        impure = self._impure()
+        if not impure:
+            return self.val
+        if not force:
+            raise NotPureSignal(f"cannot convert L9:{self[impure.bit_length() - 1]} to int")
+        return (self.val & ~impure) | (random.getrandbits(self.width) & impure)
+
     def toStr(self) -> str:
-        msg = ""
-        for b in reversed(self.value):
-            msg += b.toChar()
-        return msg
+        return "".join(CHAR_BY_CODE[code] for code in reversed(self._codes()))
 
+    #the value plane as bytes, msb first - only complete bytes
     def toBin(self) -> bytes:
-        ret = bytes()
-        curr = 0
-        pos = 0
-        for v in reversed(self.value):
-            curr = (curr << 1) | (v & 0x1)
-            pos += 1
-            if pos == 8:
-                ret += curr.to_bytes(1, 'big')
-                pos = 0
-        return ret
+        nBytes = self.width // 8
+        return (self.val >> (self.width % 8)).to_bytes(nBytes, 'big')
 
     def toVCD(self) -> str:
-        msg = ""
-        for b in reversed(self.value):
-            msg += b.toVCD()
-        return msg
+        if not self._impure():
+            return format(self.val, f"0{self.width}b")
+        return "".join(VCD_BY_CODE[code] for code in reversed(self._codes()))
+
+    #create Bits from a VCD value (msb first) - shorter values are extended like VCD does (x and z repeat, else 0)
+    @classmethod
+    def fromVCD(cls, msg:str, width:int=None) -> Bits:
+        if width is None:
+            width = len(msg)
+        if len(msg) < width:
+            fill = msg[0] if msg[0] in "xXzZ" else "0"
+            msg = fill * (width - len(msg)) + msg
+        msg = msg[len(msg) - width:]
+        if msg.isdigit():
+            try:
+                return cls._fromPlanes(width, int(msg, 2))
+            except ValueError:
+                pass
+        bits = cls.__new__(cls)
+        try:
+            bits._codesRead([CODE_BY_VCD[ch] for ch in reversed(msg)])
+        except KeyError:
+            raise ValueError(f"invalid VCD value:{msg}")
+        return bits
 
     def __str__(self) -> str:
-        return f"{len(self.value)}'b" + self.toStr()
+        return f"{self.width}'b" + self.toStr()
 
     def __repr__(self) -> str:
         return f"Bits({self})"
 
     def __eq__(self, other:Bits) -> bool:
-        return self.value == other.value
-
-    def __len__(self) -> int:
-        return len(self.value)
+        return self.width == other.width and self.val == other.val and self.unk == other.unk \
+            and self.weak == other.weak and self.virt == other.virt
 
     #concat
     def __add__(self, other:Bits) -> Bits:
         etype((other, Bits))
-        return Bits(self.value + other.value)
+        w = self.width
+        return Bits._fromPlanes(w + other.width, self.val | (other.val << w), self.unk | (other.unk << w),
+            self.weak | (other.weak << w), self.virt | (other.virt << w))
 
     def match(self, other:Bits) -> bool:
         etype((other, Bits))
         if len(self) != len(other):
             return False
-        for l,r in zip(self.value, other.value):
-            if l == r:
-                continue
-            if l is L9.dontcare or r is L9.dontcare:
-                continue
-            return False
-        return True
+        differ = (self.val ^ other.val) | (self.unk ^ other.unk) | (self.weak ^ other.weak) | (self.virt ^ other.virt)
+        return differ & ~(self._dontcare() | other._dontcare()) == 0
 
 class Change:
     value:any
@@ -513,4 +683,254 @@ class Change:
 
 #some bits are not 1 and/or 0, but contain for example X
 class NotPureSignal(Exception):
-    pass
\ No newline at end of file
+    pass
+
+BIT0_TABLE = bytes(b & 1 for b in range(256))
+LOW_BYTE = 0 if sys.byteorder == "little" else 7 #offset of the low byte of an array('Q') item
+EDGE_CHUNK = 64 #first number of changes an edge search looks at, doubled each round
+EDGE_CHUNK_MAX = 1 << 16
+
+#columnar store of a time ordered stream of Changes, all with the same TmeType
+# times are kept in an int64 array, sync flags in a bitmap
+# Bits values are kept as their four bit planes - array('Q') while they fit 64 bits, lists of int otherwise
+# all other values are kept in a plain list
+class ChangeBuffer:
+    def __init__(self, changes:Iterable[Change]=None, typ:TmeType=None):
+        etype((typ, (TmeType,None)))
+        self.typ = typ
+        self.count = 0
+        self.times = array("q")
+        self.sync = bytearray()
+        self.width = None  #width of the stored Bits
+        self.planes = None #val, unk, weak, virt plane of the stored Bits
+        self.values = None #stored values that are no Bits
+        if changes is not None:
+            self.extend(changes)
+
+    @classmethod
+    def fromChanges(cls, changes:Iterable[Change]) -> ChangeBuffer:
+        return cls(changes)
+
+    def __repr__(self):
+        return f"ChangeBuffer({self.count} changes of {self.typ})"
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _putValue(self, value:any):
+        if self.planes is None and self.values is None:
+            if isinstance(value, Bits):
+                self.width = value.width
+                self.planes = tuple(array("Q") if value.width <= 64 else [] for _ in range(4))
+            else:
+                self.values = []
+        if self.values is not None:
+            self.values.append(value)
+            return
+        if not isinstance(value, Bits) or value.width != self.width:
+            raise Exception(f"ChangeBuffer of {self.width} bit Bits cannot store:{value}")
+        val, unk, weak, virt = self.planes
+        val.append(value.val)
+        unk.append(value.unk)
+        weak.append(value.weak)
+        virt.append(value.virt)
+
+    def append(self, chg:Change):
+        etype((chg, Change))
+        time = chg.time
+        if self.typ is None:
+            self.typ = time._typ
+        elif time._typ is not self.typ:
+            raise Exception(f"cannot store a Change at {time} in a ChangeBuffer of {self.typ}")
+        if self.count and time._val < self.times[-1]:
+            raise Exception(f"ChangeBuffer needs the changes in time order, got {time} after {self.time(-1)}")
+        self._putValue(chg.value)
+        self.times.append(time._val)
+        if self.count & 7 == 0:
+            self.sync.append(0)
+        if chg.sync:
+            self.sync[-1] |= 1 << (self.count & 7)
+        self.count += 1
+
+    def extend(self, changes:Iterable[Change]):
+        for chg in changes:
+            self.append(chg)
+
+    def _index(self, idx:int) -> int:
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError("ChangeBuffer index out of range")
+        return idx
+
+    def time(self, idx:int) -> Tme:
+        return Tme._make(self.times[self._index(idx)], self.typ)
+
+    def value(self, idx:int) -> any:
+        idx = self._index(idx)
+        if self.values is not None:
+            return self.values[idx]
+        val, unk, weak, virt = self.planes
+        return Bits._fromPlanes(self.width, val[idx], unk[idx], weak[idx], virt[idx])
+
+    def isSync(self, idx:int) -> bool:
+        idx = self._index(idx)
+        return bool((self.sync[idx >> 3] >> (idx & 7)) & 1)
+
+    #buf[3] is a Change, buf[2:5] a ChangeBuffer of these changes
+    # buf[Tme("2c"):Tme("5c")] a ChangeBuffer of the changes in that time span
+    def __getitem__(self, itm:int|slice) -> Change|ChangeBuffer:
+        if not isinstance(itm, slice):
+            return Change(self.value(itm), self.time(itm), self.isSync(itm))
+        if isinstance(itm.start, Tme) or isinstance(itm.stop, Tme):
+            assert itm.step is None, "ChangeBuffer time slices have no step"
+            return self.between(itm.start, itm.stop)
+        start, stop, step = itm.indices(self.count)
+        if step != 1:
+            return ChangeBuffer((self[idx] for idx in range(start, stop, step)), self.typ)
+        return self._take(start, max(start, stop))
+
+    #ChangeBuffer of the changes start..stop-1
+    def _take(self, start:int, stop:int) -> ChangeBuffer:
+        buf = ChangeBuffer(typ=self.typ)
+        buf.count = stop - start
+        buf.times = self.times[start:stop]
+        bits = (int.from_bytes(self.sync, "little") >> start) & ((1 << buf.count) - 1)
+        buf.sync = bytearray(bits.to_bytes((buf.count + 7) // 8, "little"))
+        buf.width = self.width
+        if self.planes is not None:
+            buf.planes = tuple(plane[start:stop] for plane in self.planes)
+        if self.values is not None:
+            buf.values = self.values[start:stop]
+        return buf
+
+    def __iter__(self) -> Iterator[Change]:
+        for idx in range(self.count):
+            yield self[idx]
+
+    def toChanges(self) -> list[Change]:
+        return list(self)
+
+    def _checkTme(self, tme:Tme):
+        etype((tme, Tme))
+        if self.typ is not None and tme._typ is not self.typ:
+            raise Exception(f"cannot look up {tme} in a ChangeBuffer of {self.typ}")
+
+    #index of the change that is valid at tme (the last one at or before tme), -1 if tme is before all changes
+    def indexAt(self, tme:Tme) -> int:
+        self._checkTme(tme)
+        return bisect_right(self.times, tme._val) - 1
+
+    #number of changes before tme
+    def countBefore(self, tme:Tme) -> int:
+        self._checkTme(tme)
+        return bisect_left(self.times, tme._val)
+
+    #the value at tme, None if tme is before all changes
+    def valueAt(self, tme:Tme) -> any:
+        idx = self.indexAt(tme)
+        return None if idx < 0 else self.value(idx)
+
+    #ChangeBuffer of the changes with start <= time < end
+    def between(self, start:Tme=None, end:Tme=None) -> ChangeBuffer:
+        lo = 0
+        hi = self.count
+        if start is not None:
+            self._checkTme(start)
+            lo = bisect_left(self.times, start._val)
+        if end is not None:
+            self._checkTme(end)
+            hi = bisect_left(self.times, end._val)
+        return self._take(lo, max(lo, hi))
+
+    #drops all changes that are no longer valid at tme - the one valid at tme is kept
+    # returns the number of dropped changes
+    def trim(self, tme:Tme) -> int:
+        drop = max(self.indexAt(tme), 0)
+        if drop == 0:
+            return 0
+        del self.times[:drop]
+        bits = int.from_bytes(self.sync, "little") >> drop
+        self.count -= drop
+        self.sync = bytearray(bits.to_bytes((self.count + 7) // 8, "little"))
+        if self.planes is not None:
+            for plane in self.planes:
+                del plane[:drop]
+        if self.values is not None:
+            del self.values[:drop]
+        return drop
+
+    #values of up to 64 bits can be scanned for edges without creating any objects
+    def _packed(self) -> bool:
+        return self.planes is not None and self.width <= 64
+
+    #edge mask of the changes lo..hi-1 (lo >= 1) with the number of mask bits per change
+    # edges of bit 0 are found on a byte per change, any edges compare the whole 64 bit items
+    def _edgeMask(self, typ:Edge, lo:int, hi:int) -> tuple[int, int]:
+        if typ == Edge.any:
+            diff = 0
+            for plane in self.planes:
+                diff |= int.from_bytes(plane[lo:hi].tobytes(), "little") ^ int.from_bytes(plane[lo-1:hi-1].tobytes(), "little")
+            return (diff, 64)
+        val, unk, weak, virt = (int.from_bytes(plane[lo-1:hi].tobytes()[LOW_BYTE::8].translate(BIT0_TABLE), "little") for plane in self.planes)
+        impure = unk | weak | virt
+        ones = int.from_bytes(b"\x01" * (hi - lo + 1), "little")
+        zero = ~(val | impure) & ones
+        one = val & ~impure
+        if typ == Edge.pos:
+            mask = zero & (one >> 8)
+        else:
+            mask = one & (zero >> 8)
+        return (mask & (ones >> 8), 8)
+
+    #edge from prev to cur as seen by Probe - any change of the value or bit 0 going 0->1 (pos) or 1->0 (neg)
+    def _isEdge(self, typ:Edge, prev:any, cur:any) -> bool:
+        if prev == cur:
+            return False
+        if typ == Edge.any:
+            return True
+        if typ == Edge.pos:
+            return prev[0] == L9._0 and cur[0] == L9._1
+        return prev[0] == L9._1 and cur[0] == L9._0
+
+    #indices of the edges in start..stop-1, ascending or with backwards descending
+    # the changes are scanned in growing chunks, so close edges are found fast and far ones with few rounds
+    def _scanEdges(self, typ:Edge, start:int, stop:int, backwards:bool=False) -> Iterator[int]:
+        start = max(start, 1)
+        stop = self.count if stop is None else min(stop, self.count)
+        chunk = EDGE_CHUNK
+        while start < stop:
+            if backwards:
+                lo, hi = max(stop - chunk, start), stop
+                stop = lo
+            else:
+                lo, hi = start, min(start + chunk, stop)
+                start = hi
+            chunk = min(chunk * 2, EDGE_CHUNK_MAX)
+            if self._packed():
+                mask, bits = self._edgeMask(typ, lo, hi)
+                if not mask:
+                    continue
+                laneBytes = bits // 8
+                found = [lo + m.start() // laneBytes for m in re.finditer(rb"[^\x00]", mask.to_bytes((hi - lo) * laneBytes, "little"))]
+                found = list(dict.fromkeys(found)) #one entry per change
+            else:
+                found = [idx for idx in range(lo, hi) if self._isEdge(typ, self.value(idx - 1), self.value(idx))]
+            if backwards:
+                found.reverse()
+            yield from found
+
+    #index of the first change in start..stop-1 that is an edge to its predecessor, -1 if there is none
+    def nextEdge(self, typ:Edge=Edge.any, start:int=1, stop:int=None) -> int:
+        etype((typ, Edge), (start, int), (stop, (int,None)))
+        return next(self._scanEdges(typ, start, stop), -1)
+
+    #index of the last change before stop that is an edge to its predecessor, -1 if there is none
+    def prevEdge(self, typ:Edge=Edge.any, stop:int=None) -> int:
+        etype((typ, Edge), (stop, (int,None)))
+        return next(self._scanEdges(typ, 1, stop, backwards=True), -1)
+
+    #indices of all edges in start..stop-1
+    def edges(self, typ:Edge=Edge.any, start:int=1, stop:int=None) -> list[int]:
+        etype((typ, Edge), (start, int), (stop, (int,None)))
+        return list(self._scanEdges(typ, start, stop))
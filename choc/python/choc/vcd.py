@@ -0,0 +1,394 @@
+####    ############    Copyright (C) 2025 Mattis Hasler, Barkhausen Institut
+####    ############
+####                    This source describes Open Hardware and is licensed under the
+####                    CERN-OHL-W v2 (https://cern.ch/cern-ohl)
+############    ####
+############    ####
+####    ####    ####
+####    ####    ####
+############            Authors:
+############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
+
+# value change dump (VCD) files
+
+from __future__ import annotations
+from array import array
+import asyncio
+from bisect import bisect_right
+import datetime
+import logging
+import mmap
+from pathlib import Path
+import re
+import struct
+import sys
+from typing import Iterator
+from bilib.fn import etype
+from choc.items import FileWriter, ccMergeChanges
+from choc.pipe import BATCH_SIZE, Item, PipeOffband, Socket
+from choc.types import L9, Bits, Change, Tme, TmeType
+
+PERIOD_SCALE = "1ps" #period Tmes are picoseconds
+INDEX_EVERY = 1024   #timestamps between two checkpoints of a VcdReader index
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct("<6q") #version, VCD size, VCD mtime, indexEvery, checkpoints, snapshot entries
+EVENTS_PER_STEP = 1 << 14 #events a VcdSource parses before it lets the other tasks of the loop run
+UNIT_FS = {"s": 10**15, "ms": 10**12, "us": 10**9, "ns": 10**6, "ps": 10**3, "fs": 1}
+TOKEN = re.compile(rb"\S+")
+
+#the arrays of an index file are stored little endian - no pickle, the file might come from anybody
+def readArray(fh, count:int) -> array:
+    arr = array("q")
+    arr.fromfile(fh, count)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+def writeArray(fh, arr:array):
+    if sys.byteorder == "big":
+        arr = array("q", arr)
+        arr.byteswap()
+    arr.tofile(fh)
+
+#identifier code of the n-th signal - printable ascii characters, shortest first
+def vcdIdent(idx:int) -> str:
+    etype((idx, int))
+    code = chr(33 + idx % 94)
+    idx //= 94
+    while idx:
+        idx -= 1
+        code += chr(33 + idx % 94)
+        idx //= 94
+    return code
+
+#VCD variable type and width of the values of a signal
+def vcdVar(value:any) -> tuple[str, int]:
+    if isinstance(value, Bits):
+        return ("wire", value.width)
+    if isinstance(value, (L9, bool)) or value is None:
+        return ("wire", 1)
+    if isinstance(value, int):
+        return ("integer", 32)
+    raise Exception(f"cannot write values of type {type(value)} to a VCD")
+
+#value change line of a value
+def vcdValue(value:any, ident:str) -> str:
+    if isinstance(value, Bits):
+        if value.width == 1:
+            return f"{value.toVCD()}{ident}\n"
+        return f"b{value.toVCD()} {ident}\n"
+    if isinstance(value, L9):
+        return f"{value.toVCD()}{ident}\n"
+    if isinstance(value, bool):
+        return f"{int(value)}{ident}\n"
+    return f"b{value & 0xffffffff:b} {ident}\n"
+
+#writes any number of Change streams into one VCD file
+# the streams are merged by time and only real value changes are written
+# period Tmes are written in picoseconds, for cycle Tmes one cycle is one cycleScale
+# signals are connected in the order of names (x >> writer takes the next free one) or by name (x >> writer["clk"])
+# the file is closed when all inputs ended
+class VcdWriter(Item):
+    def __init__(self, fname:Path, signals:list[str], module:str="choc", cycleScale:str="1ns", name:str="VcdWriter"):
+        etype((fname, (Path,str)), (signals, list, str), (module, str), (cycleScale, str), (name, str))
+        super().__init__(name)
+        self.fname = fname
+        self.module = module
+        self.cycleScale = cycleScale
+        self.ports = [self.itemAddReceiver(sig, Change) for sig in signals]
+        self.signals = signals
+        self.task = self.itemSubmit(self.run(), f"{self.name}~run")
+
+    def __getitem__(self, sig:str) -> Socket:
+        return self.itemGet(sig)
+
+    #receives until the first change (or the end) of a socket is known
+    async def _ccFirst(self, sock:Socket, vals:list) -> Change:
+        while True:
+            for val in vals:
+                if not isinstance(val, PipeOffband):
+                    return val
+                if val == PipeOffband.PipeEnd:
+                    return None
+            more = await sock.recvMany(BATCH_SIZE)
+            vals.extend(more)
+            vals = more
+
+    def _header(self, firsts:list[Change]) -> str:
+        typs = {chg.time.typ() for chg in firsts if chg is not None}
+        if len(typs) > 1:
+            raise Exception(f"{self.name} cannot mix period and cycle signals")
+        scale = self.cycleScale if typs == {TmeType.cycle} else PERIOD_SCALE
+        lines = [
+            f"$date {datetime.datetime.now().ctime()} $end\n",
+            f"$version choc {self.__class__.__name__} $end\n",
+            f"$timescale {scale} $end\n",
+            f"$scope module {self.module} $end\n",
+        ]
+        for idx, (sig, chg) in enumerate(zip(self.signals, firsts)):
+            typ, width = vcdVar(None if chg is None else chg.value)
+            lines.append(f"$var {typ} {width} {vcdIdent(idx)} {sig} $end\n")
+        lines.append("$upscope $end\n$enddefinitions $end\n")
+        return "".join(lines)
+
+    async def run(self):
+        log = self.log()
+        pending = [[] for _ in self.ports]
+        firsts = [await self._ccFirst(sock, vals) for sock, vals in zip(self.ports, pending)]
+        writer = FileWriter(self.fname)
+        writer.writeRaw(self._header(firsts))
+        idents = [vcdIdent(idx) for idx in range(len(self.ports))]
+        last = [None] * len(self.ports)
+        now = None
+        async for batch in ccMergeChanges(self.ports, pending=pending):
+            lines = []
+            for port, chg in batch:
+                if last[port] is not None and chg.value == last[port]:
+                    continue
+                time = chg.time.toInt()
+                if time != now:
+                    lines.append(f"#{time}\n")
+                    now = time
+                lines.append(vcdValue(chg.value, idents[port]))
+                last[port] = chg.value
+            writer.writeRaw("".join(lines))
+        log.debug(f"all inputs ended - closing {self.fname}")
+        await writer.ccClose()
+
+    #waits until all inputs ended and the file is written
+    def wait(self, timeout:float=None):
+        self.task(timeout)
+
+#a variable declared in a VCD header
+class VcdVar:
+    def __init__(self, name:str, ident:str, width:int, typ:str):
+        self.name = name
+        self.ident = ident
+        self.width = width
+        self.typ = typ
+
+    def __repr__(self):
+        return f"VcdVar({self.name}:{self.typ}[{self.width}] {self.ident})"
+
+#reads a VCD file without loading or parsing all of it
+# the file is memory mapped, an index with a checkpoint every indexEvery timestamps is kept next to it (<fname>.idx)
+# a checkpoint holds the time, its file offset and for every signal the offset of its last change before,
+# so reading can start at any time by jumping to the checkpoint before
+# times are returned as period Tmes (converted by the timescale) or as cycle Tmes (one cycle per VCD time unit)
+class VcdReader:
+    vars:dict[str,VcdVar]
+    def __init__(self, fname:Path, indexEvery:int=INDEX_EVERY, typ:TmeType=TmeType.period, index:Path=None):
+        etype((fname, (Path,str)), (indexEvery, int), (typ, TmeType), (index, (Path,None)))
+        self.fname = Path(fname)
+        self.typ = typ
+        self.index = self.fname.with_name(self.fname.name + ".idx") if index is None else index
+        self.fh = open(self.fname, "rb")
+        self.buf = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._parseHeader()
+        self._loadIndex(indexEvery)
+
+    def close(self):
+        self.buf.close()
+        self.fh.close()
+
+    def _parseHeader(self):
+        end = self.buf.find(b"$enddefinitions")
+        if end < 0:
+            raise Exception(f"{self.fname} has no VCD header")
+        self.dataStart = self.buf.find(b"$end", end + len(b"$enddefinitions")) + len(b"$end")
+        tokens = self.buf[:end].decode(errors="replace").split()
+        self.vars = {}
+        self.scale = UNIT_FS["ps"] #femtoseconds per VCD time unit
+        scopes = []
+        pos = 0
+        while pos < len(tokens):
+            key = tokens[pos]
+            stop = tokens.index("$end", pos + 1) if key != "$end" else pos
+            body = tokens[pos+1:stop]
+            if key == "$scope":
+                scopes.append(body[1])
+            elif key == "$upscope":
+                scopes.pop()
+            elif key == "$var":
+                name = ".".join(scopes + ["".join(body[3:])])
+                self.vars[name] = VcdVar(name, body[2], int(body[1]), body[0])
+            elif key == "$timescale":
+                m = re.fullmatch(r"(\d+)(s|ms|us|ns|ps|fs)", "".join(body))
+                if m is None:
+                    raise Exception(f"cannot parse timescale of {self.fname}:{body}")
+                self.scale = int(m.group(1)) * UNIT_FS[m.group(2)]
+            pos = stop + 1
+        #signals with the same identifier share their changes
+        self.idents = {}
+        for var in self.vars.values():
+            self.idents.setdefault(var.ident.encode(), len(self.idents))
+
+    #the variable of a signal - by full name (scope.scope.name) or by its name if that is unique
+    def signal(self, name:str) -> VcdVar:
+        etype((name, str))
+        if name in self.vars:
+            return self.vars[name]
+        found = [var for full, var in self.vars.items() if full.rsplit(".", 1)[-1] == name]
+        if len(found) != 1:
+            raise Exception(f"{self.fname} has {'no' if not found else 'several'} signal {name}")
+        return found[0]
+
+    #(offset, time, ident, value) of the data from pos on - time lines have no ident, changes no time
+    def _events(self, pos:int) -> Iterator[tuple]:
+        tokens = TOKEN.finditer(self.buf, pos)
+        for m in tokens:
+            tok = m.group()
+            first = tok[:1]
+            if first == b"#":
+                yield (m.start(), int(tok[1:]), None, None)
+            elif first in b"bBrR":
+                yield (m.start(), None, next(tokens).group(), tok[1:])
+            elif first == b"$":
+                #$dumpvars, $end ... - only comments have to be skipped completely
+                if tok == b"$comment":
+                    for m in tokens:
+                        if m.group() == b"$end":
+                            break
+            else:
+                yield (m.start(), None, tok[1:], first)
+
+    def _loadIndex(self, every:int):
+        log = logging.getLogger("VcdReader")
+        stat = self.fname.stat()
+        key = (INDEX_VERSION, stat.st_size, stat.st_mtime_ns, every)
+        try:
+            with open(self.index, "rb") as fh:
+                *found, checks, snaps = INDEX_HEADER.unpack(fh.read(INDEX_HEADER.size))
+                if tuple(found) == key and snaps == checks * len(self.idents):
+                    self.times = readArray(fh, checks)
+                    self.offsets = readArray(fh, checks)
+                    self.snaps = readArray(fh, snaps)
+                    return
+        except (OSError, EOFError, struct.error):
+            pass
+        log.info(f"indexing {self.fname}")
+        self._buildIndex(every)
+        try:
+            with open(self.index, "wb") as fh:
+                fh.write(INDEX_HEADER.pack(*key, len(self.times), len(self.snaps)))
+                for arr in (self.times, self.offsets, self.snaps):
+                    writeArray(fh, arr)
+        except OSError as e:
+            log.warning(f"cannot store index of {self.fname}:{e}")
+
+    def _buildIndex(self, every:int):
+        idents = self.idents
+        last = array("q", [-1]) * len(idents)
+        self.times = array("q")
+        self.offsets = array("q")
+        self.snaps = array("q") #offsets of the last change of each signal before a checkpoint
+        count = 0
+        for off, time, ident, _ in self._events(self.dataStart):
+            if ident is None:
+                if count % every == 0:
+                    self.times.append(time)
+                    self.offsets.append(off)
+                    self.snaps.extend(last)
+                count += 1
+            else:
+                idx = idents.get(ident)
+                if idx is not None:
+                    last[idx] = off
+
+    #the VCD time of a Tme
+    def _units(self, tme:Tme) -> int:
+        if self.typ == TmeType.cycle:
+            return tme.cycle
+        return tme.period * UNIT_FS["ps"] // self.scale
+
+    def _tme(self, units:int) -> Tme:
+        if self.typ == TmeType.cycle:
+            return Tme(cycle=units)
+        return Tme(period=units * self.scale // UNIT_FS["ps"])
+
+    def _value(self, var:VcdVar, raw:bytes) -> any:
+        if var.typ == "real":
+            return float(raw)
+        return Bits.fromVCD(raw.decode(), var.width)
+
+    #raw value of the change at a file offset
+    def _rawAt(self, off:int) -> bytes:
+        tok = TOKEN.match(self.buf, off).group()
+        return tok[1:] if tok[:1] in b"bBrR" else tok[:1]
+
+    #the changes of a signal with start <= time < end
+    # with a start the first change is the value at start (from the checkpoint before it)
+    def changes(self, signal:str, start:Tme=None, end:Tme=None) -> Iterator[Change]:
+        for chg in self._changes(signal, start, end):
+            if chg is not None:
+                yield chg
+
+    #changes, with a None after every tick parsed events (0: never) - for readers that have to pause now and then
+    def _changes(self, signal:str, start:Tme=None, end:Tme=None, tick:int=0) -> Iterator[Change]:
+        etype((signal, str), (start, (Tme,None)), (end, (Tme,None)), (tick, int))
+        var = self.signal(signal)
+        want = var.ident.encode()
+        pos = self.dataStart
+        value = None
+        first = None
+        if start is not None:
+            first = self._units(start)
+            chk = bisect_right(self.times, first) - 1
+            if chk >= 0:
+                pos = self.offsets[chk]
+                snap = self.snaps[chk * len(self.idents) + self.idents[want]]
+                if snap >= 0:
+                    value = self._rawAt(snap)
+        last = None if end is None else self._units(end)
+        now = 0
+        started = start is None
+        count = tick
+        for _, time, ident, raw in self._events(pos):
+            count -= 1
+            if count == 0:
+                count = tick
+                yield None
+            if time is not None:
+                if last is not None and time >= last:
+                    break
+                if not started and time > first:
+                    started = True
+                    if value is not None:
+                        yield Change(self._value(var, value), start)
+                now = time
+            elif ident == want:
+                if started:
+                    yield Change(self._value(var, raw), self._tme(now))
+                else:
+                    value = raw
+        if not started and value is not None:
+            yield Change(self._value(var, value), start)
+
+#sends the changes of one signal of a VCD file (see VcdReader.changes)
+# the file is read while the changes are consumed
+class VcdSource(Item):
+    def __init__(self, vcd:VcdReader|Path, signal:str, start:Tme=None, end:Tme=None, name:str="VcdSource"):
+        etype((vcd, (VcdReader,Path,str)), (signal, str), (start, (Tme,None)), (end, (Tme,None)), (name, str))
+        super().__init__(name)
+        self.vcd = vcd if isinstance(vcd, VcdReader) else VcdReader(vcd)
+        self.signal = signal
+        self.start = start
+        self.end = end
+        self.itemAddSender("out", Change)
+        self.itemSubmit(self.run(), f"{self.name}~run")
+
+    async def run(self):
+        outSock = self.itemGet("out")
+        batch = []
+        for chg in self.vcd._changes(self.signal, self.start, self.end, EVENTS_PER_STEP):
+            if chg is None:
+                #a signal that rarely changes would block the loop for a long scan
+                await asyncio.sleep(0)
+                continue
+            batch.append(chg)
+            if len(batch) >= BATCH_SIZE:
+                await outSock.sendMany(batch)
+                batch = []
+        if batch:
+            await outSock.sendMany(batch)
+        await outSock.send(PipeOffband.PipeEnd)
@@ -43,10 +43,10 @@ class MemoryPort(Item):
         await req.wait()
 
     def read(self, addr:int) -> int:
-        return choc.call(self.ccRead(addr), f"{self.name}~ccRead")
+        return self.itemCall(self.ccRead(addr), f"{self.name}~ccRead")
     
     def write(self, addr:int, data:int, mask:int=True) -> int:
-        return choc.call(self.ccWrite(addr, data, mask), f"{self.name}~ccWrite")
+        return self.itemCall(self.ccWrite(addr, data, mask), f"{self.name}~ccWrite")
 
 # wite is a write bit enable mask, or True for all bits 1
 class MemoryRequest(Request):
@@ -151,7 +151,7 @@ class Memory(Item):
         super().__init__(name)
         self.mem = {}
         self.itemAddReceiver("req", MemoryRequest)
-        choc.submit(self.run(), f"{self.name}~run")
+        self.itemSubmit(self.run(), f"{self.name}~run")
 
     async def run(self):
         reqSocket = self.itemGet("req")
@@ -0,0 +1,13 @@
+####    ############    Copyright (C) 2025 Mattis Hasler, Barkhausen Institut
+####    ############    
+####                    This source describes Open Hardware and is licensed under the
+####                    CERN-OHL-W v2 (https://cern.ch/cern-ohl)
+############    ####    
+############    ####    
+####    ####    ####    
+####    ####    ####    
+############            Authors:
+############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
+
+
+from bilib.fn import configure
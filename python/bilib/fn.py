@@ -10,14 +10,69 @@
 ############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
 
 from __future__ import annotations
+import os
 import re
 
+#type check mode of etype
+# full:   check all types (default)
+# cached: check all types, but memoize the normalized type sets
+# off:    etype does nothing
+# the environment variable BILIB_TYPECHECK sets the mode at import time, configure() changes it at runtime
+TYPECHECK_MODES = ("full", "cached", "off")
+typeCheckMode = os.environ.get("BILIB_TYPECHECK", "full")
+if typeCheckMode not in TYPECHECK_MODES:
+    raise ValueError(f"BILIB_TYPECHECK must be one of {TYPECHECK_MODES}, not:{typeCheckMode}")
+typeSpecCache = {} #(varTypes, keyTypes, valTypes) -> normalized sets
+
+def configure(typecheck:str=None):
+    global typeCheckMode
+    if typecheck is not None:
+        if typecheck not in TYPECHECK_MODES:
+            raise ValueError(f"typecheck must be one of {TYPECHECK_MODES}, not:{typecheck}")
+        typeCheckMode = typecheck
+        typeSpecCache.clear()
+
+##### make sets
+# returns the types (without None) and if None is allowed
+def makeSet(tup):
+    if tup is None:
+        return None, False
+    if not isinstance(tup, tuple):
+        return (tuple(), True) if tup is None else ((tup,), False)
+    return tuple(filter(lambda x: x is not None, tup)), None in tup
+
+#the normalized sets of one etype argument (without the variable)
+def makeSpec(spec:tuple) -> tuple:
+    if len(spec) == 1:
+        keyTup, valTup = None, None
+    elif len(spec) == 2:
+        keyTup, valTup = None, spec[1]
+    elif len(spec) == 3:
+        keyTup, valTup = spec[1], spec[2]
+    else:
+        raise ValueError(f"wrong number of arguments:{len(spec) + 1}")
+    return makeSet(spec[0]) + makeSet(keyTup) + makeSet(valTup)
+
+def check(var, types, none):
+    if none and var is None:
+        return
+    if types is None or isinstance(var, types):
+        return 
+    raise TypeError(f"wrong type:{type(var)} != {types}")
+
 #checks if the type of a variable is correct
 # takes tuples of (varibale, types, [[keyTypes], valTypes])
 # types can be a tuple of types that are allowed and also None
 # if a variable is list, tuple or set the values are checked against the valTypes
 # same with dicts and keyTypes and valTypes
 def etype(*args) -> bool:
+    if typeCheckMode == "full":
+        return etypeFull(args)
+    if typeCheckMode == "cached":
+        return etypeCached(args)
+    return True
+
+def etypeFull(args:tuple) -> bool:
     for tup in args:
         #break up tuple
         if len(tup) == 2:
@@ -30,23 +85,10 @@ def etype(*args) -> bool:
             var,varTup,keyTup,valTup = tup
         else:
             raise ValueError(f"wrong number of arguments:{len(tup)}")
-        ##### make sets
-        def makeSet(tup):
-            if tup is None:
-                return None, False
-            if not isinstance(tup, tuple):
-                return (tuple(), True) if tup is None else ((tup,), False)
-            return tuple(filter(lambda x: x is not None, tup)), None in tup
         varTypes, varNone = makeSet(varTup)
         keyTypes, keyNone = makeSet(keyTup)
         valTypes, valNone = makeSet(valTup)
         #check
-        def check(var, types, none):
-            if none and var is None:
-                return
-            if types is None or isinstance(var, types):
-                return 
-            raise TypeError(f"wrong type:{type(var)} != {types}")
         check(var, varTypes, varNone)
         #check iteratables
         if isinstance(var, (list, tuple, set)) and valTypes is not None:
@@ -58,9 +100,33 @@ def etype(*args) -> bool:
                 check(val, valTypes, valNone)
     return True
 
-def ctype(*args):
+#same checks as etypeFull, the normalized sets of each argument are looked up instead of built
+def etypeCached(args:tuple) -> bool:
+    for tup in args:
+        spec = tup[1:]
+        try:
+            varTypes, varNone, keyTypes, keyNone, valTypes, valNone = typeSpecCache[spec]
+        except KeyError:
+            varTypes, varNone, keyTypes, keyNone, valTypes, valNone = typeSpecCache[spec] = makeSpec(spec)
+        except TypeError: #not hashable
+            varTypes, varNone, keyTypes, keyNone, valTypes, valNone = makeSpec(spec)
+        var = tup[0]
+        if not (varTypes is None or isinstance(var, varTypes) or (varNone and var is None)):
+            check(var, varTypes, varNone)
+        if valTypes is not None and isinstance(var, (list, tuple, set)):
+            for val in var:
+                if not isinstance(val, valTypes):
+                    check(val, valTypes, valNone)
+        if isinstance(var, dict):
+            for key,val in var.items():
+                check(key, keyTypes, keyNone)
+                check(val, valTypes, valNone)
+    return True
+
+#like etype, but returns False instead of raising - a predicate, so it checks in every mode (also "off")
+def ctype(*args) -> bool:
     try:
-        return etype(*args)
+        return etypeCached(args) if typeCheckMode == "cached" else etypeFull(args)
     except TypeError:
         return False
 
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+####    ############    Copyright (C) 2025 Mattis Hasler, Barkhausen Institut
+####    ############    
+####                    This source describes Open Hardware and is licensed under the
+####                    CERN-OHL-W v2 (https://cern.ch/cern-ohl)
+############    ####    
+############    ####    
+####    ####    ####    
+####    ####    ####    
+############            Authors:
+############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
+
+
+# micro benchmark of bilib.fn.etype in its different type check modes
+# usage: PYTHONPATH=env/python script/benchEtype.py [count]
+
+import sys
+import timeit
+from bilib import fn
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+lst = [1] * 16
+
+CASES = {
+    "simple":   lambda: fn.etype((1, int), ("a", str)),
+    "optional": lambda: fn.etype((None, (int,None)), ("a", (str,int,None)), (1.0, (float,int))),
+    "list":     lambda: fn.etype((lst, list, int)),
+}
+
+print(f"{'case':10s} {'mode':8s} {'usec/call':>10s}")
+for name, case in CASES.items():
+    for mode in fn.TYPECHECK_MODES:
+        fn.configure(typecheck=mode)
+        sec = min(timeit.repeat(case, number=count, repeat=3))
+        print(f"{name:10s} {mode:8s} {sec / count * 1e6:10.3f}")
+fn.configure(typecheck="full")
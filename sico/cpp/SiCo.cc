@@ -25,6 +25,7 @@
 #include <poll.h>
 #include <mutex>
 #include <condition_variable>
+#include <algorithm>
 #include "SiCo.h"
 
 namespace SiCo {
@@ -220,6 +221,17 @@ Message::Message(const char *raw) {
         << " channel:" << channel << std::endl;
 }
 
+Message::Message(const std::string &chan, const char *payload, int length) :
+    channel(chan),
+    dataLength(length)
+{
+    if(dataLength != 0) {
+        data = new char[dataLength];
+        memcpy(data, payload, dataLength);
+    }else
+        data = NULL;
+}
+
 Message::Message(std::string chan, int length) :
     channel(chan),
     dataLength(length)
@@ -233,10 +245,17 @@ Message::Message(int length) :
     data = new char[length];
 }
 
+Message::Message(std::vector<Message> &&recs) :
+    dataLength(0),
+    data(NULL),
+    records(std::move(recs))
+{}
+
 Message::Message(Message && o){
     channel = o.channel;
     dataLength = o.dataLength;
     data = o.data;
+    records = std::move(o.records);
     o.data = NULL; //mark as moved
 }
 
@@ -253,6 +272,12 @@ void Message::pack(char *buffer) {
     memcpy(buffer + 8 + chanLength, data, dataLength);         
 }
 
+void Message::packId(char *buffer, uint32_t id) {
+    put32(buffer, 0, getIdSize());          //0 message length
+    put32(buffer, 4, CHANNEL_ID_FLAG | id); //4 channel id
+    memcpy(buffer + 8, data, dataLength);
+}
+
 MessageQueue::MessageQueue() :
     queue(),
     queueMutex(),
@@ -344,6 +369,7 @@ int acceptConnection(int sock)
 Connection::Connection() {
     running = true;
     draining = false;
+    peerVersion = 1;
     connectedSocket = 0;
     connectedEst = 0;
     connectedTerm = 0;
@@ -360,6 +386,11 @@ void Connection::push(Message &msg) {
     sendQueue.push(msg);
 }
 
+void Connection::setPeerVersion(uint32_t version) {
+    peerVersion = std::min(version, PROTOCOL_VERSION);
+    logh("connection", info) << "protocol version:" << peerVersion << std::endl;
+}
+
 void Connection::runConn() {
     std::unique_lock<std::mutex> llock(connectedMutex, std::defer_lock);
     int listenSocket = 0;
@@ -374,6 +405,7 @@ void Connection::runConn() {
         //accept connection
         llock.lock();
         connectedSocket = acceptConnection(listenSocket);
+        peerVersion = 1; //until the peer says hello
         connectedEst += 1;
         llock.unlock();
         connectedCond.notify_all();
@@ -387,11 +419,13 @@ void Connection::runConn() {
 
 void Connection::runSend() {
     std::unique_lock<std::mutex> llock(connectedMutex, std::defer_lock);
-    int curr;
+    int curr = 0;
     while(running){
         //wait for connection
         llock.lock();
         connectedCond.wait(llock, [this]() { return connectedEst > connectedTerm; });
+        if(curr != connectedEst)
+            sendIds.clear(); //ids are bound per connection
         curr = connectedEst;
         llock.unlock();
         try{
@@ -412,11 +446,13 @@ void Connection::runSend() {
 
 void Connection::runRecv() {
     std::unique_lock<std::mutex> llock(connectedMutex, std::defer_lock);
-    int curr;
+    int curr = 0;
     while(running){
         //wait for connection
         llock.lock();
         connectedCond.wait(llock, [this]() { return connectedEst > connectedTerm; });
+        if(curr != connectedEst)
+            recvNames.clear(); //ids are bound per connection
         curr = connectedEst;
         llock.unlock();
         try{
@@ -432,19 +468,89 @@ void Connection::runRecv() {
 void Connection::sendMessage()
 {
     Message msg = sendQueue.pop();
-    severity level = msg.getChannel() == "ctrl" ? trace : debug;
-    logh("connection", level) << "sending a message channel:" << msg.getChannel()
-        << " len:" << msg.getSize() << std::endl;
+    if(msg.isBundle()){
+        logh("connection", debug) << "sending a bundle of messages:" << msg.getRecords().size() << std::endl;
+    }else{
+        severity level = msg.getChannel() == "ctrl" ? trace : debug;
+        logh("connection", level) << "sending a message channel:" << msg.getChannel()
+            << " len:" << msg.getSize() << std::endl;
+        if(msg.getSize() > 1024 * 1024) {
+            logh("connection", error) << "message unresonably big:" << msg.getSize() << " - skip" <<std::endl;
+            return;
+        }
+    }
     //prepare
-    int sendSize = msg.getSize();
-    if(sendSize > 1024 * 1024) {
-        logh("connection", error) << "message unresonably big:" << sendSize << " - skip" <<std::endl;
-        sendSize = 0;
+    std::vector<char> sendBuf;
+    if(msg.isBundle())
+        encodeBundle(msg, sendBuf);
+    else
+        encodeMessage(msg, sendBuf);
+    sendBytes(sendBuf.data(), sendBuf.size());
+}
+
+//the id of a channel, a new id is bound by a frame in buf
+uint32_t Connection::bindId(const std::string &chan, std::vector<char> &buf)
+{
+    auto it = sendIds.find(chan);
+    if(it != sendIds.end())
+        return it->second;
+    uint32_t id = sendIds.size() + 1;
+    sendIds[chan] = id;
+    size_t pos = buf.size();
+    int bindSize = 12 + chan.length();
+    buf.resize(pos + bindSize);
+    put32(buf.data(), pos, bindSize);
+    put32(buf.data(), pos + 4, CHANNEL_ID_FLAG | CHANNEL_BIND_ID);
+    put32(buf.data(), pos + 8, id);
+    memcpy(buf.data() + pos + 12, chan.c_str(), chan.length());
+    logh("connection", debug) << "bind channel:" << chan << " id:" << id << std::endl;
+    return id;
+}
+
+//append the frame of a message to buf
+void Connection::encodeMessage(Message &msg, std::vector<char> &buf)
+{
+    if(peerVersion < 2){
+        size_t pos = buf.size();
+        buf.resize(pos + msg.getSize());
+        msg.pack(buf.data() + pos);
+        return;
+    }
+    uint32_t id = bindId(msg.getChannel(), buf);
+    size_t pos = buf.size();
+    buf.resize(pos + msg.getIdSize());
+    msg.packId(buf.data() + pos, id);
+}
+
+//append the frames of a bundle to buf - a peer without bundles gets a frame for each message
+void Connection::encodeBundle(Message &msg, std::vector<char> &buf)
+{
+    std::vector<Message> &records = msg.getRecords();
+    if(peerVersion < 3 || records.size() == 1){
+        for(Message &rec : records)
+            encodeMessage(rec, buf);
         return;
     }
-    char sendBuf[sendSize];
-    msg.pack(sendBuf);
-    //send
+    //the records refer to the ids, so they are bound first
+    std::vector<uint32_t> ids;
+    for(Message &rec : records)
+        ids.push_back(bindId(rec.getChannel(), buf));
+    size_t head = buf.size();
+    buf.resize(head + 8);
+    for(size_t i = 0; i < records.size(); i++){
+        size_t pos = buf.size();
+        int length = records[i].getLength();
+        buf.resize(pos + 8 + length);
+        put32(buf.data(), pos, ids[i]);
+        put32(buf.data(), pos + 4, length);
+        memcpy(buf.data() + pos + 8, records[i].getData(), length);
+    }
+    put32(buf.data(), head, buf.size() - head);
+    put32(buf.data(), head + 4, CHANNEL_ID_FLAG | CHANNEL_BUNDLE_ID);
+}
+
+void Connection::sendBytes(const char *sendBuf, int sendSize)
+{
     int sendPos = 0;
     while(sendPos < sendSize){
         size_t ret = write(connectedSocket, sendBuf + sendPos, sendSize - sendPos);
@@ -489,17 +595,54 @@ void Connection::recvMessage()
     char lenBuf[4];
     recvBytes(lenBuf, 4);
     int msgLength = get32(lenBuf, 0);
-    if(msgLength < 16 || msgLength > 1024 * 1024) {
-        logh("connection", error) << "msgLength:" << msgLength << " < 16" <<std::endl;
+    if(msgLength < 8 || msgLength > 1024 * 1024) {
+        logh("connection", error) << "msgLength:" << msgLength << " out of range" <<std::endl;
         throw ConnectionAbort();
     }
     //receive message
     char buf[msgLength];
     put32(buf, 0, msgLength);
     recvBytes(buf + 4, msgLength - 4);
-    //unpack message
-    Message msg(buf);
-    logh("connection", trace) << "received a message len:" << msg.getSize() << std::endl;
+    uint32_t chanField = get32(buf, 4);
+    if(!(chanField & CHANNEL_ID_FLAG)){
+        //unpack message
+        Message msg(buf);
+        logh("connection", trace) << "received a message len:" << msg.getSize() << std::endl;
+        recvQueue.push(msg);
+        return;
+    }
+    uint32_t id = chanField & ~CHANNEL_ID_FLAG;
+    if(id == CHANNEL_BIND_ID){
+        std::string chan(buf + 12, msgLength - 12);
+        recvNames[get32(buf, 8)] = chan;
+        logh("connection", debug) << "peer bound channel:" << chan << " id:" << get32(buf, 8) << std::endl;
+        return;
+    }
+    if(id == CHANNEL_BUNDLE_ID){
+        int pos = 8;
+        while(pos + 8 <= msgLength){
+            int length = get32(buf, pos + 4);
+            if(pos + 8 + length > msgLength){
+                logh("connection", error) << "bundle record exceeds the message" << std::endl;
+                throw ConnectionAbort();
+            }
+            recvRecord(get32(buf, pos), buf + pos + 8, length);
+            pos += 8 + length;
+        }
+        return;
+    }
+    recvRecord(id, buf + 8, msgLength - 8);
+}
+
+void Connection::recvRecord(uint32_t id, const char *payload, int length)
+{
+    auto it = recvNames.find(id);
+    if(it == recvNames.end()){
+        logh("connection", error) << "message for unbound channel id:" << id << std::endl;
+        throw ConnectionAbort();
+    }
+    Message msg(it->second, payload, length);
+    logh("connection", trace) << "received a message len:" << msg.getIdSize() << std::endl;
     recvQueue.push(msg);
 }
 
@@ -510,7 +653,8 @@ Control::Control() :
     nowAt(0),
     tickPeriod(MHz),
     profileCycle(5.0), //seconds
-    profileLastSim(0)
+    profileLastSim(0),
+    bundleSize(0)
 {
     connection = new Connection();
     time(&profileLastWall);
@@ -615,6 +759,15 @@ void Control::ctrlProcess(Message &msg) {
             logh("control", info) << "Control received set command" << std::endl;
             setConfig(msg);
             break;
+        case Command::hello: {
+            logh("control", debug) << "Control received hello command" << std::endl;
+            Message hello("ctrl", 8);
+            put32(hello.getData(), 0, (uint32_t)Command::hello);
+            put32(hello.getData(), 4, PROTOCOL_VERSION);
+            push(hello);
+            //the peer reads ids any time, so they may be used before the answer is out
+            connection->setPeerVersion(get32(data, 4));
+        } break;
         default:
             logh("control", warning) << "SimControl received unknown command:" << cmd <<std::endl;
     }
@@ -633,10 +786,14 @@ void Control::dispatchRun()
 }
 
 void Control::reportTime(uint64_t tme) {
+    //a time step ends - its messages go out before anything reports the new time
+    if(tme != nowAt)
+        flush();
     nowAt = tme;
 }
 
 void Control::shutdown() {
+    flush();
     //send exit message
     Message msg("ctrl", 4);
     put32(msg.getData(), 0, (uint32_t)Command::shutdown);
@@ -657,6 +814,7 @@ bool Control::checkBreak(BreakType typ, bool doLock) {
             if(it->thresh < nowAt)
                 it->thresh = nowAt;
             it->ack = true;
+            flush();
             logh("control", debug) << "ack break:" << it->id << " @:" << chomp(it->thresh) 
             << " typ:" << it->type << std::endl;
             Message msg("ctrl", 17);
@@ -672,6 +830,7 @@ bool Control::checkBreak(BreakType typ, bool doLock) {
                 logh("control", info) << "hitting break:" << it->id << " @:" << chomp(nowAt) <<
                 " thresh:" << chomp(it->thresh) << std::endl;
                 it->hit = true;
+                flush();
                 Message msg("ctrl", 17);
                 put32(msg.getData(), 0, (uint32_t)Command::hitBreak);
                 put32(msg.getData(), 4, it->id);
@@ -687,6 +846,7 @@ bool Control::checkBreak(BreakType typ, bool doLock) {
 void Control::waitHold() {
     std::unique_lock<std::mutex> lock(breakMutex);
     while(checkBreak(BreakType::hold, false)){
+        flush();
         if(!breakCond.wait_for(lock, std::chrono::milliseconds(2000), [this]() {
                 return !checkBreak(BreakType::hold, false); }))
             logh("control", info) << "holding..." << std::endl;
@@ -720,6 +880,28 @@ void Control::push(Message &msg) {
     connection->push(msg);
 }
 
+void Control::record(Message &msg) {
+    std::unique_lock<std::mutex> lock(bundleMutex);
+    bundleSize += msg.getLength();
+    bundle.push_back(std::move(msg));
+    if(bundleSize >= BUNDLE_SIZE){
+        Message msg(std::move(bundle));
+        bundle.clear();
+        bundleSize = 0;
+        connection->push(msg);
+    }
+}
+
+void Control::flush() {
+    std::unique_lock<std::mutex> lock(bundleMutex);
+    if(bundle.empty())
+        return;
+    Message msg(std::move(bundle));
+    bundle.clear();
+    bundleSize = 0;
+    connection->push(msg);
+}
+
 bits::bits(const char *raw) {
     uint16_t size = get16(raw, 0);
     for(int i = 0; i < size; i++){
@@ -797,8 +979,11 @@ Player::Player(std::string &chan, bits &reset, bool sync, bool cycl):
 
 void Player::updateNext(bool block, int timeout) {
     bool empty = queue.empty();
-    if(empty && block)
+    if(empty && block){
+        //the answer may depend on what was recorded
+        Control::getInst().flush();
         empty = !queue.wait(timeout);
+    }
     if(!empty){
         Message msg = queue.pop();
         parseMessage(msg, 0);
@@ -908,7 +1093,7 @@ bool Recorder::put(simTime curr, bits val, bool sync, bool force) {
     change ch(now, cycles, val, sync);
     Message msg(channel, ch.rawSize());
     ch.rawDump(msg.getData());
-    Control::getInst().push(msg);
+    Control::getInst().record(msg);
     return true;
 };
 
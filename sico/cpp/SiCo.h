@@ -24,6 +24,8 @@
 #include <condition_variable>
 #include <thread>
 #include <list>
+#include <vector>
+#include <atomic>
 
 namespace SiCo {
 
@@ -105,18 +107,34 @@ struct ConnectionAbort : public std::exception {
 struct TimedOut : public std::exception {
 };
 
+//wire protocol version - 2: channel ids instead of names, 3: bundles
+const uint32_t PROTOCOL_VERSION = 3;
+//set in the channel length field of a frame that carries a channel id instead of a name
+const uint32_t CHANNEL_ID_FLAG = 1u << 31;
+//channel id of frames binding an id to a name - data: id(4), name
+const uint32_t CHANNEL_BIND_ID = 0;
+//channel id of frames bundling the messages of many channels - data: records of id(4), length(4), data
+const uint32_t CHANNEL_BUNDLE_ID = CHANNEL_ID_FLAG - 1;
+//size at which the recorded messages are sent
+const size_t BUNDLE_SIZE = 64 * 1024;
+
 //message passed over a comm socket
 class Message {
     std::string channel;    //the SiCo channel this message is for
     int         dataLength; //length of payload
     char *      data;       //payload
+    std::vector<Message> records; //messages of a bundle
 public:
     //create message from binary buffer
     Message(const char *raw);
+    //create message of a channel from a payload buffer
+    Message(const std::string &chan, const char *payload, int length);
     //create empty message
     Message(std::string channel, int length);
     //create empyt message with no channel
     Message(int length);
+    //create a bundle of messages
+    Message(std::vector<Message> &&recs);
     //move constructor
     Message(Message && o);
     ~Message();
@@ -124,9 +142,16 @@ public:
     size_t          getSize() { return dataLength + 8 + channel.length(); };
     //write message into binary buffer of size returned by getSize()
     void            pack(char *buffer);
+    //get the binary buffer size needed to hold this message with a channel id
+    size_t          getIdSize() { return dataLength + 8; };
+    //write message with a channel id into binary buffer of size returned by getIdSize()
+    void            packId(char *buffer, uint32_t id);
+    int             getLength() { return dataLength; };
     std::string &   getChannel() { return channel; };
     char *          getData() { return data; };
     void            setChannel(const std::string &chan) { channel = chan; };
+    bool            isBundle() { return !records.empty(); };
+    std::vector<Message> & getRecords() { return records; };
 };
 
 //thread safe message queue
@@ -157,6 +182,9 @@ class Connection {
     int                     connectedTerm;
     bool                    running;
     bool                    draining;
+    std::atomic<uint32_t>   peerVersion;    //protocol version agreed with the peer - per connection
+    std::map<std::string, uint32_t> sendIds;    //channel name -> id bound by us (send thread)
+    std::map<uint32_t, std::string> recvNames;  //channel id -> name bound by the peer (recv thread)
     std::mutex              connectedMutex;
     std::condition_variable connectedCond;
 
@@ -171,12 +199,19 @@ public:
                 Connection();
     Message     pop();
     void        push(Message &msg);
+    //the peer announced its protocol version (hello)
+    void        setPeerVersion(uint32_t version);
 private:
     void        runConn();
     void        runSend();
     void        runRecv();
     void        sendMessage();
+    void        sendBytes(const char *buf, int amount);
+    uint32_t    bindId(const std::string &chan, std::vector<char> &buf);
+    void        encodeMessage(Message &msg, std::vector<char> &buf);
+    void        encodeBundle(Message &msg, std::vector<char> &buf);
     void        recvMessage();
+    void        recvRecord(uint32_t id, const char *payload, int length);
     void        recvBytes(char *buf, int amount);
 };
 
@@ -190,6 +225,7 @@ enum Command {
     remBreak = 6,   //remove a break threshhold
     ackBreak = 7,   //acknowledge the break
     hitBreak = 8,   //break was hit
+    hello = 9,      //protocol version handshake
 };
 
 // python <---> sinmulator
@@ -202,6 +238,14 @@ enum Command {
 
 // Shutdown - Close connection (last message on a socket)
 
+// Hello - protocol version handshake, sent by python on every new connection
+//   hello ->    (version:int)
+//   <- hello    (version:int)
+//   both sides use the smaller version, a peer not knowing hello never answers (version 1)
+//   version 2: channels are sent as ids, an id is bound by a frame with id CHANNEL_BIND_ID
+//              before its first use, each side binds the ids of the messages it sends
+//   version 3: many messages are sent in one frame with id CHANNEL_BUNDLE_ID
+
 // Set - set a config value
 //   set ->    (key:string, ...)
 //   set ->    loglevel(scope:str, level:int)
@@ -247,11 +291,14 @@ class Control {
     //
     bool                inShutdown;
     std::map<std::string, MessageQueue> channels;
+    std::vector<Message> bundle;        //recorded messages not sent yet
+    size_t              bundleSize;     //payload bytes in bundle
 
                         Control();
     //mutex
     std::mutex          channelMutex;
     std::mutex          breakMutex;
+    std::mutex          bundleMutex;
     std::condition_variable breakCond;
 
     std::thread         ctrlThread;
@@ -283,6 +330,10 @@ public:
     void                waitHold();
     void                profile(); //if enabled print profiling information
     void                push(Message &msg);
+    //send a message with the others recorded in the same time step
+    void                record(Message &msg);
+    //send the recorded messages - before the simulation waits or reports something
+    void                flush();
 
     //class managent
     static Control &    getInst(){ return inst; };
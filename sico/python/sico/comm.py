@@ -12,10 +12,12 @@
 from __future__ import annotations
 from enum import Enum
 import logging
+import struct
 import threading
+from typing import Callable
 import weakref
 
-from choc.pipe import Item, Gate, PipeOffband
+from choc.pipe import Buffer, Item, PipeOffband
 from choc.types import Bits, Change, Tme, MEGA
 import choc
 from bilib.fn import etype
@@ -31,22 +33,41 @@ class SimFinished(Exception):
 
 class Message:
     channel:str
-    data:bytes
+    data:bytes|memoryview
     BASE_LENGTH = 8 #message length + channel length
-
-    def __init__(self, channel:str=None, data:bytes= None):
-        etype((channel, (str, None)), (data, (bytes, None)))
+    HEADER = struct.Struct(">II") #message length, channel length
+    ID_FLAG = 1 << 31 #set in the channel length field if the frame carries a channel id instead of a name
+    BIND_ID = 0 #channel id of frames binding an id to a name
+    BUNDLE_ID = ID_FLAG - 1 #channel id of frames bundling the messages of many channels
+    RECORD = struct.Struct(">II") #channel id, data length - of a message in a bundle
+    BUNDLE_BYTES = 1 << 16 #size at which a bundle is closed
+
+    def __init__(self, channel:str=None, data:bytes|memoryview=None):
+        etype((channel, (str, None)), (data, (bytes, memoryview, None)))
         self.channel = channel
         self.data = data
 
+    #parses a whole message - the data is a view into raw, not a copy
     @classmethod
-    def fromBytes(cls, raw:bytes) -> Message:
+    def fromBytes(cls, raw:bytes|memoryview) -> Message:
+        raw = memoryview(raw)
         #raw[0:4] msgLength
-        chanLength = int.from_bytes(raw[4:8], 'big')
-        #channel
-        channel = raw[8:8+chanLength].decode('utf-8')
-        data = raw[8+chanLength:]
-        return Message(channel, data)
+        _, chanLength = cls.HEADER.unpack_from(raw)
+        return cls.fromBody(raw[cls.BASE_LENGTH:], chanLength)
+
+    #unchecked constructor for internal use
+    @classmethod
+    def _make(cls, channel:str, data:bytes|memoryview) -> Message:
+        msg = object.__new__(cls)
+        msg.channel = channel
+        msg.data = data
+        return msg
+
+    #parses the part of a message after the header
+    @classmethod
+    def fromBody(cls, body:memoryview, chanLength:int) -> Message:
+        channel = str(body[:chanLength], 'utf-8')
+        return cls._make(channel, body[chanLength:])
 
     #message format:
     # offset | size     | description
@@ -54,17 +75,127 @@ class Message:
     # 4      | 4        | channel length (n)
     # 8      | n        | channel name
     # 8+n    | m-n-8    | data
-    def toBytes(self) -> bytes:
-        chanBytes = self.channel.encode('utf-8')
-        chanLength = len(chanBytes)
+    #with a channel id (protocol version 2):
+    # 0      | 4        | message length (m)
+    # 4      | 4        | ID_FLAG | channel id
+    # 8      | m-8      | data
+    #a bundle (protocol version 3) has the channel id BUNDLE_ID and a record for each message as data:
+    # 0      | 4        | channel id
+    # 4      | 4        | data length (n)
+    # 8      | n        | data
+    # the parts of the message - to be sent without joining them (writelines)
+    def toFrames(self, cid:int=None) -> list[bytes]:
         dataLength = len(self.data) if self.data else 0
-        msgLength = self.BASE_LENGTH + chanLength + dataLength
-        ret = msgLength.to_bytes(4, 'big')
-        ret += chanLength.to_bytes(4, 'big')
-        ret += chanBytes
-        if self.data:
-            ret += self.data
-        return ret
+        if cid is None:
+            chanBytes = self.channel.encode('utf-8')
+            head = self.HEADER.pack(self.BASE_LENGTH + len(chanBytes) + dataLength, len(chanBytes)) + chanBytes
+        else:
+            head = self.HEADER.pack(self.BASE_LENGTH + dataLength, self.ID_FLAG | cid)
+        return [head, self.data] if dataLength else [head]
+
+    #the frame binding a channel id to a name - data: id(4), name
+    @classmethod
+    def bindFrame(cls, cid:int, channel:str) -> bytes:
+        chanBytes = channel.encode('utf-8')
+        head = cls.HEADER.pack(cls.BASE_LENGTH + 4 + len(chanBytes), cls.ID_FLAG | cls.BIND_ID)
+        return head + cid.to_bytes(4, 'big') + chanBytes
+
+    #the parts of a bundle frame of (channel id, message) records
+    @classmethod
+    def bundleFrames(cls, records:list[tuple[int,Message]]) -> list[bytes]:
+        frames = [None]
+        size = cls.BASE_LENGTH
+        for cid, msg in records:
+            data = msg.data or b""
+            frames.append(cls.RECORD.pack(cid, len(data)))
+            frames.append(data)
+            size += cls.RECORD.size + len(data)
+        frames[0] = cls.HEADER.pack(size, cls.ID_FLAG | cls.BUNDLE_ID)
+        return frames
+
+    def toBytes(self) -> bytes:
+        return b"".join(self.toFrames())
+
+    #the frames of the messages for a peer of a protocol version
+    # from version 2 channels are sent as ids - ids maps names to the ids bound so far, new ones are bound on first use
+    # version 3 gets the messages in bundles of up to BUNDLE_BYTES
+    @classmethod
+    def encodeMany(cls, msgs:list[Message], version:int, ids:dict[str,int]) -> list[bytes]:
+        frames = []
+        if version < 2:
+            for msg in msgs:
+                frames += msg.toFrames()
+            return frames
+        bundle = []
+        size = 0
+        for msg in msgs:
+            cid = ids.get(msg.channel)
+            if cid is None:
+                cid = ids[msg.channel] = len(ids) + 1
+                frames.append(cls.bindFrame(cid, msg.channel))
+            if version < 3 or len(msgs) == 1:
+                frames += msg.toFrames(cid)
+                continue
+            bundle.append((cid, msg))
+            size += msg.nBytes()
+            if size >= cls.BUNDLE_BYTES:
+                frames += cls.bundleFrames(bundle)
+                bundle = []
+                size = 0
+        if bundle:
+            frames += cls.bundleFrames(bundle)
+        return frames
+
+    #parses all complete messages at the front of raw - returns them and the incomplete rest
+    # the message data are views into raw
+    # names maps the channel ids of the peer to names, bind frames are added to it
+    @classmethod
+    def splitFrames(cls, raw:bytes, names:dict[int,str]=None) -> tuple[list[Message], bytes]:
+        view = memoryview(raw)
+        unpack = cls.HEADER.unpack_from
+        make = cls._make
+        msgs = []
+        end = len(raw)
+        pos = 0
+        while end - pos >= cls.BASE_LENGTH:
+            size, chanLength = unpack(view, pos)
+            if end - pos < size:
+                break
+            if chanLength & cls.ID_FLAG:
+                cid = chanLength ^ cls.ID_FLAG
+                data = pos + cls.BASE_LENGTH
+                if cid == cls.BIND_ID:
+                    bound = int.from_bytes(view[data:data+4], 'big')
+                    names[bound] = str(view[data+4:pos+size], 'utf-8')
+                elif cid == cls.BUNDLE_ID:
+                    while data < pos + size:
+                        cid, length = unpack(view, data)
+                        data += cls.RECORD.size
+                        msgs.append(make(cls.boundName(names, cid), view[data:data+length]))
+                        data += length
+                else:
+                    msgs.append(make(cls.boundName(names, cid), view[data:pos+size]))
+            else:
+                data = pos + cls.BASE_LENGTH + chanLength
+                msgs.append(make(str(view[data-chanLength:data], 'utf-8'), view[data:pos+size]))
+            pos += size
+        return msgs, raw[pos:]
+
+    @staticmethod
+    def boundName(names:dict[int,str], cid:int) -> str:
+        try:
+            return names[cid]
+        except KeyError:
+            #like the simulator, a connection that sends garbage is dropped (and established again)
+            raise ConnectionResetError(f"message for unbound channel id:{cid}") from None
+
+    #the number of bytes missing to complete the first message of raw (0 if the header is incomplete)
+    @classmethod
+    def missing(cls, raw:bytes) -> int:
+        if len(raw) < cls.BASE_LENGTH:
+            return 0
+        size, _ = cls.HEADER.unpack_from(raw)
+        return max(size - len(raw), 0)
 
     def __str__(self):
         return f"Message({self.channel},len:{self.nBytes()})"
@@ -72,88 +203,218 @@ class Message:
     def nBytes(self) -> int:
         return self.BASE_LENGTH + len(self.channel) + len(self.data)
 
+#the socket end of a connection
+# the socket is read into a preallocated buffer and the messages are parsed in place
+# payloads up to COPY_BYTES are copied out, larger ones stay views into the buffer
+# the buffer is reused unless such a view keeps it alive (or a message does not fit), the incomplete rest moves to the front
+# while the buffer is full (the receiver is behind) the transport stops reading
+class SocketProtocol(asyncio.BufferedProtocol):
+    COPY_BYTES = 1 << 12
+
+    def __init__(self, size:int):
+        etype((size, int))
+        self.size = size
+        self.buffer = memoryview(bytearray(size))
+        self.end = 0 #bytes received into buffer
+        self.transport = None
+        self.paused = False
+        self.closed = False
+        self.received = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport:asyncio.Transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint:int) -> memoryview:
+        return self.buffer[self.end:]
+
+    def buffer_updated(self, nbytes:int):
+        self.end += nbytes
+        self.received.set()
+        if self.end == len(self.buffer):
+            self.transport.pause_reading()
+            self.paused = True
+
+    def eof_received(self) -> bool:
+        self.closed = True
+        self.received.set()
+        return False
+
+    def connection_lost(self, exc:Exception):
+        self.closed = True
+        self.received.set()
+        self.writable.set()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    #waits while the transport holds more than its high water mark
+    async def ccDrain(self):
+        await self.writable.wait()
+        if self.closed:
+            raise ConnectionResetError("connection lost")
+
+    #waits for data and returns the messages it completes (might be none)
+    async def ccRecv(self, names:dict[int,str]) -> list[Message]:
+        if not self.closed:
+            await self.received.wait()
+            self.received.clear()
+        msgs, rest = Message.splitFrames(self.buffer[:self.end], names)
+        shared = False
+        for msg in msgs:
+            if len(msg.data) <= self.COPY_BYTES:
+                msg.data = msg.data.tobytes()
+            else:
+                shared = True
+        full = len(rest) == len(self.buffer)
+        #without messages the rest is already at the front
+        if msgs or full:
+            rest = rest.tobytes()
+            #a new buffer if the old one is referenced by the messages or is too small for the next one
+            if shared or full:
+                self.buffer = memoryview(bytearray(max(self.size, len(rest) + Message.missing(rest))))
+            self.buffer[:len(rest)] = rest
+            self.end = len(rest)
+        if self.paused:
+            self.paused = False
+            self.transport.resume_reading()
+        if self.closed and not msgs:
+            raise asyncio.IncompleteReadError(bytes(rest), None)
+        return msgs
+
 class Connection:
     DEFAULT_SOCK_NAME = "SiCo.sock"
     logName = "SiCoConnection"
     CONN_ABORT_EXCEPT = (BrokenPipeError, ConnectionResetError, asyncio.IncompleteReadError)
-    def __init__(self):
+    PIPE_DEPTH = 64 #messages (receiving: batches of messages) buffered between the socket and the dispatcher/sender
+    RECV_CHUNK = 1 << 16 #size of the receive buffer
+    SEND_BYTES = 1 << 16 #bytes coalesced into one write
+    HIGH_WATER = 1 << 20 #transport buffer size at which the sender blocks
+    LOW_WATER = 1 << 18  #transport buffer size at which a blocked sender continues
+    VERSION = 3 #wire protocol version - 2: channel ids instead of names, 3: bundles
+    #sendDelay - time (seconds) the sender waits for more messages if a write is not full (0: send what is queued)
+    #dispatch - called by the receiver with every batch of received messages, without it the batches go to recvPipe
+    def __init__(self, shard:int=None, sendBytes:int=SEND_BYTES, sendDelay:float=0, highWater:int=HIGH_WATER, lowWater:int=LOW_WATER, dispatch:Callable=None):
+        etype((shard, (int,None)), (sendBytes, int), (sendDelay, (int,float)), (highWater, int), (lowWater, int), (dispatch, (Callable,None)))
+        assert 0 <= lowWater <= highWater, "water marks must satisfy 0 <= low <= high"
         super().__init__()
+        self.shard = choc.currentShard() if shard is None else shard
+        self.sendBytes = sendBytes
+        self.sendDelay = sendDelay
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.dispatch = dispatch
+        self.peerVersion = 1 #protocol version agreed with the simulator - per connection
+        self.sendIds = {}    #channel name -> id bound by us
+        self.recvNames = {}  #channel id -> name bound by the simulator
         self.socketName = self.DEFAULT_SOCK_NAME
         self.connected = asyncio.Event()
         self.connMutex = asyncio.Lock()
         self.connCond = asyncio.Condition(self.connMutex)
         self.connEst = 0    #number of the last established connection 
         self.connTerm = 0   #number of the last terminated connection
-        self.connReader = None
-        self.connWriter = None
-        self.recvPipe = Gate(f"{self.logName}.recvPipe")
-        self.sendPipe = Gate(f"{self.logName}.sendPipe")
-        choc.submit(self.ccRunConnect(), f"{self.logName}~ccRunConnect")
-        choc.submit(self.ccRunSend(), f"{self.logName}~ccRunSend")
-        choc.submit(self.ccRunRecv(), f"{self.logName}~ccRunRecv")
+        self.socketTransport = None
+        self.socketProtocol = None
+        self.recvPipe = Buffer(f"{self.logName}.recvPipe", self.PIPE_DEPTH) if dispatch is None else None
+        self.sendPipe = Buffer(f"{self.logName}.sendPipe", self.PIPE_DEPTH)
+        choc.submit(self.ccRunConnect(), f"{self.logName}~ccRunConnect", self.shard)
+        choc.submit(self.ccRunSend(), f"{self.logName}~ccRunSend", self.shard)
+        choc.submit(self.ccRunRecv(), f"{self.logName}~ccRunRecv", self.shard)
 
     async def ccRunConnect(self):
         log = logging.getLogger(self.logName)
+        loop = asyncio.get_running_loop()
         while True:
             log.info("open UNIX socket")
             while True:
                 try:
-                    reader, writer = await asyncio.open_unix_connection(self.socketName)
+                    transport, protocol = await loop.create_unix_connection(lambda: SocketProtocol(self.RECV_CHUNK), self.socketName)
                     break
                 except (ConnectionRefusedError, FileNotFoundError):
                     await asyncio.sleep(1)
             #connection established
             log.info("connection established")
+            transport.set_write_buffer_limits(self.highWater, self.lowWater)
             async with self.connCond:
-                self.socketReader = reader
-                self.socketWriter = writer
+                self.socketTransport = transport
+                self.socketProtocol = protocol
+                self.peerVersion = 1
                 self.connEst += 1
                 self.connCond.notify_all()
             self.connected.set()
+            #a simulator knowing a newer protocol answers, older ones ignore it
+            await self.sendPipe.push(Message(Control.SC_CHAN, Command.hello.toBytes() + self.VERSION.to_bytes(4, 'big')))
             async with self.connCond:
                 await self.connCond.wait_for(lambda: self.connEst <= self.connTerm)
-                self.socketWriter.close()
+                self.socketTransport.close()
             log.info("connection terminated - again...")
             self.connected.clear()
 
+    #pushes all messages completed by the data received so far as one batch
     async def ccRunRecv(self):
         log = logging.getLogger(self.logName)
         connCurr = 0
         while True:
             async with self.connCond:
                 await self.connCond.wait_for(lambda: self.connEst > self.connTerm)
+                if connCurr != self.connEst:
+                    self.recvNames = {}
                 connCurr = self.connEst
-                reader = self.socketReader
+                protocol = self.socketProtocol
             try:
-                log.log(5, "receiving a message...")
-                raw = await reader.readexactly(4)
-                size = int.from_bytes(raw, 'big')
-                raw += await reader.readexactly(size-4)
-                msg = Message.fromBytes(raw)
-                assert isinstance(msg, Message)
-                log.log(5, f"message received:{msg} raw:{raw}")
-                await self.recvPipe.push(msg)
+                log.log(5, "receiving messages...")
+                msgs = await protocol.ccRecv(self.recvNames)
+                if not msgs:
+                    continue
+                log.log(5, f"messages received:{len(msgs)}")
+                if self.dispatch is None:
+                    await self.recvPipe.push(msgs)
+                else:
+                    self.dispatch(msgs)
             except self.CONN_ABORT_EXCEPT:
                 log.info("reader failt read")
                 async with self.connCond:
                     self.connTerm = connCurr
                     self.connCond.notify_all()
 
+    #collects the queued messages for one write - up to sendBytes, waiting at most sendDelay for more
+    async def ccCollect(self) -> list[Message]:
+        msgs = await self.sendPipe.pullMany(self.PIPE_DEPTH)
+        size = sum(msg.nBytes() for msg in msgs)
+        delayed = not self.sendDelay
+        while size < self.sendBytes:
+            more = await self.sendPipe.pullMany(self.PIPE_DEPTH, wait=False)
+            if not more:
+                if delayed:
+                    break
+                await asyncio.sleep(self.sendDelay)
+                delayed = True
+            msgs += more
+            size += sum(msg.nBytes() for msg in more)
+        return msgs
+
+    #sends the queued messages with one write per loop iteration
+    # drain blocks while the transport holds more than highWater bytes - that throttles the senders through sendPipe
     async def ccRunSend(self):
         log = logging.getLogger(self.logName)
         connCurr = 0
         while True:
-            msg = await self.sendPipe.pull()
+            msgs = await self.ccCollect()
             async with self.connCond:
                 await self.connCond.wait_for(lambda: self.connEst > self.connTerm)
+                if connCurr != self.connEst:
+                    self.sendIds = {}
                 connCurr = self.connEst
-                writer = self.socketWriter
+                transport = self.socketTransport
+                protocol = self.socketProtocol
             try:
-                log.log(5, f"sending a message... {msg}")
-                raw = msg.toBytes()
-                log.log(5, f"raw len:{len(raw)} message:{raw}")
-                writer.write(raw)
-                log.log(5, f"sent a message:{msg}")
+                log.log(5, f"sending messages:{len(msgs)}")
+                transport.writelines(Message.encodeMany(msgs, self.peerVersion, self.sendIds))
+                await protocol.ccDrain()
             except self.CONN_ABORT_EXCEPT:
                 log.info("reader failt read")
                 async with self.connCond:
@@ -170,6 +431,7 @@ class Command(Enum):
     remBreak = 6   #remove a break threshhold
     ackBreak = 7   #acknowledge the break
     hitBreak = 8   #break was hit
+    hello = 9      #protocol version handshake
 
     def toBytes(self) -> bytes:
         return self.value.to_bytes(4, 'big')
@@ -204,7 +466,7 @@ class Break:
         self.type = type
         self.hit = asyncio.Event() #set when the break was hit -> stopped set
         self.ack = asyncio.Event() #set when the break was acknoledged -> thresh set
-        choc.submit(self.ccRequest(), "Break~ccRequest")
+        choc.submit(self.ccRequest(), "Break~ccRequest", ctrl.shard)
 
     def __repr__(self) -> str:
         msg = f"Break("
@@ -251,13 +513,13 @@ class Break:
         return self.thresh
 
     def getStopped(self) -> Tme:
-        return choc.call(self.ccGetStopped(), "Break~ccGetStopped")
+        return choc.call(self.ccGetStopped(), "Break~ccGetStopped", shard=self.ctrl.shard)
     
     def getPromised(self) -> Tme:
-        return choc.call(self.ccGetPromised(), "Break~ccGetPromised")
+        return choc.call(self.ccGetPromised(), "Break~ccGetPromised", shard=self.ctrl.shard)
 
     def release(self):
-        choc.call(self.ccRelease(), "Break~ccRelease")
+        choc.call(self.ccRelease(), "Break~ccRelease", shard=self.ctrl.shard)
 
     def setAck(self, time:Tme):
         self.thresh = time
@@ -279,7 +541,7 @@ class Wait:
             self.thresh = time
         self.hitTime = None
         self.hit = asyncio.Event()
-        choc.submit(self.ccRegister(), "Wait~ccRegister")
+        choc.submit(self.ccRegister(), "Wait~ccRegister", ctrl.shard)
 
     async def ccRegister(self):
         self.ctrl.waits.append(self)
@@ -289,16 +551,18 @@ class Wait:
         return self.hitTime
 
     def wait(self) -> Tme:
-        return choc.call(self.ccWait(), "Wait~ccWait")
+        return choc.call(self.ccWait(), "Wait~ccWait", shard=self.ctrl.shard)
 
 class Control:
     SSC_LOGLEVEL = "loglevel"
     SC_CHAN = "ctrl"
     logName = "SiCoControl"
-    def __init__(self):
-        self.connection = Connection()
+    #the control and its channels run on one shard (default: the current one)
+    def __init__(self, shard:int=None):
+        self.shard = choc.currentShard() if shard is None else shard
+        self.connection = Connection(self.shard, dispatch=self.dispatch)
         self.recvQueues = {}
-        self.sendQueue = asyncio.Queue()
+        self.handlers = {} #channel name -> handler called with each message
         self.now = Tme.zero()
         self.breaks = {}
         self.waits = []
@@ -306,9 +570,7 @@ class Control:
         #self.isFinished = asyncio.Event()
         #self.isHolding = asyncio.Event()
         self.shutdownRequest = asyncio.Event()
-        choc.submit(self.ccRunDispatch(), f"Control~ccRunDispatch")
-        choc.submit(self.ccRunSender(), f"Control~ccRunSender")
-        choc.submit(self.ccRunCtrl(), f"Control~ccRunCtrl")
+        choc.submit(self.ccRunCtrl(), f"Control~ccRunCtrl", self.shard)
 
     def getQueue(self, name:str) -> asyncio.Queue[Message]:
         try:
@@ -319,22 +581,42 @@ class Control:
             logging.getLogger(self.logName).debug(f"new channel:{name}")
             return chan
 
-    #push message to sendQueue
+    #push message to the connection - blocks while the connection is congested
     async def ccPush(self, msg:Message):
         log = logging.getLogger(self.logName)
-        await self.sendQueue.put(msg)
-        log.log(5, "pushed to send queue")
-
-    #the main dispatcher loop - sorts messages coming from the connection to recvQueues
-    async def ccRunDispatch(self):
-        log = logging.getLogger(self.logName)
-        log.debug("starting dispatcher task")
-        while True:
-            msg = await self.connection.recvPipe.pull()
-            assert isinstance(msg, Message), f"msg is not Message but:{type(msg)}"
-            que = self.getQueue(msg.channel)
-            await que.put(msg)
-            log.log(5, f"dispatched to channel:{msg.channel} message:{msg}")
+        await self.connection.sendPipe.push(msg)
+        log.log(5, "pushed to connections sendPipe")
+
+    async def ccPushMany(self, msgs:list[Message]):
+        await self.connection.sendPipe.pushMany(msgs)
+
+    #registers a handler for the messages of a channel - called by the receiver, so it must not block
+    # messages that arrived before are handed over right away
+    def register(self, name:str, handler:Callable[[Message],None]):
+        etype((name, str), (handler, Callable))
+        if name in self.handlers:
+            logging.getLogger(self.logName).warning(f"channel:{name} replaces its handler")
+        self.handlers[name] = handler
+        queue = self.recvQueues.pop(name, None)
+        while queue is not None and not queue.empty():
+            handler(queue.get_nowait())
+
+    #removes the handler of a channel if it is (still) the given one - later messages wait in a recvQueue again
+    def unregister(self, name:str, handler:Callable[[Message],None]):
+        etype((name, str), (handler, Callable))
+        if self.handlers.get(name) == handler:
+            del self.handlers[name]
+
+    #sorts a batch of received messages to the channel handlers - channels without one get a recvQueue
+    def dispatch(self, msgs:list[Message]):
+        handlers = self.handlers
+        for msg in msgs:
+            handler = handlers.get(msg.channel)
+            if handler is None:
+                #the channel queues are unbounded
+                self.getQueue(msg.channel).put_nowait(msg)
+            else:
+                handler(msg)
 
     #the command processor - processes messages from the recvQueue 'ctrl'
     async def ccRunCtrl(self):
@@ -346,16 +628,6 @@ class Control:
             msg = await queue.get()
             await self.ccProcess(msg)
 
-    #send messages from the sendQueue to the connection
-    async def ccRunSender(self):
-        log = logging.getLogger(self.logName)
-        log.debug("starting sender task")
-        while True:
-            msg = await self.sendQueue.get()
-            log.log(5, "took message from sendQueue")
-            await self.connection.sendPipe.push(msg)
-            log.log(5, "pushed message to connections sendPipe")
-
     #handles one control message
     async def ccProcess(self, msg):
         log = logging.getLogger(self.logName)
@@ -375,6 +647,10 @@ class Control:
             self.breaks[uid].setHit(Tme.fromBytes(msg.data[8:]))
         elif cmd == Command.shutdown:
             self.shutdownRequest.set()
+        elif cmd == Command.hello:
+            version = int.from_bytes(msg.data[4:8], 'big')
+            log.debug(f"simulator speaks protocol version:{version}")
+            self.connection.peerVersion = min(version, Connection.VERSION)
         else:
             log.warning(f"SimContol got unknown command {cmd}")
 
@@ -391,7 +667,7 @@ class Control:
 
     #wait for a simulator connection
     def simWaitConn(self):
-        choc.call(self.connection.connected.wait(), "simWaitConn")
+        choc.call(self.connection.connected.wait(), "simWaitConn", shard=self.shard)
 
     def checkWaits(self):
         newlist = []
@@ -426,10 +702,11 @@ class Control:
 class Channel(Item):
     def __init__(self, ctrl:Control, name:str, asyncSample:Tme=None):
         etype((ctrl, Control), (name, str), (asyncSample, (Tme, None)))
-        super().__init__(name)
+        super().__init__(name, ctrl.shard)
         self.name = name
         self.ctrl = ctrl
-        self.queue = ctrl.getQueue(name)
+        self.inbox = [] #payloads received since the last delivery
+        self.received = asyncio.Event()
         self.offset = None
         self.pos = Tme.zero()
         self.breakPoint = None
@@ -439,26 +716,38 @@ class Channel(Item):
         self.sampleLock = asyncio.Lock()
         self.itemAddSender("income", Change)
         self.itemAddReceiver("outgo", Change)
-        choc.submit(self.ccRunSend(), f"{self.name}~ccRunSend")
-        choc.submit(self.ccRunRecv(), f"{self.name}~ccRunRecv")
+        self.itemSubmit(self.ccRunSend(), f"{self.name}~ccRunSend")
+        self.recvTask = self.itemSubmit(self.ccRunRecv(), f"{self.name}~ccRunRecv")
         if self.sampleCycle:
-            choc.submit(self.ccRunSampler(), f"{self.name}~ccRunSampler")
+            self.itemSubmit(self.ccRunSampler(), f"{self.name}~ccRunSampler")
+
+    #handler of the control's dispatcher
+    def receive(self, msg:Message):
+        self.inbox.append(msg.data)
+        self.received.set()
 
+    #sends the changes queued on outgo together - the connection bundles them
     async def ccRunSend(self):
         sock = self.itemGet("outgo")
         log = logging.getLogger(self.name)
         while True:
-            chg:Change = await sock.recv()
-            if isinstance(chg, PipeOffband):
+            msgs = []
+            for chg in await sock.recvMany():
+                if not isinstance(chg, PipeOffband):
+                    msgs.append(self.toMessage(chg))
+                    continue
+                #offband values act between the changes before and after them
+                if msgs:
+                    await self.ctrl.ccPushMany(msgs)
+                    msgs = []
                 if chg == PipeOffband.PipeEnd:
-                    break
+                    return
                 elif chg == PipeOffband.FrameStart:
                     assert self.breakPoint is None, "Frame start! but frame already started"
                     self.breakPoint = self.ctrl.setHold(Tme.zero(), relative=True)
                     promise = await self.breakPoint.ccGetPromised() + self.breakMargin
                     self.offset = max(promise, self.pos)
                     log.debug(f"Frame start at:{self.offset}!")
-                    continue
                 elif chg == PipeOffband.FrameEnd:
                     assert self.breakPoint is not None, "Frame end! but no frame opened"
                     log.debug("try to release break")
@@ -466,38 +755,61 @@ class Channel(Item):
                     self.breakPoint = None
                     self.offset = None
                     log.debug(f"Frame stop at:{self.pos}!")
-                    continue
-                else:
-                    continue
-            assert isinstance(chg.value, Bits), f"channel:{self.name} must transport Bits, not:{type(chg.value)}"
-            if self.offset:
-                chg = chg.shifted(self.offset)
-                self.pos = chg.time
-            log.debug(f"Change:{chg} -> Simulator")
-            msg = Message(self.name, chg.toBytes())
-            await self.ctrl.ccPush(msg)
+            if msgs:
+                await self.ctrl.ccPushMany(msgs)
+
+    def toMessage(self, chg:Change) -> Message:
+        assert isinstance(chg.value, Bits), f"channel:{self.name} must transport Bits, not:{type(chg.value)}"
+        if self.offset:
+            chg = chg.shifted(self.offset)
+            self.pos = chg.time
+        logging.getLogger(self.name).debug(f"Change:{chg} -> Simulator")
+        return Message(self.name, chg.toBytes())
+
+    #stops receiving - the control keeps the later messages of the channel in a recvQueue
+    async def ccClose(self):
+        self.ctrl.unregister(self.name, self.receive)
+        task = self.recvTask.task
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def close(self):
+        self.itemCall(self.ccClose(), f"{self.name}~close")
 
     async def ccRunRecv(self):
         sock = self.itemGet("income")
         log = logging.getLogger(self.name)
-        while True:
-            msg = await self.queue.get()
-            self.sample = Change.fromBytes(msg.data, Bits)
-            if self.sample.sync:
-                chg = self.sample
-            else:
-                chg = Change(self.sample.value, self.sample.time)
-            log.debug(f"Simulator -> {self.sample} -> Change:{chg}")
-            await sock.send(chg)
+        #registered from the loop - messages received before wait in a recvQueue
+        self.ctrl.register(self.name, self.receive)
+        try:
+            while True:
+                await self.received.wait()
+                self.received.clear()
+                payloads, self.inbox = self.inbox, []
+                chgs = []
+                #the lock keeps the sampler from sending between the changes of the batch
+                async with self.sampleLock:
+                    for data in payloads:
+                        self.sample = Change.fromBytes(data, Bits)
+                        if self.sample.sync:
+                            chgs.append(self.sample)
+                        else:
+                            chgs.append(Change(self.sample.value, self.sample.time))
+                    log.log(5, f"Simulator -> Changes:{len(chgs)}")
+                    await sock.sendMany(chgs)
+        finally:
+            self.ctrl.unregister(self.name, self.receive)
 
     async def ccRunSampler(self):
         log = logging.getLogger(self.name)
         sock = self.itemGet("income")
         while True:
             sTime = self.ctrl.now - self.sampleCycle #time we want to synthesize a sample
-            if self.sample is not None and not self.sample.sync and sTime > self.sample.time:
-                chg = Change(self.sample.value, sTime)
-                #log.debug(f"Simulator -> Sample:{self.sample} -> Change:{chg}")
-                await sock.send(chg)
+            async with self.sampleLock:
+                if self.sample is not None and not self.sample.sync and sTime > self.sample.time:
+                    chg = Change(self.sample.value, sTime)
+                    #log.debug(f"Simulator -> Sample:{self.sample} -> Change:{chg}")
+                    await sock.send(chg)
             wait = self.ctrl.setWait(self.sampleCycle)
             await wait.ccWait()
@@ -0,0 +1,63 @@
+////    ////////////    Copyright (C) 2025 Mattis Hasler, Barkhausen Institut
+////    ////////////    
+////                    This source describes Open Hardware and is licensed under the
+////                    CERN-OHL-W v2 (https://cern.ch/cern-ohl)
+////////////    ////    
+////////////    ////    
+////    ////    ////    
+////    ////    ////    
+////////////            Authors:
+////////////            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
+
+
+//exchanges bundles with tests/test_comm.py - no simulator involved
+// waits for one change on "loopback", then records <count> values on 16 channels in one time step
+// (so the bundles are split at BUNDLE_SIZE) and waits to get <count> changes back on "loopback"
+
+#include "SiCo.h"
+#include <iostream>
+#include <unistd.h>
+
+using namespace SiCo;
+
+const int CHANNELS = 16;
+
+int receive(Player &play, int count) {
+    int got = 0;
+    while(got < count){
+        bool valid = false;
+        try {
+            play.getNext(~0ull, &valid, 1000);
+        } catch(TimedOut &e) {
+            continue;
+        }
+        if(valid)
+            got++;
+    }
+    return got;
+}
+
+int main(int argc, char **argv) {
+    int count = atoi(argv[1]);
+    bits reset;
+    for(int b = 0; b < 16; b++)
+        reset.push_back(zero);
+    std::vector<Recorder *> recs;
+    for(int c = 0; c < CHANNELS; c++)
+        recs.push_back(new Recorder("ch" + std::to_string(c), reset, false));
+    std::string chan = "loopback";
+    Player play(chan, reset, true, false);
+    receive(play, 1);
+    Control::getInst().reportTime(1000);
+    for(int i = 1; i <= count; i++){
+        bits val;
+        for(int b = 0; b < 16; b++)
+            val.push_back((i >> b) & 1 ? one : zero);
+        for(auto rec : recs)
+            rec->put(1000 + i, val, true);
+    }
+    int got = receive(play, count);
+    std::cout << "received " << got << std::endl;
+    //the control threads do not end on their own
+    _exit(0);
+}
@@ -440,11 +440,22 @@ PLI_INT32 SiCoVpiRecorderInit(PLI_BYTE8 *)
     return 0;
 }
 
+//the changes recorded in the last time step are still in the bundle
+PLI_INT32 SiCoVpiEndOfSim(p_cb_data) {
+    SiCo::logh("VPI", SiCo::debug) << "end of simulation - flush recorded changes" << std::endl;
+    SiCo::Control::getInst().flush();
+    return 0;
+}
+
 void setup(void)
 {
     SiCo::logh("VPI", SiCo::trace) << "setup - force Control creation" << std::endl;
     SiCo::Control &ctrl = SiCo::Control::getInst();
     ctrl.profile(); //shut up the compiler warning that ctrl is not used
+    s_cb_data cb = {};
+    cb.reason = cbEndOfSimulation;
+    cb.cb_rtn = SiCoVpiEndOfSim;
+    vpi_register_cb(&cb);
 }
 
 //simTime now
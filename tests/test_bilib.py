@@ -0,0 +1,56 @@
+####    ############    Copyright (C) 2025 Mattis Hasler, Barkhausen Institut
+####    ############    
+####                    This source describes Open Hardware and is licensed under the
+####                    CERN-OHL-W v2 (https://cern.ch/cern-ohl)
+############    ####    
+############    ####    
+####    ####    ####    
+####    ####    ####    
+############            Authors:
+############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
+
+import unittest
+from bilib import fn
+from choc.types import Bits, Change, Tme
+
+class TestEtype(unittest.TestCase):
+    def tearDown(self):
+        fn.configure(typecheck="full")
+
+    def test_modes(self):
+        for mode in ("full", "cached"):
+            fn.configure(typecheck=mode)
+            self.assertTrue(fn.etype((1, int), (None, (str,None)), ([1,2], list, int), ({"a":1}, dict, str, int)))
+            self.assertTrue(fn.etype(([1,None], list, (int,None))))
+            with self.assertRaises(TypeError):
+                fn.etype((1, str))
+            with self.assertRaises(TypeError):
+                fn.etype(([1,"a"], list, int))
+            with self.assertRaises(TypeError):
+                fn.etype(({"a":"b"}, dict, str, int))
+            with self.assertRaises(ValueError):
+                fn.etype((1,))
+            self.assertFalse(fn.ctype((None, int)))
+        fn.configure(typecheck="off")
+        self.assertTrue(fn.etype((1, str)))
+
+    def test_configure(self):
+        fn.configure(typecheck="off")
+        fn.configure(typecheck="full")
+        with self.assertRaises(TypeError):
+            fn.etype((1, str))
+        fn.configure(typecheck="off")
+        fn.configure(typecheck="cached")
+        with self.assertRaises(TypeError):
+            fn.etype((1, str))
+        with self.assertRaises(ValueError):
+            fn.configure(typecheck="some")
+
+    def test_ctype(self):
+        chg = Change(5, Tme("1n"))
+        for mode in fn.TYPECHECK_MODES:
+            fn.configure(typecheck=mode)
+            self.assertFalse(fn.ctype((1, str)))
+            self.assertTrue(fn.ctype(([1], list, int)))
+            self.assertFalse(chg.isType(Bits))
+            self.assertTrue(chg.isType(int))
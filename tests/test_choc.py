@@ -9,37 +9,345 @@
 ############            Authors:
 ############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pickle
+import tempfile
 import time
 import unittest
-from choc.items import BitsToInt, Clock, Input, IntToBits, Output, Printer, Range, Signal
+import choc
+from choc.items import WRITE_QUEUE, BitsToInt, Clock, FileWriter, Input, IntToBits, Output, Printer, Probe, ProbeGroup, Range, Tee, TimedSignal, TimeMerge, ToFile, readRecords
 
 import logging
 
-from choc.types import Bits, Change, Tme, TmeType
+from choc.pipe import Buffer, Direction, Fuse, PipeOffband, Socket
+from choc.process import ProcessSegment
+from choc.types import L9, Bits, Change, ChangeBuffer, Edge, NotPureSignal, Tme, TmeType
+from choc.vcd import VcdReader, VcdSource, VcdWriter
+
+#builds the graph of the process segment test in the worker
+def bitsSegment():
+    head = IntToBits(16)
+    return head, head >> BitsToInt()
+
+async def double(x):
+    return 2 * x
+
+async def fail():
+    raise ValueError("fail")
+
+#a segment whose graph cannot be built in the worker
+def failingSegment():
+    raise ValueError("no graph")
+
+def setUpModule():
+    choc.setup(2)
 
 class TestChoc(unittest.TestCase):
     def setUp(self):
         logging.basicConfig(level=logging.DEBUG)
 
     def test_choc(self):
-        syn = Input("in")
-        bnd = Output("out")
+        syn = Input(int, "in")
+        bnd = Output(int, "out")
         syn >> bnd
         syn.feeds(range(100))
         lst = [bnd.consume() for _ in range(100)]
         self.assertListEqual(lst, list(range(100)))
 
     def test_int2bits(self):
-        syn = Input("in")
-        bnd = Output("out")
+        syn = Input(int, "in")
+        bnd = Output(int, "out")
         syn >> IntToBits(16) >> BitsToInt() >> bnd
         syn.feeds(range(100))
         lst = [bnd.consume() for _ in range(100)]
         self.assertListEqual(lst, list(range(100)))
 
+    def test_buffer(self):
+        syn = Input(int, "in")
+        bnd = Output(int, "out")
+        syn.connect(IntToBits(16), depth=16).connect(BitsToInt(), depth=16).connect(bnd, depth=16)
+        syn.feeds(range(100))
+        lst = [bnd.consume() for _ in range(100)]
+        self.assertListEqual(lst, list(range(100)))
+
+    def test_range(self):
+        bnd = Output(int, "out")
+        Range(3000) >> bnd
+        lst = [bnd.consume() for _ in range(3000)]
+        self.assertListEqual(lst, list(range(3000)))
+        self.assertEqual(bnd.consume(), PipeOffband.PipeEnd)
+
+    def test_trusted(self):
+        bnd = Output(int, "out")
+        Range(100).connect(IntToBits(8), trusted=True).connect(BitsToInt(), trusted=True) >> bnd
+        lst = [bnd.consume() for _ in range(100)]
+        self.assertListEqual(lst, list(range(100)))
+
+    def test_fuse(self):
+        syn = Input(int, "in")
+        bnd = Output(int, "out")
+        choc.fuse(syn, IntToBits(16), BitsToInt(), bnd)
+        syn.feeds(range(100))
+        syn.close()
+        lst = [bnd.consume() for _ in range(100)]
+        self.assertListEqual(lst, list(range(100)))
+        self.assertEqual(bnd.consume(), PipeOffband.PipeEnd)
+
+    def test_fuse_depth(self):
+        syn = Input(int, "in")
+        bnd = Output(int, "out")
+        conv = BitsToInt()
+        conv.pipeDepth = 4
+        choc.fuse(syn, IntToBits(16), conv, bnd)
+        self.assertIsInstance(conv.itemGet("in").pipe, Buffer)
+        syn.feeds(range(10))
+        self.assertListEqual([bnd.consume() for _ in range(10)], list(range(10)))
+
+    def test_fuse_offband(self):
+        syn = Input(int, "in")
+        bnd = Output(int, "out")
+        conv = BitsToInt()
+        choc.fuse(syn, IntToBits(16), conv, bnd)
+        self.assertIsInstance(conv.itemGet("in").pipe, Fuse)
+        syn.feeds([1, 2, PipeOffband.FrameEnd, 3])
+        self.assertListEqual([bnd.consume(timeout=5) for _ in range(3)], [1, 2, PipeOffband.FrameEnd])
+        with self.assertRaises(choc.TimedOut):
+            bnd.consume(timeout=0.2)
+
+    def test_lazy(self):
+        conv = IntToBits(16)
+        self.assertTrue(all(task.task is None for task in conv.pending))
+        syn = Input(int, "in")
+        bnd = Output(int, "out")
+        syn >> conv >> BitsToInt() >> bnd
+        self.assertIsNone(conv.pending)
+        syn.feeds(range(10))
+        lst = [bnd.consume() for _ in range(10)]
+        self.assertListEqual(lst, list(range(10)))
+
+    def test_shard(self):
+        syn = Input(int, "in")
+        bnd = Output(int, "out")
+        with choc.pinShard(1):
+            conv = IntToBits(16)
+        self.assertEqual(conv.shard, 1)
+        syn >> conv >> BitsToInt() >> bnd
+        syn.feeds(range(100))
+        lst = [bnd.consume() for _ in range(100)]
+        self.assertListEqual(lst, list(range(100)))
+
+    def test_offload(self):
+        bnd = Output(int, "out")
+        with ThreadPoolExecutor(2) as executor:
+            Range(100) >> IntToBits(16).offload(executor, batch=8) >> BitsToInt() >> bnd
+            lst = [bnd.consume() for _ in range(100)]
+        self.assertListEqual(lst, list(range(100)))
+        self.assertEqual(bnd.consume(), PipeOffband.PipeEnd)
+
+    def test_task(self):
+        self.assertEqual(choc.submit(double(21), "double")(timeout=5), 42)
+        with self.assertRaises(ValueError):
+            choc.submit(fail(), "fail")(timeout=5)
+        task = choc.Task(double(4), "double", start=False)
+        choc.startTasks([task])
+        self.assertEqual(task(timeout=5), 8)
+        tasks = choc.submitMany([double(i) for i in range(10)])
+        self.assertListEqual([task(timeout=5) for task in tasks], [2 * i for i in range(10)])
+        self.assertTrue(all(task.name == "double" for task in tasks))
+        coros = [double(i) for i in range(3)]
+        with self.assertRaises(ValueError):
+            choc.submitMany(coros, ["a", "b"])
+        self.assertTrue(all(coro.cr_frame is None for coro in coros))
+
+    def test_call(self):
+        self.assertEqual(choc.call(self.ccCross(), "cross", shard=1), 6)
+
+    #runs on shard 1 - calling shard 0 is fine, calling itself would block
+    async def ccCross(self):
+        with self.assertRaises(Exception):
+            choc.call(double(1), "double")
+        return choc.call(double(3), "double", shard=0)
+
+    def test_recvmany(self):
+        choc.call(self.ccRecvMany(), "recvMany", shard=0)
+
+    async def ccRecvMany(self):
+        tx = Socket("tx", Direction.Sender, int)
+        rx = Socket("rx", Direction.Receiver, int)
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.3, tx.connectForward, rx)
+        #one deadline for the connection and the values
+        start = loop.time()
+        self.assertListEqual(await rx.recvMany(timeout=0.5), [])
+        self.assertLess(loop.time() - start, 0.7)
+        push = asyncio.ensure_future(tx.sendMany([1, 2, 3]))
+        self.assertListEqual(await rx.recvMany(timeout=5), [1, 2, 3])
+        await push
+        push = asyncio.ensure_future(tx.sendMany([4, 5]))
+        self.assertListEqual(await rx.recvMany(1, timeout=5), [4])
+        self.assertListEqual(await rx.recvMany(timeout=5), [5])
+        await push
+
+    def test_session(self):
+        #the embedded daemon stands in for the threaded one of this module
+        daemon = choc.Daemon.instance
+        choc.Daemon.instance = None
+        try:
+            asyncio.run(self.ccSession())
+        finally:
+            choc.Daemon.instance = daemon
+
+    async def ccSession(self):
+        async with choc.session() as inst:
+            self.assertTrue(inst.embedded)
+            syn = Input(Change, "in")
+            prb = Probe()
+            syn >> prb
+            syn.feeds([Change(Bits(i % 2, 1), Tme(period=1000 * i)) for i in range(10)])
+            syn.close()
+            self.assertEqual(await prb.ccNextEdge(Edge.pos), Change(Bits(1, 1), Tme("1n")))
+            self.assertEqual(await prb.ccRead(at=Tme("4n")), Bits(0, 1))
+            with self.assertRaises(Exception):
+                choc.call(double(1), "double")
+        self.assertIsNone(choc.Daemon.instance)
+
+    def test_process(self):
+        seg = ProcessSegment(bitsSegment, int, int)
+        bnd = Output(int, "out")
+        Range(100) >> seg >> bnd
+        lst = [bnd.consume(timeout=10) for _ in range(100)]
+        self.assertListEqual(lst, list(range(100)))
+        self.assertEqual(bnd.consume(timeout=10), PipeOffband.PipeEnd)
+        seg.close()
+
+    def test_process_failure(self):
+        seg = ProcessSegment(failingSegment, int, int)
+        bnd = Output(int, "out")
+        Range(10) >> seg >> bnd
+        with self.assertRaises(ValueError):
+            seg.pumps[-1](timeout=20)
+        seg.close()
+
+    def test_probe(self):
+        syn = Input(Change, "in")
+        prb = Probe(retention=Tme("20n"))
+        syn >> prb
+        syn.feeds([Change(Bits(i % 2, 1), Tme(period=1000 * i)) for i in range(100)])
+        syn.close()
+        self.assertEqual(prb.nextEdge(Edge.pos), Change(Bits(1, 1), Tme("1n")))
+        prb.seek(Tme("50n"))
+        self.assertEqual(prb.nextEdge(Edge.neg).time, Tme("52n"))
+        self.assertEqual(prb.prevEdge(Edge.pos).time, Tme("51n"))
+        self.assertEqual(prb.read(at=Tme("40n")), Bits(0, 1))
+        self.assertRaises(AssertionError, prb.seek, Tme("10n"))
+        prb.seek(Tme("99n"))
+        self.assertIsNone(prb.nextEdge())
+
+    def test_merge(self):
+        ins = [Input(Change, f"in{k}") for k in range(3)]
+        mrg = TimeMerge(3)
+        out = Output(Change, "out")
+        for syn in ins:
+            syn >> mrg
+        mrg >> out
+        for k, syn in enumerate(ins):
+            syn.feeds([Change(k, Tme(cycle=3 * i + k % 2)) for i in range(10)])
+            syn.close()
+        lst = [out.consume(timeout=5) for _ in range(30)]
+        self.assertListEqual([chg.time.toInt() for chg in lst], sorted(chg.time.toInt() for chg in lst))
+        self.assertListEqual([chg.value for chg in lst[:3]], [0, 2, 1])
+        self.assertEqual(out.consume(timeout=5), PipeOffband.PipeEnd)
+
+    def test_probegroup(self):
+        grp = ProbeGroup(["clk", "valid"])
+        clk = Input(Change, "clk")
+        valid = Input(Change, "valid")
+        clk >> grp
+        valid >> grp
+        clk.feeds([Change(Bits(i % 2, 1), Tme(period=5000 * i)) for i in range(20)])
+        valid.feeds([Change(Bits(0, 1), Tme("0n")), Change(Bits(1, 1), Tme("52n"))])
+        clk.close()
+        valid.close()
+        self.assertEqual(grp.nextEdge(Edge.pos, "valid"), ("valid", {"clk": Bits(0, 1), "valid": Bits(1, 1)}))
+        self.assertEqual(grp.nextEdge(Edge.pos)[0], "clk")
+        self.assertEqual(grp.pos, Tme("55n"))
+        self.assertEqual(grp.prevEdge()[0], "valid")
+
+    def test_tofile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            txt = ToFile(Path(tmp) / "vals.txt", int)
+            Range(1000) >> txt
+            txt.wait(10)
+            self.assertListEqual((Path(tmp) / "vals.txt").read_text().split(), [str(i) for i in range(1000)])
+            tee = Tee(Path(tmp) / "vals.bin", Bits, binary=True)
+            out = Output(Bits, "out")
+            Range(100) >> IntToBits(12) >> tee >> out
+            lst = [out.consume(timeout=5) for _ in range(100)]
+            tee.wait(10)
+            self.assertListEqual([Bits.fromBytes(rec) for rec in readRecords(Path(tmp) / "vals.bin")], lst)
+
+    def test_tee_end(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            syn = Input(int, "in")
+            tee = Tee(Path(tmp) / "vals.txt", int)
+            out = Output(int, "out")
+            syn >> tee >> out
+            syn.feeds([0, 1, 2, PipeOffband.PipeEnd, 3])
+            self.assertListEqual([out.consume(timeout=5) for _ in range(4)], [0, 1, 2, PipeOffband.PipeEnd])
+            tee.wait(10)
+            self.assertListEqual((Path(tmp) / "vals.txt").read_text().split(), ["0", "1", "2"])
+
+    def test_filewriter_error(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = FileWriter(Path(tmp) / "vals.bin", flushSize=1)
+            #every write of the thread fails
+            writer.fh.close()
+            with self.assertRaises(ValueError):
+                for _ in range(4 * WRITE_QUEUE):
+                    writer.writeRaw(b"x")
+                writer.close()
+
+    def test_vcd(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            clk = Input(Change, "clk")
+            data = Input(Change, "data")
+            vcd = VcdWriter(Path(tmp) / "dump.vcd", ["clk", "data"])
+            clk >> vcd
+            data >> vcd
+            clk.feeds([Change(Bits(i % 2, 1), Tme(cycle=i)) for i in range(4)])
+            data.feeds([Change(Bits(3, 4), Tme("0c")), Change(Bits(3, 4), Tme("1c")), Change(Bits(9, 4), Tme("2c"))])
+            clk.close()
+            data.close()
+            vcd.wait(10)
+            text = (Path(tmp) / "dump.vcd").read_text()
+            reader = VcdReader(Path(tmp) / "dump.vcd", typ=TmeType.cycle, indexEvery=2)
+            self.assertListEqual(list(reader.changes("data", Tme("1c"))), [Change(Bits(3, 4), Tme("1c")), Change(Bits(9, 4), Tme("2c"))])
+            out = Output(Change, "out")
+            VcdSource(reader, "choc.clk", end=Tme("3c")) >> out
+            self.assertListEqual([out.consume(timeout=5) for _ in range(4)], [Change(Bits(i % 2, 1), Tme(cycle=i)) for i in range(3)] + [PipeOffband.PipeEnd])
+            ticks = list(reader._changes("data", tick=2))
+            self.assertIn(None, ticks)
+            self.assertListEqual([chg for chg in ticks if chg is not None], list(reader.changes("data")))
+            reader.close()
+            #the stored index is plain data and is loaded again, not rebuilt
+            self.assertNotEqual((Path(tmp) / "dump.vcd.idx").read_bytes()[:1], b"\x80")
+            again = VcdReader(Path(tmp) / "dump.vcd", typ=TmeType.cycle, indexEvery=2)
+            self.assertEqual((again.times, again.offsets, again.snaps), (reader.times, reader.offsets, reader.snaps))
+            self.assertListEqual(list(again.changes("data", Tme("1c"))), [Change(Bits(3, 4), Tme("1c")), Change(Bits(9, 4), Tme("2c"))])
+            again.close()
+            (Path(tmp) / "dump.vcd.idx").write_bytes(b"garbage")
+            again = VcdReader(Path(tmp) / "dump.vcd", typ=TmeType.cycle, indexEvery=2)
+            self.assertEqual(again.times, reader.times)
+            again.close()
+        self.assertIn("$timescale 1ns $end\n", text)
+        self.assertIn("$var wire 4 \" data $end\n", text)
+        self.assertTrue(text.endswith("$enddefinitions $end\n#0\n0!\nb0011 \"\n#1\n1!\n#2\n0!\nb1001 \"\n#3\n1!\n"))
+
     def test_signal(self):
-        out = Output("out")
-        (Clock(Tme("5c")) | Range(10)) >> Signal() >> out
+        out = Output(Change, "out")
+        (Clock(Tme("5c")) | Range(10)) >> TimedSignal() >> out
         for i in range(10):
             val = out.consume()
             self.assertEqual(val, Change(i, Tme(f"{i*5}c")))
@@ -63,3 +371,61 @@ class TestTme(unittest.TestCase):
         self.assertEqual(Tme("123n").toBytes(), b'\x00\x00\x00\x00\x00\x01\xe0x\x00')
         self.assertEqual(Tme("123n"), Tme.fromBytes(b'\x00\x00\x00\x00\x00\x01\xe0x\x00'))
 
+    def test_hash(self):
+        seen = {Tme("1n"): "a", Tme("1c"): "b"}
+        self.assertEqual(seen[Tme(period=1000)], "a")
+        self.assertEqual(seen[Tme(cycle=1)], "b")
+        self.assertEqual(len({Tme("2c"), Tme("1c") + Tme("1c")}), 1)
+        #period and cycle keys (and other types) mix without raising
+        mixed = {Tme("1c"), Tme("1p"), 1, "1c"}
+        self.assertEqual(len(mixed), 4)
+        self.assertNotIn(Tme("2c"), mixed)
+        self.assertNotEqual(Tme("1c"), Tme("1p"))
+        self.assertNotEqual(Tme("1c"), 1)
+        self.assertRaises(Exception, Tme("1c").__lt__, Tme("1p"))
+        self.assertRaises(AttributeError, setattr, Tme("1c"), "_val", 2)
+        self.assertEqual(pickle.loads(pickle.dumps(Tme("5u"))), Tme("5u"))
+
+
+class TestBits(unittest.TestCase):
+    def test_planes(self):
+        bits = Bits([L9._1, L9.X, L9._0, L9.D, L9.H])
+        self.assertEqual(len(bits), 5)
+        self.assertEqual(bits[1], L9.X)
+        self.assertEqual(bits[-1], L9.H)
+        self.assertEqual(bits.value, (L9._1, L9.X, L9._0, L9.D, L9.H))
+        self.assertEqual(str(bits[1:4]), "3'bD0X")
+        self.assertEqual(Bits.fromBytes(bits.toBytes()), bits)
+        self.assertRaises(NotPureSignal, bits.toInt)
+        self.assertTrue(bits.match(Bits([L9._1, L9.X, L9._0, L9._1, L9.H])))
+        self.assertFalse(bits.match(Bits([L9._0, L9.X, L9._0, L9._1, L9.H])))
+
+    def test_int(self):
+        bits = Bits(0xabcd, 16)
+        self.assertEqual(bits.toInt(), 0xabcd)
+        self.assertEqual(bits[4:12].toInt(), 0xbc)
+        self.assertEqual((bits[0:8] + bits[8:16]).toInt(), 0xabcd)
+        self.assertEqual(hash(bits), hash(Bits("16'habcd")))
+
+    def test_bytes(self):
+        bits = Bits("8'h5a") + Bits([L9.X, L9.Z, L9.U])
+        raw = bits.toBytes()
+        self.assertEqual(raw, b'\x00\x0b\x0a\x23\x01\x01\x10\x10')
+        self.assertEqual(Bits.fromBytes(raw), bits)
+        lst = [Bits(i, 12) for i in range(10)] + [bits]
+        self.assertListEqual(Bits.fromBytesMany(Bits.toBytesMany(lst)), lst)
+        self.assertListEqual(Bits.fromBytesMany(Bits.toBytesMany(lst), count=3), lst[:3])
+
+class TestChangeBuffer(unittest.TestCase):
+    def test_query(self):
+        clk = [Change(Bits(i & 1, 1), Tme(cycle=2 * i), sync=i != 3) for i in range(10)]
+        buf = ChangeBuffer(clk)
+        self.assertEqual(len(buf), 10)
+        self.assertListEqual(list(buf), clk)
+        self.assertEqual(buf.valueAt(Tme("7c")), Bits(1, 1))
+        self.assertIsNone(buf.valueAt(Tme("0c") - 1))
+        self.assertListEqual(buf.edges(Edge.pos), [1, 3, 5, 7, 9])
+        self.assertEqual(buf.prevEdge(Edge.neg, 8), 6)
+        self.assertListEqual(list(buf[Tme("4c"):Tme("10c")]), clk[2:5])
+        self.assertEqual(buf.trim(Tme("9c")), 4)
+        self.assertListEqual(buf.toChanges(), clk[4:])
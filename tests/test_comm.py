@@ -0,0 +1,347 @@
+####    ############    Copyright (C) 2025 Mattis Hasler, Barkhausen Institut
+####    ############    
+####                    This source describes Open Hardware and is licensed under the
+####                    CERN-OHL-W v2 (https://cern.ch/cern-ohl)
+############    ####    
+############    ####    
+####    ####    ####    
+####    ####    ####    
+############            Authors:
+############            Mattis Hasler (mattis.hasler@barkhauseninstitut.org)
+
+
+import asyncio
+from pathlib import Path
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+import choc
+from choc.items import Output
+from choc.types import Bits, Change, Tme, TmeType
+from sico.comm import Channel, Command, Connection, Control, Message, SocketProtocol
+
+SICO = Path(__file__).resolve().parent.parent / "sico"
+
+#channel and data of messages, the data of parsed messages are views
+def content(msgs:list[Message]) -> list[tuple[str,bytes]]:
+    return [(msg.channel, bytes(msg.data or b"")) for msg in msgs]
+
+def encode(msgs:list[Message], version:int, ids:dict[str,int]) -> bytes:
+    return b"".join(Message.encodeMany(msgs, version, ids))
+
+#the channel length fields of the complete frames at the front of raw
+def frameKinds(raw:bytes) -> list[int]:
+    kinds = []
+    pos = 0
+    while len(raw) - pos >= Message.BASE_LENGTH:
+        size, chanLength = Message.HEADER.unpack_from(raw, pos)
+        if len(raw) - pos < size:
+            break
+        kinds.append(chanLength)
+        pos += size
+    return kinds
+
+BUNDLE = Message.ID_FLAG | Message.BUNDLE_ID
+
+class TestWire(unittest.TestCase):
+    def setUp(self):
+        self.msgs = [Message("clk", b"\x01"), Message("data", b"abc"), Message("clk", b""), Message("data", b"d" * 300)]
+
+    def test_names(self):
+        raw = encode(self.msgs, 1, {})
+        msgs, rest = Message.splitFrames(raw)
+        self.assertListEqual(content(msgs), content(self.msgs))
+        self.assertEqual(rest, b"")
+
+    def test_ids(self):
+        ids = {}
+        names = {}
+        raw = encode(self.msgs, 2, ids)
+        self.assertDictEqual(ids, {"clk": 1, "data": 2})
+        msgs, rest = Message.splitFrames(raw, names)
+        self.assertListEqual(content(msgs), content(self.msgs))
+        self.assertEqual(rest, b"")
+        self.assertDictEqual(names, {1: "clk", 2: "data"})
+        #bound ids are reused without binding again
+        again = encode(self.msgs, 2, ids)
+        self.assertLess(len(again), len(raw))
+        msgs, _ = Message.splitFrames(again, names)
+        self.assertListEqual(content(msgs), content(self.msgs))
+
+    def test_bind(self):
+        raw = Message.bindFrame(5, "x") + b"".join(Message("x", b"data").toFrames(5))
+        names = {}
+        msgs, rest = Message.splitFrames(raw, names)
+        self.assertListEqual(content(msgs), [("x", b"data")])
+        self.assertEqual(rest, b"")
+        self.assertDictEqual(names, {5: "x"})
+
+    def test_unbound(self):
+        raw = b"".join(Message("x", b"data").toFrames(7))
+        with self.assertRaises(ConnectionResetError):
+            Message.splitFrames(raw, {})
+
+    def test_split(self):
+        raw = encode(self.msgs, 2, {})
+        for cut in range(len(raw) + 1):
+            names = {}
+            first, rest = Message.splitFrames(raw[:cut], names)
+            second, rest = Message.splitFrames(rest + raw[cut:], names)
+            self.assertListEqual(content(first) + content(second), content(self.msgs))
+            self.assertEqual(rest, b"")
+
+    def test_hello(self):
+        #without an answer to hello the peer is version 1 and gets names
+        old = encode(self.msgs, 1, {})
+        new = encode(self.msgs, 2, {})
+        self.assertNotEqual(old, new)
+        _, chanLength = Message.HEADER.unpack_from(old)
+        self.assertFalse(chanLength & Message.ID_FLAG)
+        _, chanLength = Message.HEADER.unpack_from(new)
+        self.assertEqual(chanLength, Message.ID_FLAG | Message.BIND_ID)
+        self.assertListEqual(content(Message.splitFrames(old)[0]), content(Message.splitFrames(new, {})[0]))
+
+    def test_bundle(self):
+        msgs = [Message(f"ch{i % 16}", bytes([i]) * (i % 5)) for i in range(100)]
+        ids = {}
+        raw = encode(msgs, 3, ids)
+        self.assertEqual(len(ids), 16)
+        #the bind frames come ahead of the one bundle
+        self.assertListEqual(frameKinds(raw), [Message.ID_FLAG | Message.BIND_ID] * 16 + [BUNDLE])
+        names = {}
+        got, rest = Message.splitFrames(raw, names)
+        self.assertListEqual(content(got), content(msgs))
+        self.assertEqual(rest, b"")
+        #bound channels are not bound again
+        self.assertListEqual(frameKinds(encode(msgs, 3, ids)), [BUNDLE])
+        #a single message is not bundled
+        self.assertListEqual(frameKinds(encode(msgs[:1], 3, ids)), [Message.ID_FLAG | 1])
+
+    def test_bundle_split(self):
+        raw = encode(self.msgs * 10, 3, {})
+        for cut in range(len(raw) + 1):
+            names = {}
+            first, rest = Message.splitFrames(raw[:cut], names)
+            second, rest = Message.splitFrames(rest + raw[cut:], names)
+            self.assertListEqual(content(first) + content(second), content(self.msgs * 10))
+            self.assertEqual(rest, b"")
+
+    def test_bundle_size(self):
+        msgs = [Message(f"ch{i % 4}", i.to_bytes(2, 'big') * 500) for i in range(200)]
+        raw = encode(msgs, 3, {})
+        kinds = frameKinds(raw)
+        bundles = kinds.count(BUNDLE)
+        total = sum(msg.nBytes() for msg in msgs)
+        self.assertEqual(bundles, (total + Message.BUNDLE_BYTES - 1) // Message.BUNDLE_BYTES)
+        got, rest = Message.splitFrames(raw, {})
+        self.assertListEqual(content(got), content(msgs))
+        self.assertEqual(rest, b"")
+
+#stands in for the socket transport of a SocketProtocol
+class FakeTransport:
+    def __init__(self):
+        self.reading = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+#feeds raw into the protocol as the transport would - in reads of at most step bytes
+def feed(protocol:SocketProtocol, raw:bytes, step:int):
+    for pos in range(0, len(raw), step):
+        buf = protocol.get_buffer(-1)
+        part = raw[pos:pos+min(step, len(buf))]
+        buf[:len(part)] = part
+        protocol.buffer_updated(len(part))
+
+class TestSocketProtocol(unittest.TestCase):
+    def test_recv(self):
+        asyncio.run(self.ccRecv())
+
+    async def ccRecv(self):
+        transport = FakeTransport()
+        protocol = SocketProtocol(64)
+        protocol.connection_made(transport)
+        msgs = [Message("a", b"1" * 10), Message("b", b"2" * 20), Message("c", b"3" * 200), Message("a", b"4")]
+        raw = encode(msgs, 2, {})
+        names = {}
+        got = []
+        pos = 0
+        while pos < len(raw):
+            step = min(len(protocol.get_buffer(-1)), 50)
+            feed(protocol, raw[pos:pos+step], step)
+            pos += step
+            got += await protocol.ccRecv(names)
+            self.assertTrue(transport.reading)
+        #the data of earlier messages is not overwritten by later reads
+        self.assertListEqual(content(got), content(msgs))
+        protocol.eof_received()
+        with self.assertRaises(asyncio.IncompleteReadError):
+            await protocol.ccRecv(names)
+
+    def test_reuse(self):
+        asyncio.run(self.ccReuse())
+
+    async def ccReuse(self):
+        protocol = SocketProtocol(1 << 14)
+        protocol.connection_made(FakeTransport())
+        buffer = protocol.buffer.obj
+        small = [Message("a", bytes([i]) * 10) for i in range(10)]
+        feed(protocol, encode(small, 1, {}) + Message("a", b"x" * 10).toBytes()[:12], 1 << 14)
+        got = await protocol.ccRecv({})
+        #small payloads are copied out, the buffer is kept with the rest at its front
+        self.assertTrue(all(isinstance(msg.data, bytes) for msg in got))
+        self.assertIs(protocol.buffer.obj, buffer)
+        self.assertEqual(protocol.end, 12)
+        large = Message("b", b"y" * (2 * SocketProtocol.COPY_BYTES))
+        feed(protocol, Message("a", b"x" * 10).toBytes()[12:] + large.toBytes(), 1 << 14)
+        got += await protocol.ccRecv({})
+        #a large payload is a view into the buffer, so the next data goes to a new one
+        self.assertIsInstance(got[-1].data, memoryview)
+        self.assertIsNot(protocol.buffer.obj, buffer)
+        feed(protocol, Message("c", b"z" * 5000).toBytes(), 1 << 14)
+        got += await protocol.ccRecv({})
+        self.assertListEqual(content(got), content(small + [Message("a", b"x" * 10), large, Message("c", b"z" * 5000)]))
+
+    def test_full(self):
+        asyncio.run(self.ccFull())
+
+    async def ccFull(self):
+        transport = FakeTransport()
+        protocol = SocketProtocol(32)
+        protocol.connection_made(transport)
+        raw = Message("x", b"y" * 100).toBytes()
+        feed(protocol, raw[:32], 32)
+        self.assertFalse(transport.reading)
+        self.assertListEqual(await protocol.ccRecv({}), [])
+        self.assertTrue(transport.reading)
+        #the buffer grew to take the whole message
+        self.assertEqual(len(protocol.get_buffer(-1)), len(raw) - 32)
+        feed(protocol, raw[32:], len(raw))
+        self.assertListEqual(content(await protocol.ccRecv({})), [("x", b"y" * 100)])
+
+#a connection to a fake simulator - a python socket server
+class TestConnection(unittest.TestCase):
+    def test_unbound(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "SiCo.sock"
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(str(path))
+            server.listen()
+            server.settimeout(10)
+            conn = Connection(dispatch=lambda msgs: None)
+            conn.socketName = str(path)
+            first, _ = server.accept()
+            first.sendall(b"".join(Message("x", b"data").toFrames(7)))
+            #the connection drops the peer and connects again
+            second, _ = server.accept()
+            self.assertEqual(conn.connTerm, 1)
+            for sock in (first, second, server):
+                sock.close()
+
+#the handler table of a control - no simulator is connected
+class TestControl(unittest.TestCase):
+    def test_handlers(self):
+        ctrl = Control()
+        choc.call(self.ccHandlers(ctrl), "handlers", shard=ctrl.shard)
+
+    async def ccHandlers(self, ctrl:Control):
+        first = []
+        second = []
+        ctrl.register("x", first.append)
+        ctrl.dispatch([Message("x", b"1")])
+        with self.assertLogs(Control.logName, "WARNING"):
+            ctrl.register("x", second.append)
+        ctrl.dispatch([Message("x", b"2")])
+        #only the current handler is removed
+        ctrl.unregister("x", first.append)
+        ctrl.dispatch([Message("x", b"3")])
+        ctrl.unregister("x", second.append)
+        ctrl.dispatch([Message("x", b"4")])
+        self.assertListEqual(content(first), [("x", b"1")])
+        self.assertListEqual(content(second), [("x", b"2"), ("x", b"3")])
+        #messages without a handler wait for the next one
+        ctrl.register("x", first.append)
+        self.assertListEqual(content(first), [("x", b"1"), ("x", b"4")])
+
+    def test_channel(self):
+        ctrl = Control()
+        chan = Channel(ctrl, "chan")
+        out = Output(Change, "out")
+        chan >> out
+        for _ in range(100):
+            if "chan" in ctrl.handlers:
+                break
+            time.sleep(0.01)
+        chg = Change(Bits(5, 8), Tme(10, typ=TmeType.period))
+        choc.do(ctrl.dispatch, [Message("chan", chg.toBytes())], name="dispatch", shard=ctrl.shard)
+        self.assertEqual(out.consume(timeout=5).value, Bits(5, 8))
+        chan.close()
+        self.assertNotIn("chan", ctrl.handlers)
+
+#runs the C++ side of sico (sico/test/loopback.cc) against the python encoding
+@unittest.skipIf(shutil.which("g++") is None, "needs g++")
+class TestLoopback(unittest.TestCase):
+    COUNT = 1000
+    CHANNELS = 16
+
+    def test_loopback(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            exe = Path(tmp) / "loopback"
+            subprocess.run(["g++", "-std=c++17", "-I", SICO / "cpp", SICO / "test" / "loopback.cc", SICO / "cpp" / "SiCo.cc", "-o", exe, "-lpthread"], check=True)
+            with open(Path(tmp) / "loopback.log", "w+") as log:
+                sim = subprocess.Popen([exe, str(self.COUNT)], cwd=tmp, stdout=log, stderr=subprocess.STDOUT)
+                try:
+                    self.exchange(Path(tmp) / "SiCo.sock")
+                    self.assertEqual(sim.wait(20), 0)
+                finally:
+                    sim.kill()
+                log.seek(0)
+                self.assertIn(f"received {self.COUNT}", log.read())
+
+    def connect(self, path:Path) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(20)
+        for _ in range(200):
+            try:
+                sock.connect(str(path))
+                return sock
+            except (ConnectionRefusedError, FileNotFoundError):
+                time.sleep(0.05)
+        self.fail("loopback did not listen")
+
+    def exchange(self, path:Path):
+        sock = self.connect(path)
+        sock.sendall(Message(Control.SC_CHAN, Command.hello.toBytes() + Connection.VERSION.to_bytes(4, 'big')).toBytes())
+        ids = {}
+        names = {}
+        received = {}
+        bundles = 0
+        rest = b""
+        while sum(map(len, received.values())) < self.COUNT * self.CHANNELS:
+            chunk = sock.recv(Connection.RECV_CHUNK)
+            self.assertTrue(chunk, "loopback closed the connection")
+            raw = rest + chunk
+            bundles += frameKinds(raw).count(BUNDLE)
+            msgs, rest = Message.splitFrames(raw, names)
+            for msg in msgs:
+                if msg.channel != Control.SC_CHAN:
+                    received.setdefault(msg.channel, []).append(bytes(msg.data))
+                elif Command.fromBytes(msg.data) == Command.hello:
+                    #the peer talks version 3 from now on - start the recording
+                    go = Change(Bits(0xffff, 16), Tme(0, typ=TmeType.period))
+                    sock.sendall(encode([Message("loopback", go.toBytes())], 3, ids))
+        #one time step of all channels is larger than a bundle
+        self.assertGreater(bundles, 1)
+        self.assertListEqual(sorted(received), sorted(f"ch{c}" for c in range(self.CHANNELS)))
+        values = [Change.fromBytes(data, Bits).value.toInt() for data in received["ch0"]]
+        self.assertListEqual(values, list(range(1, self.COUNT + 1)))
+        self.assertTrue(all(chan == received["ch0"] for chan in received.values()))
+        #send them back in one bundle
+        sock.sendall(encode([Message("loopback", data) for data in received["ch0"]], 3, ids))
+        sock.close()